@@ -1,56 +1,174 @@
-from flask import Flask, send_from_directory, render_template, abort, request, jsonify, redirect, url_for, send_file, session
+from flask import Flask, Response, send_from_directory, render_template, abort, request, jsonify, redirect, url_for, send_file, session, g
 from flask_sqlalchemy import SQLAlchemy
+from werkzeug.middleware.proxy_fix import ProxyFix
 from sqlalchemy import text
-from werkzeug.security import generate_password_hash, check_password_hash
 import re
 import os
+import math
+import hmac
+import click
+import time
+import logging
+import threading
 from functools import wraps
 from pathlib import Path
 
 # custom imports
+import metrics
 from helper_functions import allowed_file, clean_filename, get_subtitle_url
-from database import db, User, Media, MediaProgress, user_watched, create_media_object
+from database import db, User, Media, MediaProgress, BookProgress, Folder, SubtitleTrack, user_watched, migrate, tune_sqlite, get_watched_ids, get_folder_page, set_watched, get_folder_state, get_known_media_ids, get_next_video
+from library import scan_library, scan_folder, scan_lock, start_scanner
+from reconcile import reconcile, start_reconciler
+from progress_buffer import ProgressBuffer
+from event_log import EventLog
+from auth import HasherBusy, RateLimiter, create_hasher, remember_login, forget_login, get_session_user, logins_rejected
+from media_delivery import send_media
+from epub import load_book, iter_member, get_media_type
+from search import create_search_index, search_media
+from listing_cache import ListingCache, create_version_triggers
+from streaming import SegmentError, create_generator, get_ffmpeg, get_ffprobe, needs_hls, get_version, plan_segments, build_playlist
+from prefetch import create_prefetcher
+from uploads import UploadError, create_upload, load_upload, get_offset, write_chunk, finalize_upload, discard_upload
 from config import *
 
-MEDIA_DIR = "../media"
+MEDIA_DIR = os.getenv("MEDIA_DIR", "../media")
+
+logging.basicConfig(level=LOG_LEVEL, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+log = logging.getLogger("app")
 
 app = Flask(__name__)
 app.secret_key = os.getenv("SECRET_KEY")
+if TRUSTED_PROXIES:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXIES) # request.remote_addr is the client, not the proxy
 
 admin_user = os.getenv("ADMIN_USERNAME")
 admin_pass = os.getenv("ADMIN_PASSWORD")
 
-app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///media-server.db"
+app.config["SQLALCHEMY_DATABASE_URI"] = os.getenv("DATABASE_URI", "sqlite:///media-server.db")
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 
 db.init_app(app)
 
+password_hasher = create_hasher(PASSWORD_HASH_METHOD, PASSWORD_HASH_WORKERS, PASSWORD_HASH_QUEUE)
+login_limiter = RateLimiter(LOGIN_ATTEMPTS_PER_MINUTE, LOGIN_ATTEMPTS_BURST)
+
 with app.app_context():
+    tune_sqlite(db.engine)
+    metrics.instrument(app, db.engine)
     db.create_all()
+    migrate()
+    create_search_index()
+    create_version_triggers()
     if not User.query.filter_by(username=admin_user).first():
-        hashed_pw = generate_password_hash(admin_pass)
+        hashed_pw = password_hasher.hash(admin_pass)
         admin = User(username=admin_user, password_hash=hashed_pw, is_admin=True)
         db.session.add(admin)
         db.session.commit()
 
+    # index the media folder once at startup, then keep it up to date in the background
+    os.makedirs(app.instance_path, exist_ok=True)
+    with scan_lock(os.path.join(app.instance_path, "library-scan.lock")):
+        scan_library(MEDIA_DIR, verbose=True, in_pool=True) # no other threads are running yet
+
+    metrics.remove_stale_snapshots(METRICS_DIR)
+    metrics.write_snapshot(METRICS_DIR) # the startup scan, forked workers count from zero
+
+# video progress heartbeats, see PROGRESS_STORE in config.py
+if PROGRESS_STORE == "log" or (PROGRESS_STORE == "auto" and WSGI_WORKERS > 1):
+    event_log = EventLog(EVENT_LOG_DIR, EVENT_LOG_GROUP_COMMIT) # also takes the watched changes
+    progress_store = event_log
+else:
+    event_log = None
+    progress_store = ProgressBuffer() # written to the database in batches
+
+setup_pid = os.getpid() # process that set up the database above
+background_pid = None
+background_lock = threading.Lock()
+
+@app.before_request
+def start_background_tasks():
+    # threads don't survive gunicorn forking a preloaded app, so start them once per worker process
+    global background_pid
+    if background_pid == os.getpid():
+        return
+
+    with background_lock:
+        if background_pid == os.getpid():
+            return
+
+        if os.getpid() != setup_pid:
+            db.engine.dispose(close=False) # don't share the parent's sqlite connections
+
+        start_scanner(app, MEDIA_DIR, LIBRARY_SCAN_INTERVAL)
+        start_reconciler(app, MEDIA_DIR, RECONCILE_INTERVAL, RECONCILE_ORPHAN_GRACE, event_log)
+        progress_store.start(app, EVENT_LOG_COMPACT_INTERVAL if event_log else PROGRESS_FLUSH_INTERVAL)
+        metrics.start(METRICS_DIR, METRICS_WRITE_INTERVAL)
+        background_pid = os.getpid()
+
+segment_generator = create_generator() # HLS segments for videos browsers can't play
+
+# warms the next episode while one is ending
+prefetcher = create_prefetcher(MEDIA_DIR, PREFETCH_DIR, PREFETCH_LEAD_SECONDS, PREFETCH_HEAD_BYTES, PREFETCH_TAIL_BYTES, 
+                               PREFETCH_BUDGET_PER_MINUTE, PREFETCH_BUDGET_BURST, PREFETCH_WINDOW) if PREFETCH_ENABLED else None
+
+# rendered folder pages, under keys that change with the template too (pages on disk outlive restarts)
+template_mtime = os.stat(os.path.join(app.root_path, app.template_folder, "index.html")).st_mtime_ns
+listing_cache = ListingCache(LISTING_CACHE_SIZE, LISTING_CACHE_DIR, LISTING_CACHE_DISK_ENTRIES, 
+                             namespace=f"{template_mtime}:{INFO_POPUP_TEXT}")
+
 def get_user():
-    user_id = session.get("user_id", None)
-    if user_id:
-        user = User.query.filter_by(user_id=user_id).first()
-        return user
-    return None
+    # from the login state cached in the session, or from the database once that is
+    # AUTH_SESSION_TTL seconds old; at most once per request
+    if "user" not in g:
+        g.user = get_session_user(AUTH_SESSION_TTL)
+        user_id = session.get("user_id", None)
+        if not g.user and user_id:
+            g.user = db.session.get(User, user_id)
+            if g.user:
+                remember_login(g.user)
+            else:
+                forget_login() # user was deleted
+    return g.user
+
+def load_watched_ids(user_id, media_ids = None):
+    # get_watched_ids(), plus changes that are still in the event log
+    watched_ids = get_watched_ids(user_id, media_ids)
+    if event_log:
+        media_ids = set(media_ids) if media_ids is not None else None
+        for media_id, watched in event_log.get_watched(user_id).items():
+            if not watched:
+                watched_ids.discard(media_id)
+            elif media_ids is None or media_id in media_ids:
+                watched_ids.add(media_id)
+    return watched_ids
+
+def get_pending_watched(user_id):
+    # watched changes still in the event log, for queries that filter on user_watched
+    return event_log.get_watched(user_id) if event_log and user_id else None
+
+def get_user_watched_ids():
+    # media_ids the current user marked as watched, loaded at most once per request
+    if "watched_ids" not in g:
+        user = get_user()
+        g.watched_ids = load_watched_ids(user.user_id) if user else set()
+    return g.watched_ids
 
 def user_is_admin():
+    # the session only caches is_admin for display, a demoted or deleted admin loses access right away
     user = get_user()
-    if not user:
+    if not user or not user.is_admin:
         return False
-    return user.is_admin
+    if isinstance(user, User):
+        return True # loaded from the database in this request
+    return bool(db.session.execute(db.select(User.is_admin).where(User.user_id == user.user_id)).scalar())
+
+def user_exists():
+    return get_user() is not None
 
 def login_required(f):
     @wraps(f)
     def wrapper(*args, **kwargs):
-        user_id = session.get("user_id", None)
-        if not user_id:
+        if not user_exists():
             abort(401)
         return f(*args, **kwargs)
     return wrapper
@@ -71,65 +189,50 @@ def index(subpath):
     show_mp4_only = request.args.get('mp4_only') == 'true'
     show_unwatched = request.args.get('unwatched', 'false') == 'true'
     
-    current_path = os.path.join(MEDIA_DIR, subpath)
-
-    if not (os.path.exists(current_path) and os.path.isdir(current_path)):
-        abort(404)
-
-    # collect all filenames/folders in current subdirectory
-    items = sorted(os.listdir(current_path), key = lambda x: x.upper())
-    folders = [item for item in items if os.path.isdir(os.path.join(current_path, item)) and not item.startswith(".")]
-    
-    media_filenames = [item for item in items if item.endswith(tuple(VIDEO_EXT | BOOK_EXT))]
+    # served from the library index (see library.py), not the filesystem
+    subpath = subpath.strip("/")
     
-    subtitle_filenames = [item for item in items if item.endswith(tuple(SUBTITLE_EXT))]
-    subtitle_basenames = [os.path.splitext(f)[0] for f in subtitle_filenames]
-
-    # collect/create media objects for each media filename in current subdirectory
-    media_list = [] 
-    db_updated = False
-    
-    for filename in media_filenames:
-        media_subpath = os.path.join(subpath, filename)
-        media = Media.query.filter_by(subpath=media_subpath).first()
-
-        # create media object if it doesn't exist
-        if not media:
-            media = create_media_object(filename, media_subpath, subtitle_basenames)
-
-            db.session.add(media) # add new object to database
-            db_updated = True
-
-        else:
-            # update whether existing media objects have subtitles
-            has_subtitles = media.get_subtitles_bool(subtitle_basenames)
-
-            if has_subtitles and not media.has_subtitles:
-                # new subtitles were uploaded
-                media.has_subtitles = True
-                db_updated = True
-                
-            elif not has_subtitles and media.has_subtitles:
-                # subtitles were removed
-                media.has_subtitles = False
-                db_updated = True
-                
-        media_list.append(media)
-        
-    if db_updated:
-        db.session.commit()
+    folder = Folder.query.filter_by(subpath=subpath).first()
+    if not folder:
+        abort(404)
 
-    # applying search filters
+    # rendered pages are cached, see listing_cache.py
     user = get_user()
-    if user:
-        watched_media = [media for media in user.watched_media]
+    key = listing_key(folder, user, show_unwatched, show_mp4_only)
+    if key in request.if_none_match:
+        response = Response(status=304)
     else:
-        watched_media = []
+        page = listing_cache.get(key)
+        if page is None:
+            page = render_index(subpath, user, show_unwatched, show_mp4_only)
+            listing_cache.put(key, page)
+        response = Response(page, mimetype="text/html")
+
+    response.set_etag(key)
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response
+
+def listing_key(folder, user, show_unwatched, show_mp4_only):
+    # everything a folder page depends on, the versions are bumped by sqlite triggers
+    user_state = None
+    if user:
+        watched_version = db.session.execute(db.select(User.watched_version).where(User.user_id == user.user_id)).scalar()
+        pending = sorted(event_log.get_watched(user.user_id).items()) if event_log else [] # not in the database yet
+        user_state = [user.user_id, user.username, user.is_admin, watched_version, pending]
 
-    if show_mp4_only:
-        media_list = [media for media in media_list if media.filename.endswith(".mp4")]
-    if show_unwatched:
-        media_list = [media for media in media_list if not media in watched_media]
+    return listing_cache.key(folder.subpath, folder.mtime, folder.version, show_unwatched, show_mp4_only, user_state)
+
+def render_index(subpath, user, show_unwatched, show_mp4_only):
+    folders = sorted((folder.name for folder in Folder.query.filter_by(parent=subpath)), key = lambda x: x.upper())
+
+    # only the first page of media, index.html loads the rest from /api/list
+    media_list, next_cursor = get_folder_page(subpath, 
+                                              LISTING_PAGE_SIZE, 
+                                              user_id=user.user_id if user else None, 
+                                              unwatched=show_unwatched, 
+                                              mp4_only=show_mp4_only,
+                                              pending_watched=get_pending_watched(user.user_id if user else None))
+    watched_ids = load_watched_ids(user.user_id, [media.media_id for media in media_list]) if user else set()
 
     parent_path = str(Path(subpath).parent) if subpath else "" # path for "back" button
     
@@ -138,11 +241,99 @@ def index(subpath):
                            parent_path=parent_path, 
                            folders=folders, 
                            media_list=media_list, 
-                           watched_media=watched_media, 
+                           watched_ids=watched_ids, 
                            show_unwatched=show_unwatched, 
                            show_mp4_only=show_mp4_only, 
                            user=user,
-                           info_popup_text=INFO_POPUP_TEXT)
+                           info_popup_text=INFO_POPUP_TEXT,
+                           next_cursor=next_cursor)
+
+def media_json(media, watched_ids):
+    return {"media_id": media.media_id, 
+            "filename": media.filename, 
+            "subpath": media.subpath, 
+            "has_subtitles": media.has_subtitles, 
+            "duration": media.duration,
+            "width": media.width,
+            "height": media.height,
+            "playable": media.playable,
+            "poster_url": url_for("poster_file", name=media.poster) if media.poster else None,
+            "watched": media.media_id in watched_ids}
+
+@app.route('/api/list/', defaults={'subpath': ''})
+@app.route('/api/list/<path:subpath>')
+# paginated folder listing: pass the returned next_cursor to get the following page
+def api_list(subpath):
+    subpath = subpath.strip("/")
+    show_mp4_only = request.args.get('mp4_only') == 'true'
+    show_unwatched = request.args.get('unwatched', 'false') == 'true'
+    limit = min(max(request.args.get('limit', LISTING_PAGE_SIZE, type=int), 1), LISTING_PAGE_SIZE)
+
+    if not Folder.query.filter_by(subpath=subpath).first():
+        abort(404)
+
+    user_id = session.get("user_id", None)
+    try:
+        media_list, next_cursor = get_folder_page(subpath, 
+                                                  limit, 
+                                                  cursor=request.args.get('cursor'), 
+                                                  user_id=user_id, 
+                                                  unwatched=show_unwatched, 
+                                                  mp4_only=show_mp4_only,
+                                                  pending_watched=get_pending_watched(user_id))
+    except ValueError:
+        abort(400)
+
+    watched_ids = load_watched_ids(user_id, [media.media_id for media in media_list]) if user_id else set()
+
+    return jsonify({"media": [media_json(media, watched_ids) for media in media_list], 
+                    "next_cursor": next_cursor})
+
+def get_search_results():
+    # shared by /search and /api/search
+    query = request.args.get('q', '').strip()
+    page = max(request.args.get('page', 1, type=int), 1)
+    limit = min(max(request.args.get('limit', SEARCH_PAGE_SIZE, type=int), 1), SEARCH_PAGE_SIZE)
+    show_mp4_only = request.args.get('mp4_only') == 'true'
+    show_unwatched = request.args.get('unwatched', 'false') == 'true'
+
+    user_id = session.get("user_id", None)
+    media_list, has_more = search_media(query, 
+                                        user_id=user_id, 
+                                        unwatched=show_unwatched, 
+                                        mp4_only=show_mp4_only, 
+                                        pending_watched=get_pending_watched(user_id),
+                                        limit=limit, 
+                                        offset=(page - 1) * limit)
+
+    return query, page, media_list, has_more, show_mp4_only, show_unwatched
+
+@app.route('/search')
+def search():
+    query, page, media_list, has_more, show_mp4_only, show_unwatched = get_search_results()
+
+    return render_template("index.html", 
+                           subpath="", 
+                           parent_path="", 
+                           folders=[], 
+                           media_list=media_list, 
+                           watched_ids=get_user_watched_ids(), 
+                           show_unwatched=show_unwatched, 
+                           show_mp4_only=show_mp4_only, 
+                           user=get_user(),
+                           info_popup_text=INFO_POPUP_TEXT,
+                           search_query=query,
+                           page=page,
+                           has_more=has_more)
+
+@app.route('/api/search')
+def api_search():
+    query, page, media_list, has_more, show_mp4_only, show_unwatched = get_search_results()
+    watched_ids = get_user_watched_ids()
+
+    results = [media_json(media, watched_ids) for media in media_list]
+
+    return jsonify({"query": query, "page": page, "has_more": has_more, "results": results})
 
 @app.route("/login", methods=["GET", "POST"])
 def login():
@@ -152,27 +343,50 @@ def login():
     # POST
     username = request.form.get("username")
     password = request.form.get("password")
+    ip = request.remote_addr
 
-    if LOG_LOGIN_ATTEMPTS:
-        ip = request.remote_addr
+    # every attempt counts against the ip, only failed ones against the username
+    retry_after = login_limiter.take(f"ip:{ip}") or login_limiter.retry_after(f"user:{username}")
+    if retry_after:
+        if LOG_LOGIN_ATTEMPTS:
+            log.warning("login rate limited username=%r ip=%s", username, ip)
+        return auth_rejected("login.html", "rate_limited", "Too many login attempts, try again later", 429, retry_after)
 
-    user = User.query.filter_by(username=username).first()
-    
-    if user and check_password_hash(user.password_hash, password):
+    user = User.query.filter_by(username=username).first() if username and password else None
+
+    try:
+        valid = user is not None and password_hasher.check(user.password_hash, password)
+    except HasherBusy:
+        return auth_rejected("login.html", "busy", "Server busy, try again in a moment", 503, 1)
+
+    if valid:
         if LOG_LOGIN_ATTEMPTS:
-            print(f"login successful; username '{username}', ip '{ip}'")
+            log.info("login successful username=%r ip=%s", username, ip)
+
+        if password_hasher.needs_rehash(user.password_hash):
+            try:
+                user.password_hash = password_hasher.hash(password)
+                db.session.commit()
+            except HasherBusy:
+                pass # upgraded on a later login
 
-        session["user_id"] = user.user_id
+        remember_login(user)
         return redirect(url_for("index"))
 
+    login_limiter.take(f"user:{username}")
     if LOG_LOGIN_ATTEMPTS:
-        print(f"login failed; username '{username}', ip '{ip}'")
+        log.warning("login failed username=%r ip=%s", username, ip)
         
     return render_template("login.html", error="Invalid credentials")
 
+def auth_rejected(template, reason, error, status, retry_after):
+    # login or signup turned away before hashing the password
+    logins_rejected.inc(reason=reason)
+    return render_template(template, error=error), status, {"Retry-After": str(math.ceil(retry_after))}
+
 @app.route("/logout")
 def logout():
-    session.pop("user_id", None)
+    forget_login()
     return redirect(url_for("index"))
     
 @app.route('/signup', methods=['GET', 'POST'])
@@ -195,18 +409,27 @@ def signup():
     if password != confirm_password:
         return render_template("signup.html", error = "Passwords do not match")
 
+    ip = request.remote_addr
+    retry_after = login_limiter.take(f"ip:{ip}")
+    if retry_after:
+        return auth_rejected("signup.html", "rate_limited", "Too many attempts, try again later", 429, retry_after)
+
+    try:
+        password_hash = password_hasher.hash(password)
+    except HasherBusy:
+        return auth_rejected("signup.html", "busy", "Server busy, try again in a moment", 503, 1)
+
     if LOG_LOGIN_ATTEMPTS:
-        ip = request.remote_addr
-        print(f"new user; username '{username}', ip '{ip}'")
+        log.info("new user username=%r ip=%s", username, ip)
         
     new_user = User(
             username=username,
-            password_hash=generate_password_hash(password),
+            password_hash=password_hash,
             is_admin=False)
     
     db.session.add(new_user)
     db.session.commit()
-    session["user_id"] = new_user.user_id
+    remember_login(new_user)
     
     return redirect(url_for("index"))
 
@@ -222,20 +445,35 @@ def play(subpath):
 
     name = os.path.splitext(subpath)[0] # remove extension
     
+    user = get_user()
+    logged_in = True if user else False
+
     if media.is_book:
-        book_url = url_for('media', subpath=subpath)
-        return render_template("reader.html", book_name=name, book_url=book_url)
+        # chapters are loaded from /books/ (see epub.py)
+        return render_template("reader.html", book_name=name, media_id=media.media_id, logged_in=logged_in)
         
     video_url = f"/media/{subpath}" # endpoint that serves video files
     subtitle_url = get_subtitle_url(subpath, media_dir = MEDIA_DIR)
-    
-    user = get_user()
-    logged_in = True if user else False
+
+    # subtitle tracks inside the file, extracted by the metadata scan (see embedded_subtitles.py)
+    subtitle_tracks = []
+    if media.has_embedded_subtitles:
+        for track in SubtitleTrack.query.filter_by(media_id=media.media_id).order_by(SubtitleTrack.track_number):
+            subtitle_tracks.append({"url": url_for("subtitle_file", name=track.filename),
+                                    "language": track.language or "",
+                                    "label": track.name or track.language or f"Track {track.track_number}",
+                                    "default": track.is_default or track.is_forced})
+
+    # videos browsers can't play directly are streamed as HLS, see streaming.py
+    hls_url = url_for("hls_playlist", media_id=media.media_id) if needs_hls(media) and get_ffmpeg() else None
     
     return render_template("play.html", 
                            video_url=video_url, 
+                           hls_url=hls_url,
+                           hls_js_url=HLS_JS_URL,
                            subtitle_url=subtitle_url, 
                            has_subtitles=media.has_subtitles, 
+                           subtitle_tracks=subtitle_tracks,
                            movie_name=name, 
                            media_id=media.media_id,
                            logged_in=logged_in)
@@ -251,13 +489,17 @@ def toggle_watched():
     if not media:
         abort(404)
         
-    user = get_user()
+    user_id = session.get("user_id")
+    key = (user_watched.c.user_id == user_id) & (user_watched.c.media_id == media.media_id)
 
-    if media in user.watched_media:
-        user.watched_media.remove(media)
+    if event_log:
+        watched = media.media_id not in load_watched_ids(user_id, [media.media_id])
+        event_log.set_watched(user_id, [media.media_id], watched)
+    elif db.session.execute(db.select(user_watched.c.media_id).where(key)).first():
+        db.session.execute(user_watched.delete().where(key))
         watched = False
     else:
-        user.watched_media.append(media)
+        db.session.execute(user_watched.insert().values(user_id=user_id, media_id=media.media_id))
         watched = True
         
     db.session.commit()
@@ -272,13 +514,16 @@ def progress(media_id):
     user_id = session.get("user_id")
     
     if request.method == "GET":
-        row = MediaProgress.query.filter_by(user_id=user_id, media_id=media_id).first()
-        pos = row.position_seconds if row else 0
-        
-        if row:
-            print(f"found pos: {pos}")
-        else:
-            print("no pos found")
+        # buffered heartbeats are newer than what's in the database
+        pos = progress_store.get(user_id, media_id)
+
+        if pos is None:
+            row = MediaProgress.query.filter_by(user_id=user_id, media_id=media_id).first()
+            pos = row.position_seconds if row else 0
+            log.debug("progress loaded user_id=%s media_id=%s position=%s found=%s", user_id, media_id, pos, bool(row))
+
+        if prefetcher:
+            prefetcher.playback_started(media_id) # the player asks for the position when it opens a video
             
         return jsonify({"position": pos})
     
@@ -289,18 +534,195 @@ def progress(media_id):
     except:
         pos = 0.0
 
-    print(f"saving pos: {pos}")
+    log.debug("progress saved user_id=%s media_id=%s position=%s", user_id, media_id, pos)
     
-    row = MediaProgress.query.filter_by(user_id=user_id, media_id=media_id).first()
-    if not row:
-        row = MediaProgress(user_id=user_id, media_id=media_id)
-        db.session.add(row)
+    progress_store.set(user_id, media_id, pos) # written to the database by a background thread
 
-    row.position_seconds = pos
-    db.session.commit()
+    if prefetcher:
+        prefetch_next(media_id, pos)
 
     return "", 204 # no content
 
+def prefetch_next(media_id, pos):
+    # warm the video after this one once the viewer nears the end, see prefetch.py
+    duration = prefetcher.get_duration(media_id, load_duration)
+    if not prefetcher.near_end(media_id, pos, duration):
+        return
+
+    media = db.session.get(Media, media_id)
+    next_media = get_next_video(media) if media else None
+    if next_media:
+        tracks = SubtitleTrack.query.filter_by(media_id=next_media.media_id) if next_media.has_embedded_subtitles else []
+        prefetcher.submit(next_media.media_id, next_media.subpath, [track.filename for track in tracks])
+
+def load_duration(media_id):
+    return db.session.scalar(db.select(Media.duration).where(Media.media_id == media_id))
+
+
+def get_book(media_id):
+    media = db.session.get(Media, media_id)
+    if not media or not media.is_book or not media.present:
+        abort(404)
+
+    try:
+        return media, load_book(MEDIA_DIR, media.subpath)
+    except FileNotFoundError:
+        abort(404)
+    except ValueError:
+        abort(422) # not a valid epub
+
+@app.route('/api/books/<int:media_id>')
+# title, spine and table of contents of a book, hrefs are relative to base_url
+def book_manifest(media_id):
+    media, book = get_book(media_id)
+
+    response = jsonify({"title": book["title"] or os.path.splitext(media.filename)[0],
+                        "version": book["version"],
+                        "base_url": url_for("book_resource", media_id=media_id, version=book["version"], name=""),
+                        "spine": book["spine"],
+                        "toc": book["toc"]})
+    response.set_etag(book["version"])
+    response.cache_control.no_cache = True # revalidate, the version changes when the file does
+    return response.make_conditional(request)
+
+@app.route('/books/<int:media_id>/<version>/<path:name>')
+# one chapter, image or stylesheet of a book, read from its offset in the .epub
+def book_resource(media_id, version, name):
+    media, book = get_book(media_id)
+
+    if version != book["version"]: # the book was replaced since the reader loaded it
+        return redirect(url_for("book_resource", media_id=media_id, version=book["version"], name=name))
+
+    entry = book["entries"].get(name)
+    if not entry:
+        abort(404)
+
+    etag = f"{version}-{entry['crc']:08x}"
+    headers = {
+        "ETag": f'"{etag}"',
+        "Cache-Control": f"public, max-age={BOOK_CACHE_MAX_AGE}, immutable",
+        "Content-Security-Policy": "script-src 'none'", # the reader doesn't run scripts from books
+        "Content-Length": str(entry["size"]),
+    }
+
+    if request.if_none_match.contains(etag):
+        return Response(status=304, headers=headers)
+
+    return Response(iter_member(os.path.join(MEDIA_DIR, media.subpath), name, entry), 
+                    headers=headers, 
+                    mimetype=get_media_type(name, entry), 
+                    direct_passthrough=True)
+
+def get_stream(media_id):
+    media = db.session.get(Media, media_id)
+    if not media or not media.present or not needs_hls(media):
+        abort(404)
+
+    ffmpeg = get_ffmpeg()
+    if not ffmpeg:
+        abort(404)
+
+    try:
+        version = get_version(MEDIA_DIR, media.subpath)
+    except FileNotFoundError:
+        abort(404)
+
+    source = {"path": os.path.join(MEDIA_DIR, media.subpath), "video_codec": media.video_codec, "audio_codec": media.audio_codec}
+    segments, source["copy_video"] = plan_segments(get_ffprobe(ffmpeg), source, version, media.duration)
+    return ffmpeg, version, source, segments
+
+@app.route('/hls/<int:media_id>/index.m3u8')
+# HLS playlist of a video browsers can't play directly, segments are made when they're requested
+def hls_playlist(media_id):
+    _, version, _, segments = get_stream(media_id)
+
+    playlist = build_playlist(segments, 
+                              lambda index: url_for("hls_segment", media_id=media_id, version=version, index=index))
+    response = Response(playlist, mimetype="application/vnd.apple.mpegurl")
+    response.cache_control.no_cache = True # the version changes when the file does
+    return response
+
+@app.route('/hls/<int:media_id>/<version>/<int:index>.ts')
+def hls_segment(media_id, version, index):
+    ffmpeg, current_version, source, segments = get_stream(media_id)
+
+    if version != current_version: # the file was replaced since the player loaded the playlist
+        return redirect(url_for("hls_segment", media_id=media_id, version=current_version, index=index))
+    if index >= len(segments):
+        abort(404)
+
+    try:
+        path = segment_generator.get(ffmpeg, source, version, index, segments)
+    except TimeoutError:
+        return Response(status=503, headers={"Retry-After": "5"})
+    except SegmentError:
+        abort(500)
+
+    response = send_file(path, mimetype="video/mp2t", conditional=True, etag=f"{version}-{index}", max_age=HLS_SEGMENT_MAX_AGE)
+    response.cache_control.immutable = True
+    return response
+
+@app.route("/book_progress/<int:media_id>", methods=["GET", "POST"])
+# reading position in a book, like /progress for videos
+@login_required
+def book_progress(media_id):
+    user_id = session.get("user_id")
+
+    if request.method == "GET":
+        row = db.session.get(BookProgress, (user_id, media_id))
+        return jsonify({"location": row.location if row else None})
+
+    # POST
+    location = str((request.json or {}).get("location", ""))[:512]
+    if not location or not db.session.get(Media, media_id):
+        abort(400)
+
+    db.session.merge(BookProgress(user_id=user_id, media_id=media_id, location=location, updated_at=time.time()))
+    db.session.commit()
+    return "", 204
+
+
+@app.route('/api/watched', methods=['POST'])
+# mark many media as watched or unwatched at once: {"media_ids": [...], "watched": true}
+@login_required
+def bulk_watched():
+    data = request.json or {}
+    try:
+        media_ids = [int(media_id) for media_id in data["media_ids"]]
+    except (KeyError, TypeError, ValueError):
+        abort(400)
+
+    if event_log:
+        event_log.set_watched(session.get("user_id"), get_known_media_ids(media_ids), bool(data.get("watched", True)))
+    else:
+        set_watched(session.get("user_id"), media_ids, bool(data.get("watched", True)))
+        db.session.commit()
+
+    return "", 204
+
+@app.route('/api/state')
+# watched flags and positions for every item in a folder, so listings can show progress in one request
+@login_required
+def folder_state():
+    folder = request.args.get('folder', '').strip("/")
+    if not Folder.query.filter_by(subpath=folder).first():
+        abort(404)
+
+    user_id = session.get("user_id")
+    watched, positions = get_folder_state(user_id, folder)
+    positions.update(progress_store.get_many(user_id, watched)) # not written to the database yet
+    if event_log:
+        watched.update((media_id, is_watched) for media_id, is_watched in event_log.get_watched(user_id).items() 
+                       if media_id in watched)
+
+    response = jsonify({"folder": folder, 
+                        "media": {media_id: {"watched": is_watched, "position": positions.get(media_id)} 
+                                  for media_id, is_watched in watched.items()}})
+    response.add_etag() # hash of the body, clients send it back to skip unchanged state
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
 
 @app.route('/upload', methods=['GET', 'POST'])
 @admin_required
@@ -330,13 +752,115 @@ def upload():
         return render_template('upload.html', msg = f"Error: File '{filename}' already exists.", **kwargs)
 
     file.save(os.path.join(MEDIA_DIR, filename))
+    scan_folder(MEDIA_DIR, "", os.stat(MEDIA_DIR).st_mtime) # add the new file to the library index
     return render_template('upload.html', msg =  f"File {filename} uploaded successfully.", **kwargs)
+
+
+# resumable chunked uploads (see uploads.py), used by upload.html:
+# POST /api/uploads to start, PUT chunks at their offset, then POST .../finalize
+
+@app.errorhandler(UploadError)
+def upload_error(e):
+    return jsonify({"error": str(e), **e.extra}), e.status
+
+@app.route('/api/uploads', methods=['POST'])
+@admin_required
+def start_upload():
+    data = request.json or {}
+    filename = clean_filename(str(data.get("filename", "")))
+    folder = str(data.get("folder", "")).strip("/")
+
+    try:
+        size = int(data["size"])
+    except (KeyError, TypeError, ValueError):
+        raise UploadError("Missing file size")
+
+    if not filename or not allowed_file(filename, allowed_extensions = ALLOWED_EXT):
+        raise UploadError("Invalid file type")
+
+    if not Folder.query.filter_by(subpath=folder).first():
+        raise UploadError("Unknown folder", 404)
+
+    upload = create_upload(MEDIA_DIR, folder, filename, size)
+    return jsonify({"upload_id": upload["upload_id"], "offset": 0}), 201
+
+@app.route('/api/uploads/<upload_id>', methods=['GET', 'PUT', 'DELETE'])
+@admin_required
+def upload_chunk(upload_id):
+    upload = load_upload(upload_id)
+
+    if request.method == 'GET':
+        # where to resume after a disconnect
+        return jsonify({"offset": get_offset(upload), "size": upload["size"]})
+
+    if request.method == 'DELETE':
+        discard_upload(upload)
+        return "", 204
+
+    # PUT
+    offset = request.args.get("offset", type=int)
+    if offset is None:
+        raise UploadError("Missing offset")
+
+    offset = write_chunk(upload, offset, request.stream)
+    return jsonify({"offset": offset, "size": upload["size"]})
+
+@app.route('/api/uploads/<upload_id>/finalize', methods=['POST'])
+@admin_required
+def finish_upload(upload_id):
+    upload = load_upload(upload_id)
+    data = request.get_json(silent=True) or {} # the body is optional
+
+    finalize_upload(upload, sha256 = data.get("sha256"))
+
+    # register the new file in the library index right away
+    folder_path = os.path.join(MEDIA_DIR, upload["folder"])
+    scan_folder(MEDIA_DIR, upload["folder"], os.stat(folder_path).st_mtime)
+
+    return jsonify({"message": f"File {upload['filename']} uploaded successfully.", "filename": upload["filename"]})
     
    
+@app.route('/subtitles/<name>')
+# .srt subtitles converted to .vtt (see subtitles.py) and subtitles extracted from videos (see embedded_subtitles.py)
+def subtitle_file(name):
+    return send_from_directory(os.path.abspath(SUBTITLE_CACHE_DIR), name, mimetype="text/vtt")
+
+
+@app.route('/posters/<name>')
+# poster frames grabbed from videos (see metadata.py)
+def poster_file(name):
+    return send_from_directory(os.path.abspath(METADATA_CACHE_DIR), name, mimetype="image/jpeg", max_age=MEDIA_CACHE_MAX_AGE)
+
+
+@app.route('/metrics')
+# prometheus metrics, added up across gunicorn workers (see metrics.py)
+def metrics_endpoint():
+    if METRICS_TOKEN:
+        if not hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {METRICS_TOKEN}"):
+            abort(401)
+    elif not user_is_admin():
+        abort(403)
+
+    return Response(metrics.render(metrics.collect(METRICS_DIR)), mimetype="text/plain; version=0.0.4")
+
+
 @app.route('/media/<path:subpath>') 
 # not used when running with Docker (/media/ gets served by nginx)
 def media(subpath):
-    return send_from_directory(MEDIA_DIR, subpath)
+    return send_media(MEDIA_DIR, subpath)
+
+
+@app.cli.command("reconcile")
+@click.option("--dry-run", is_flag=True, help="Only report moved files and orphans, as of the last library scan, without changing anything.")
+@click.option("--grace", type=float, default=RECONCILE_ORPHAN_GRACE / 86400, show_default=True,
+              help="Days a file has to be gone before its row is purged.")
+# full rescan of MEDIA_DIR, carrying over watched flags and progress of moved files
+# and purging rows of removed files: flask --app app reconcile
+def reconcile_command(dry_run, grace):
+    with scan_lock(os.path.join(app.instance_path, "library-scan.lock")):
+        counts = reconcile(MEDIA_DIR, grace * 86400, dry_run = dry_run, event_log = event_log)
+    click.echo(f"{'to fingerprint' if dry_run else 'fingerprinted'}: {counts['hashed']}, moved: {counts['moves']}, "
+               f"{'orphans' if dry_run else 'purged'}: {counts['orphans']}")
 
 
 if __name__ == '__main__':
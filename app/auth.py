@@ -0,0 +1,137 @@
+# auth.py
+# password hashing, login rate limiting and the login state kept in the session
+#
+# password hashes are slow on purpose, so they run on a small thread pool per worker process:
+# a burst of logins waits its turn there (or gets turned away once the queue is full) instead
+# of occupying every request thread, and hashlib releases the GIL while hashing so the other
+# threads keep streaming
+
+import os
+import time
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import session
+from werkzeug.security import generate_password_hash, check_password_hash
+
+import metrics
+
+hash_seconds = metrics.histogram("auth_password_hash_seconds", "Time logins and signups wait for a password hash, including the queue")
+logins_rejected = metrics.counter("auth_logins_rejected_total", "Login and signup attempts turned away before hashing", ("reason",))
+
+class HasherBusy(Exception):
+    pass
+
+class PasswordHasher:
+    def __init__(self, method, workers, queue_size):
+        self.method = method # werkzeug method string, e.g. "scrypt:32768:8:1" or "pbkdf2:sha256:600000"
+        self.workers = workers
+        self.queue_size = queue_size # hashes that may wait for a thread
+        self.prefix = None # method and parameters as they appear in generated hashes
+        self.reset()
+
+    def reset(self):
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="password-hash")
+        self.slots = threading.BoundedSemaphore(self.workers + self.queue_size)
+
+    def run(self, fn, *args):
+        # raises HasherBusy when all threads are busy and the queue is full
+        if not self.slots.acquire(blocking=False):
+            raise HasherBusy()
+        try:
+            future = self.executor.submit(fn, *args)
+        except BaseException:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda _: self.slots.release())
+
+        with hash_seconds.time():
+            return future.result()
+
+    def hash(self, password):
+        return self.run(generate_password_hash, password, self.method)
+
+    def check(self, password_hash, password):
+        return self.run(check_password_hash, password_hash, password)
+
+    def needs_rehash(self, password_hash):
+        # hashes made with another method or work factor are replaced on the next login
+        if self.prefix is None:
+            self.prefix = generate_password_hash("", self.method).split("$", 1)[0]
+        return password_hash.split("$", 1)[0] != self.prefix
+
+class RateLimiter:
+    # token bucket per key (ip or username): up to burst attempts at once,
+    # refilled at per_minute attempts per minute
+    # per worker process, so the effective limit is this times the number of workers
+
+    def __init__(self, per_minute, burst, max_keys = 10000):
+        self.rate = per_minute / 60
+        self.burst = burst
+        self.max_keys = max_keys
+        self.buckets = {} # key -> (tokens, time)
+        self.lock = threading.Lock()
+
+    def tokens(self, key, now):
+        tokens, last = self.buckets.get(key, (self.burst, now))
+        return min(self.burst, tokens + (now - last) * self.rate)
+
+    def retry_after(self, key):
+        # seconds until key has an attempt left, 0 if it has one now
+        with self.lock:
+            tokens = self.tokens(key, time.monotonic())
+        return 0 if tokens >= 1 else (1 - tokens) / self.rate
+
+    def take(self, key):
+        # uses up an attempt, returns the seconds to wait instead if there is none left
+        now = time.monotonic()
+        with self.lock:
+            tokens = self.tokens(key, now)
+            if tokens < 1:
+                return (1 - tokens) / self.rate
+
+            self.buckets[key] = (tokens - 1, now)
+            if len(self.buckets) > self.max_keys:
+                self.prune(now)
+        return 0
+
+    def prune(self, now):
+        # forget keys whose bucket has filled up again
+        full = self.burst / self.rate
+        self.buckets = {key: value for key, value in self.buckets.items() if now - value[1] < full}
+
+# login state cached in the session cookie (signed, so it can't be edited by the client),
+# trusted for AUTH_SESSION_TTL seconds before it's checked against the database again
+
+SessionUser = namedtuple("SessionUser", ["user_id", "username", "is_admin"])
+
+def remember_login(user):
+    session["user_id"] = user.user_id
+    session["auth"] = {"username": user.username, "is_admin": user.is_admin, "checked": time.time()}
+
+def forget_login():
+    session.pop("user_id", None)
+    session.pop("auth", None)
+
+def get_session_user(ttl):
+    # None if nobody is logged in or the cached state is older than ttl
+    user_id = session.get("user_id")
+    auth = session.get("auth")
+    if not user_id or not auth or time.time() - auth.get("checked", 0) >= ttl:
+        return None
+    return SessionUser(user_id, auth["username"], auth["is_admin"])
+
+hashers = [] # reset in forked workers, the parent's threads don't survive the fork
+
+def create_hasher(method, workers, queue_size):
+    hasher = PasswordHasher(method, workers, queue_size)
+    hashers.append(hasher)
+    return hasher
+
+def reset_after_fork():
+    for hasher in hashers:
+        hasher.reset()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=reset_after_fork)
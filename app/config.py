@@ -1,10 +1,82 @@
 LOG_LOGIN_ATTEMPTS = True
 
+# password hashes are computed on a small thread pool per worker process, see auth.py
+PASSWORD_HASH_METHOD = "scrypt:32768:8:1" # werkzeug method and work factor, existing hashes are redone on the next login
+PASSWORD_HASH_WORKERS = 1 # threads per worker process
+PASSWORD_HASH_QUEUE = 16 # logins that may wait for a thread, further ones get a 503
+LOGIN_ATTEMPTS_PER_MINUTE = 5 # per ip, and failed ones per username (token bucket, per worker process)
+LOGIN_ATTEMPTS_BURST = 10
+AUTH_SESSION_TTL = 300 # seconds the login state cached in the session is trusted before checking the database, 0 to always check
+
 VIDEO_EXT = {".mp4", ".mkv"}
 BOOK_EXT = {".epub"}
 SUBTITLE_EXT = {".srt", ".vtt"}
 ALLOWED_EXT = VIDEO_EXT | BOOK_EXT | SUBTITLE_EXT # for file uploading via /upload
 
+LIBRARY_SCAN_INTERVAL = 60 # seconds between incremental rescans of the media folder
+RECONCILE_INTERVAL = 6 * 3600 # seconds between full rescans that carry over data of moved files, see reconcile.py
+RECONCILE_ORPHAN_GRACE = 7 * 24 * 3600 # seconds a file has to be gone before its watched flags and progress are deleted
+
+SUBTITLE_CACHE_DIR = "instance/subtitle-cache" # .srt subtitles converted to .vtt
+SUBTITLE_WORKERS = 2 # background threads converting subtitles
+ENCODING_WORKERS = 2 # processes detecting subtitle encodings during library scans
+
+METADATA_CACHE_DIR = "instance/metadata-cache" # video metadata and poster frames, per file version
+METADATA_WORKERS = 2 # processes reading video headers (and running ffmpeg) after library scans
+METADATA_BATCH_SIZE = 50 # videos handed to the pool and committed at a time
+POSTER_WIDTH = 320 # pixels
+
+BOOK_CACHE_DIR = "instance/book-cache" # parsed .epub manifests, per file version
+BOOK_CACHE_MAX_AGE = 365 * 24 * 3600 # seconds, book resource urls include the file version
+
+# videos browsers can't play are streamed as HLS, cut into segments with ffmpeg (see streaming.py)
+HLS_CACHE_DIR = "instance/hls-cache" # segments, shared by all workers
+HLS_CACHE_MAX_BYTES = 20 * 1024**3 # least recently served segments are removed beyond this
+HLS_SEGMENT_SECONDS = 6
+HLS_SEGMENTS_AHEAD = 3 # segments generated after the one being played
+HLS_WORKERS = 1 # ffmpeg processes per worker process
+HLS_SEGMENT_TIMEOUT = 60 # seconds
+HLS_TRANSCODE_PRESET = "veryfast" # x264 preset for videos that aren't h264
+HLS_TRANSCODE_CRF = 23
+HLS_SEGMENT_MAX_AGE = 365 * 24 * 3600 # seconds, segment urls include the file version
+HLS_JS_URL = "https://cdn.jsdelivr.net/npm/hls.js@1/dist/hls.min.js" # for browsers without native HLS
+
+# warming the next video in a folder while one is ending, see prefetch.py
+PREFETCH_DIR = "instance/prefetch" # I/O budget and markers of warmed videos, shared by all workers
+PREFETCH_LEAD_SECONDS = 120 # how long before the end of a video the next one is warmed
+PREFETCH_HEAD_BYTES = 64 * 1024**2
+PREFETCH_TAIL_BYTES = 4 * 1024**2 # mp4 moov / mkv cues, read by browsers before playing
+PREFETCH_BUDGET_PER_MINUTE = 256 * 1024**2 # bytes warmed per minute by all workers together
+PREFETCH_BUDGET_BURST = 512 * 1024**2
+PREFETCH_WINDOW = 3600 # seconds a warmed video isn't warmed again, and counts as a hit when played
+
+PROGRESS_FLUSH_INTERVAL = 10 # seconds between batched writes of video progress to the database
+
+# where progress heartbeats and watched changes go:
+# "buffer" - batched writes to the database (progress_buffer.py), buffered heartbeats are only
+#            seen by the worker process that received them, others read the database (up to
+#            PROGRESS_FLUSH_INTERVAL seconds old)
+# "log"    - append-only event log, folded into the database periodically (event_log.py),
+#            read by all worker processes
+# "auto"   - "log" when gunicorn runs several worker processes (see WSGI_WORKERS), "buffer" otherwise
+PROGRESS_STORE = "buffer"
+EVENT_LOG_DIR = "instance/event-log"
+EVENT_LOG_GROUP_COMMIT = 0 # extra seconds to wait for appends to share a write + fsync, 0 = batch whatever queued up during the last one
+EVENT_LOG_COMPACT_INTERVAL = 300 # seconds between compactions into the database
+
+SEARCH_PAGE_SIZE = 50 # results per page for /search and /api/search
+LISTING_PAGE_SIZE = 200 # media per page for folder listings, further pages are loaded while scrolling
+LISTING_CACHE_SIZE = 256 # rendered folder pages kept in memory per worker process, see listing_cache.py
+LISTING_CACHE_DIR = "instance/listing-cache" # rendered folder pages shared by all workers, None to only cache in memory
+LISTING_CACHE_DISK_ENTRIES = 5000 # pages kept in LISTING_CACHE_DIR
+
+UPLOAD_STATE_DIR = "instance/uploads" # bookkeeping for resumable uploads in progress
+UPLOAD_BUFFER_SIZE = 1024 * 1024 # bytes read from the request at a time
+UPLOAD_EXPIRE_AGE = 7 * 24 * 3600 # seconds without a new chunk before an unfinished upload is discarded
+
+METRICS_DIR = "instance/metrics" # per-worker snapshots, added up by /metrics
+METRICS_WRITE_INTERVAL = 5 # seconds between snapshots
+
 INFO_POPUP_TEXT = (
     "Log in to mark content as watched and filter by unwatched content. <br>"
     "Source code available "
@@ -20,10 +92,36 @@ load_dotenv()
 
 IP = os.getenv("TAILSCALE_IP", "127.0.0.1")
 
+# reverse proxies in front of the app, client ips (for login rate limits) are taken from the
+# X-Forwarded-For entries they add, 0 = connected directly (Docker: tailscale serve + nginx = 2)
+TRUSTED_PROXIES = int(os.getenv("TRUSTED_PROXIES", 0))
+
 # used when running app.py directly
 DEV_PORT = 8080
 
 # used when running wsgi_launcher.py
-WSGI_PORT = 8000
+WSGI_PORT = int(os.getenv("WSGI_PORT", 8000))
 ACCESS_LOGFILE = os.getenv("ACCESS_LOGFILE", "-")
-ERROR_LOGFILE = os.getenv("ERROR_LOGFILE", "-")
\ No newline at end of file
+ERROR_LOGFILE = os.getenv("ERROR_LOGFILE", "-")
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO") # DEBUG also logs progress heartbeats and subtitle lookups
+
+# bearer token prometheus sends to /metrics, without one only admins can see it
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+
+# how /media/ is served when it doesn't go through the Docker nginx (see media_delivery.py):
+# "direct" (Range + sendfile), "accel" (X-Accel-Redirect to a fronting nginx) or "flask"
+MEDIA_DELIVERY = os.getenv("MEDIA_DELIVERY", "direct")
+MEDIA_ACCEL_PREFIX = os.getenv("MEDIA_ACCEL_PREFIX", "/internal-media/") # internal nginx location
+MEDIA_CACHE_MAX_AGE = 3600 # seconds browsers may reuse media without revalidating
+
+# poster frames are generated with ffmpeg when it is installed
+FFMPEG_PATH = os.getenv("FFMPEG_PATH", "ffmpeg")
+GENERATE_POSTERS = os.getenv("GENERATE_POSTERS", "true") == "true"
+HLS_ENABLED = os.getenv("HLS_ENABLED", "true") == "true" # stream videos browsers can't play, see streaming.py
+PREFETCH_ENABLED = os.getenv("PREFETCH_ENABLED", "true") == "true" # warm the next episode, worth it on spinning disks
+
+WSGI_WORKER_CLASS = os.getenv("WSGI_WORKER_CLASS", "gthread") # sync, gthread or gevent
+WSGI_WORKERS = int(os.getenv("WSGI_WORKERS", 0)) # 0 = based on cpu count, set to the actual count by wsgi_launcher.py
+WSGI_THREADS = int(os.getenv("WSGI_THREADS", 0)) # per worker, 0 = based on worker class
+WSGI_TIMEOUT = int(os.getenv("WSGI_TIMEOUT", 120))
+WSGI_PRELOAD = os.getenv("WSGI_PRELOAD", "true") == "true" # set up database and library index once, before forking
@@ -1,8 +1,61 @@
 import re
 import os
-from chardet import detect
-
-def is_srt(srt_file, verbose = False):
+import codecs
+from chardet import UniversalDetector
+
+# compiled once instead of on every line
+INDEX_RE = re.compile(r"^\d+$")
+TIMESTAMP_RE = re.compile(r"\d{2}:\d{2}:\d{2},\d{3} --> \d{2}:\d{2}:\d{2},\d{3}")
+
+ENCODING_PREFIX_BYTES = 64 * 1024 # how much of a file is used to detect its encoding
+
+BOMS = [ # longest first, utf-32 LE starts with the utf-16 LE bom
+    (codecs.BOM_UTF32_LE, "utf-32"),
+    (codecs.BOM_UTF32_BE, "utf-32"),
+    (codecs.BOM_UTF8, "utf-8-sig"),
+    (codecs.BOM_UTF16_LE, "utf-16"),
+    (codecs.BOM_UTF16_BE, "utf-16"),
+]
+
+def iter_vtt(lines):
+    # converts srt lines to vtt in a single pass, yielding one chunk of output per cue
+    # raises ValueError at the end if no valid srt cue (index line + timestamp line) was found
+    yield "WEBVTT\n\n"
+
+    cue = []
+    pending_index = None # digit-only line, dropped if the next line is a timestamp
+    valid = False
+
+    for line in lines:
+        line = line.strip()
+
+        if TIMESTAMP_RE.match(line):
+            if pending_index is not None:
+                valid = True
+            pending_index = None
+
+            if cue:
+                yield "\n".join(cue) + "\n\n"
+            cue = [line.replace(",", ".")]
+            continue
+
+        if pending_index is not None:
+            # digits were subtitle text after all
+            cue.append(pending_index)
+            pending_index = None
+
+        if INDEX_RE.match(line):
+            pending_index = line
+        elif line and cue:
+            cue.append(line)
+
+    if cue:
+        yield "\n".join(cue) + "\n\n"
+
+    if not valid:
+        raise ValueError("no valid srt cues found")
+
+def is_srt_path(srt_file, verbose = False):
     if not os.path.isfile(srt_file):
         if verbose:
             print(f"'{srt_file}' does not exist")
@@ -13,61 +66,85 @@ def is_srt(srt_file, verbose = False):
             print(f"'{srt_file}' is not a .srt file")
         return False
 
-    with open(srt_file, 'r', encoding='utf-8') as file:
-        content = file.read()
-
-    if not re.search(r"\d+\n\d{2}:\d{2}:\d{2},\d{3} --> \d{2}:\d{2}:\d{2},\d{3}", content):
-        if verbose:
-            print(f"'{srt_file}' does not have a valid srt format")
-        return False
-
     return True
 
+def is_srt(srt_file, verbose = False, encoding = None):
+    if not is_srt_path(srt_file, verbose):
+        return False
 
-def srt_to_vtt(srt_file, vtt_file, verbose = True):
-    if not is_srt(srt_file):
-        return
+    encoding = encoding or get_encoding_type(srt_file)
 
-    try:
-        with open(srt_file, 'r', encoding='utf-8') as srt:
-            lines = srt.readlines()
+    # only reads up to the first cue
+    with open(srt_file, 'r', encoding=encoding, errors='replace') as file:
+        previous = None
+        for line in file:
+            line = line.strip()
+            if previous is not None and INDEX_RE.match(previous) and TIMESTAMP_RE.match(line):
+                return True
+            previous = line
 
-        with open(vtt_file, 'w', encoding='utf-8') as vtt:
-            # add required WebVTT header
-            vtt.write("WEBVTT\n\n")
+    if verbose:
+        print(f"'{srt_file}' does not have a valid srt format")
+    return False
 
-            buffer = []
-            for line in lines:
-                line = line.strip()
 
-                # skip srt block numbers
-                if re.match(r"^\d+$", line):
-                    continue
+def srt_to_vtt(srt_file, vtt_file, verbose = True, encoding = None):
+    # vtt_file can be a path or a writable text buffer (e.g. io.StringIO)
+    # returns True if the conversion succeeded
+    if not is_srt_path(srt_file, verbose):
+        return False
 
-                # convert srt timestamps to vtt format
-                if re.match(r"\d{2}:\d{2}:\d{2},\d{3} --> \d{2}:\d{2}:\d{2},\d{3}", line):
-                    line = line.replace(",", ".")
+    encoding = encoding or get_encoding_type(srt_file) # detected once, for is_srt too
+    if not encoding:
+        if verbose:
+            print(f"unable to detect the encoding of '{srt_file}'")
+        return False
 
-                    if buffer:
-                        vtt.write("\n".join(buffer) + "\n\n")
-                        buffer = []
+    # checked before any output is written
+    if not is_srt(srt_file, verbose = verbose, encoding = encoding):
+        return False
 
-                buffer.append(line)
+    writes_path = not hasattr(vtt_file, "write")
 
-            if buffer:
-                vtt.write("\n".join(buffer) + "\n\n")
+    try:
+        with open(srt_file, 'r', encoding=encoding, errors='replace') as srt:
+            if writes_path:
+                with open(vtt_file, 'w', encoding='utf-8') as vtt:
+                    vtt.writelines(iter_vtt(srt))
+            else:
+                vtt_file.writelines(iter_vtt(srt))
 
         if verbose:
             print(f"conversion successful: {srt_file} -> {vtt_file}")
+        return True
 
     except Exception as e:
+        if writes_path and os.path.exists(vtt_file):
+            os.remove(vtt_file) # don't leave a partial file behind
         if verbose:
             print(f"error during conversion: {e}")
+        return False
 
 def get_encoding_type(file):
+    # detect the encoding from the start of the file only, files are decoded with errors='replace'
+    # in case the rest doesn't match: byte order mark, then utf-8 (this also covers ascii), then chardet
     with open(file, 'rb') as f:
-        rawdata = f.read()
-    return detect(rawdata)['encoding']
+        prefix = f.read(ENCODING_PREFIX_BYTES)
+
+    for bom, encoding in BOMS:
+        if prefix.startswith(bom):
+            return encoding
+
+    try:
+        codecs.getincrementaldecoder('utf-8')().decode(prefix) # not final, the prefix may end mid-character
+        return 'utf-8'
+    except UnicodeDecodeError:
+        pass
+
+    detector = UniversalDetector()
+    detector.feed(prefix)
+    detector.close()
+    return detector.result['encoding']
 
 def to_utf_8(srcfile, verbose = True):
 
@@ -1,12 +1,25 @@
 # database.py
 
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, inspect, text, func, or_, and_, exists
+from sqlalchemy.dialects.sqlite import insert
 import os
+import json
+import base64
 
 from config import VIDEO_EXT, BOOK_EXT
 
 db = SQLAlchemy() 
 
+# applied to every new sqlite connection, see tune_sqlite()
+SQLITE_PRAGMAS = [
+    "journal_mode=WAL", # readers don't block behind writers (and vice versa)
+    "synchronous=NORMAL", # safe with WAL, fsync only at checkpoints
+    "busy_timeout=5000", # wait for locks instead of failing right away
+    "cache_size=-65536", # 64 MB page cache
+    "mmap_size=268435456", # 256 MB memory-mapped reads
+]
+
 user_watched = db.Table(
     'user_watched',
     db.Column('user_id', db.Integer, db.ForeignKey('user.user_id'), primary_key=True),
@@ -19,6 +32,7 @@ class User(db.Model):
     username = db.Column(db.String(100), unique=True, nullable=False)
     password_hash = db.Column(db.String(200), nullable=False)
     is_admin = db.Column(db.Boolean, default=False)
+    watched_version = db.Column(db.Integer, default=0, server_default="0", nullable=False) # bumped by a trigger, see listing_cache.py
 
     watched_media = db.relationship( # media marked as watched, for search filtering
         'Media',
@@ -34,6 +48,28 @@ class Media(db.Model):
     is_video = db.Column(db.Boolean, default=False, nullable=False)
     is_book = db.Column(db.Boolean, default=False, nullable=False)
     has_subtitles = db.Column(db.Boolean, default=False, nullable=False)
+
+    # filled in by the library scanner (library.py)
+    folder = db.Column(db.String(255)) # subpath of containing folder, "" for MEDIA_DIR (indexed below, see MIGRATION_INDEXES)
+    present = db.Column(db.Boolean, default=True, nullable=False) # False once the file is gone from disk
+    size = db.Column(db.Integer)
+    mtime = db.Column(db.Float)
+
+    # read from the container headers of videos (metadata.py), None until then
+    duration = db.Column(db.Float) # seconds
+    width = db.Column(db.Integer)
+    height = db.Column(db.Integer)
+    video_codec = db.Column(db.String(20))
+    audio_codec = db.Column(db.String(20))
+    playable = db.Column(db.Boolean) # browsers can play it, better than going by the extension
+    poster = db.Column(db.String(64)) # filename in METADATA_CACHE_DIR
+    metadata_mtime = db.Column(db.Float) # mtime of the file when the metadata was read
+    metadata_version = db.Column(db.Integer) # METADATA_VERSION it was read with
+    has_embedded_subtitles = db.Column(db.Boolean, default=False, nullable=False) # text subtitle tracks, see SubtitleTrack
+
+    # used by reconcile.py to recognize moved files and clean up removed ones
+    partial_hash = db.Column(db.String(40)) # of the size, first and last block
+    missing_since = db.Column(db.Float) # unix time the scanner noticed the file was gone
     
     viewers = db.relationship( # people who have marked piece of media as watched (for search filtering)
         'User',
@@ -46,7 +82,7 @@ class Media(db.Model):
             return False
         
         basename = os.path.splitext(self.filename)[0]
-        return any(basename == stb for stb in subtitle_basenames) # matching subtitle file exists
+        return basename in subtitle_basenames or bool(self.has_embedded_subtitles) # matching subtitle file exists
 
 class MediaProgress(db.Model):
     # for returning users to where they left off if they revisit a video
@@ -54,9 +90,127 @@ class MediaProgress(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey("user.user_id"), primary_key=True)
     media_id = db.Column(db.Integer, db.ForeignKey("media.media_id"), primary_key=True)
     position_seconds = db.Column(db.Float, nullable=False, default=0)
+    updated_at = db.Column(db.Float) # unix time of the heartbeat, so buffered writes can't go back in time
 
     user = db.relationship("User")
     media = db.relationship("Media")
+
+class BookProgress(db.Model):
+    # where a user left off in a book, see reader.html
+    __tablename__ = "book_progress"
+    user_id = db.Column(db.Integer, db.ForeignKey("user.user_id"), primary_key=True)
+    media_id = db.Column(db.Integer, db.ForeignKey("media.media_id"), primary_key=True)
+    location = db.Column(db.String(512), nullable=False) # opaque to the server
+    updated_at = db.Column(db.Float)
+
+class SubtitleFile(db.Model):
+    # sidecar .srt files seen by the library scanner, so their encoding is only detected once
+    __tablename__ = "subtitle_file"
+    subtitle_id = db.Column(db.Integer, primary_key=True)
+    subpath = db.Column(db.String(255), unique=True, nullable=False)
+    folder = db.Column(db.String(255), index=True, nullable=False)
+    size = db.Column(db.Integer)
+    mtime = db.Column(db.Float)
+    encoding = db.Column(db.String(50)) # None if it couldn't be detected
+
+class SubtitleTrack(db.Model):
+    # text subtitles inside a video file, extracted to SUBTITLE_CACHE_DIR by the metadata scan (embedded_subtitles.py)
+    __tablename__ = "subtitle_track"
+    media_id = db.Column(db.Integer, db.ForeignKey("media.media_id"), primary_key=True)
+    track_number = db.Column(db.Integer, primary_key=True) # as numbered in the container
+    codec = db.Column(db.String(20)) # srt, ass, webvtt or tx3g
+    language = db.Column(db.String(35)) # iso 639-2 or bcp 47, None if unknown
+    name = db.Column(db.String(255))
+    is_default = db.Column(db.Boolean, default=False, nullable=False)
+    is_forced = db.Column(db.Boolean, default=False, nullable=False)
+    filename = db.Column(db.String(64), nullable=False) # .vtt in SUBTITLE_CACHE_DIR
+
+class Folder(db.Model):
+    # directory tree of MEDIA_DIR, kept up to date by the library scanner
+    __tablename__ = "folder"
+    folder_id = db.Column(db.Integer, primary_key=True)
+    subpath = db.Column(db.String(255), unique=True, nullable=False) # "" for MEDIA_DIR itself
+    parent = db.Column(db.String(255), index=True) # None for MEDIA_DIR itself
+    name = db.Column(db.String(255), nullable=False)
+    mtime = db.Column(db.Float) # directory mtime at last scan, None if never scanned
+    version = db.Column(db.Integer, default=0, server_default="0", nullable=False) # bumped by triggers when its listing changes, see listing_cache.py
+
+# columns added after the first release; db.create_all() doesn't alter existing tables
+MIGRATION_COLUMNS = {
+    "media": {
+        "folder": "VARCHAR(255)",
+        "present": "BOOLEAN NOT NULL DEFAULT 1",
+        "size": "INTEGER",
+        "mtime": "FLOAT",
+        "duration": "FLOAT",
+        "width": "INTEGER",
+        "height": "INTEGER",
+        "video_codec": "VARCHAR(20)",
+        "audio_codec": "VARCHAR(20)",
+        "playable": "BOOLEAN",
+        "poster": "VARCHAR(64)",
+        "metadata_mtime": "FLOAT",
+        "metadata_version": "INTEGER",
+        "has_embedded_subtitles": "BOOLEAN NOT NULL DEFAULT 0",
+        "partial_hash": "VARCHAR(40)",
+        "missing_since": "FLOAT",
+    },
+    "media_progress": {
+        "updated_at": "FLOAT",
+    },
+    "folder": {
+        "version": "INTEGER NOT NULL DEFAULT 0",
+    },
+    "user": {
+        "watched_version": "INTEGER NOT NULL DEFAULT 0",
+    },
+}
+
+# indexes for the lookups the app runs; per-user lookups of user_watched and
+# media_progress are already covered by their (user_id, media_id) primary keys
+MIGRATION_INDEXES = {
+    "ix_media_folder_present": "media (folder, present)",
+    "ix_media_folder_filename": "media (folder, filename COLLATE NOCASE, media_id)", # paginated listings
+    "ix_user_watched_media": "user_watched (media_id)",
+    "ix_media_progress_media": "media_progress (media_id)",
+    "ix_media_present_size": "media (present, size, mtime)", # move detection in reconcile.py
+}
+
+# indexes made redundant by the ones above
+MIGRATION_DROPPED_INDEXES = ["ix_media_folder"] # prefix of ix_media_folder_present
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for pragma in SQLITE_PRAGMAS:
+        cursor.execute(f"PRAGMA {pragma}")
+    cursor.close()
+
+def tune_sqlite(engine):
+    # call before the engine opens its first connection
+    if engine.dialect.name == "sqlite":
+        event.listen(engine, "connect", set_sqlite_pragmas)
+
+def migrate():
+    # add missing columns to databases created by older versions
+    inspector = inspect(db.engine)
+
+    for table, columns in MIGRATION_COLUMNS.items():
+        existing = {column["name"] for column in inspector.get_columns(table)}
+
+        for name, ddl in columns.items():
+            if name not in existing:
+                db.session.execute(text(f"ALTER TABLE {table} ADD COLUMN {name} {ddl}"))
+
+    for name, target in MIGRATION_INDEXES.items():
+        db.session.execute(text(f"CREATE INDEX IF NOT EXISTS {name} ON {target}"))
+    for name in MIGRATION_DROPPED_INDEXES:
+        db.session.execute(text(f"DROP INDEX IF EXISTS {name}"))
+
+    # rows created before the scanner existed don't know their folder yet
+    for media in Media.query.filter(Media.folder.is_(None)):
+        media.folder = os.path.dirname(media.subpath)
+
+    db.session.commit()
     
 def create_media_object(filename, subpath, subtitle_basenames):
     is_video = filename.endswith(tuple(VIDEO_EXT))
@@ -65,7 +219,164 @@ def create_media_object(filename, subpath, subtitle_basenames):
     media = Media(filename=filename, 
                   is_video=is_video, 
                   is_book=is_book, 
-                  subpath=subpath)
+                  subpath=subpath,
+                  folder=os.path.dirname(subpath))
 
     media.has_subtitles = media.get_subtitles_bool(subtitle_basenames)
-    return media
\ No newline at end of file
+    return media
+
+# bulk helpers, so listing a folder costs a fixed number of queries instead of one per file
+
+SQLITE_MAX_VARS = 500 # stay well below sqlite's limit on bound parameters per query
+
+def get_media_by_subpaths(subpaths):
+    # existing media objects as {subpath: media}, using chunked IN (...) queries
+    subpaths = list(subpaths)
+    found = {}
+
+    for i in range(0, len(subpaths), SQLITE_MAX_VARS):
+        for media in Media.query.filter(Media.subpath.in_(subpaths[i:i + SQLITE_MAX_VARS])):
+            found[media.subpath] = media
+    return found
+
+def get_folder_media(folder, present_only = False):
+    # all media objects directly inside a folder, in one query
+    query = Media.query.filter_by(folder=folder)
+    if present_only:
+        query = query.filter_by(present=True)
+    return query.all()
+
+def bulk_create_media(folder, filenames, subtitle_basenames, stats = None):
+    # insert rows for new files with a single executemany, query the folder again to use them
+    # files another process indexed in the meantime (e.g. a worker finalizing an upload) are skipped
+    rows = []
+
+    for filename in filenames:
+        media = create_media_object(filename, os.path.join(folder, filename), subtitle_basenames)
+        row = {"filename": media.filename, "subpath": media.subpath, "folder": media.folder,
+               "is_video": media.is_video, "is_book": media.is_book, "has_subtitles": media.has_subtitles}
+        if stats:
+            row["size"] = stats[filename].st_size
+            row["mtime"] = stats[filename].st_mtime
+        rows.append(row)
+
+    if rows:
+        db.session.execute(insert(Media.__table__).on_conflict_do_nothing(index_elements=["subpath"]), rows)
+    return len(rows)
+
+def get_watched_ids(user_id, media_ids = None):
+    # media_ids the user marked as watched, as a set for O(1) membership checks
+    # pass media_ids to only check those (e.g. one page of a listing)
+    query = db.select(user_watched.c.media_id).where(user_watched.c.user_id == user_id)
+    if media_ids is None:
+        return {media_id for (media_id,) in db.session.execute(query)}
+
+    media_ids = list(media_ids)
+    watched = set()
+    for i in range(0, len(media_ids), SQLITE_MAX_VARS):
+        chunk = query.where(user_watched.c.media_id.in_(media_ids[i:i + SQLITE_MAX_VARS]))
+        watched.update(media_id for (media_id,) in db.session.execute(chunk))
+    return watched
+
+def get_known_media_ids(media_ids):
+    # the given media_ids that exist, as a set
+    media_ids = list(media_ids)
+    known = set()
+    for i in range(0, len(media_ids), SQLITE_MAX_VARS):
+        query = db.select(Media.media_id).where(Media.media_id.in_(media_ids[i:i + SQLITE_MAX_VARS]))
+        known.update(media_id for (media_id,) in db.session.execute(query))
+    return known
+
+def set_watched(user_id, media_ids, watched):
+    # mark many media as watched or unwatched, unknown media_ids are skipped
+    # the caller commits, so it all happens in one transaction
+    media_ids = list(media_ids)
+
+    for i in range(0, len(media_ids), SQLITE_MAX_VARS):
+        chunk = media_ids[i:i + SQLITE_MAX_VARS]
+        if watched:
+            known = db.select(Media.media_id, db.literal(user_id)).where(Media.media_id.in_(chunk))
+            db.session.execute(insert(user_watched).from_select(["media_id", "user_id"], known).on_conflict_do_nothing())
+        else:
+            db.session.execute(user_watched.delete().where(user_watched.c.user_id == user_id,
+                                                           user_watched.c.media_id.in_(chunk)))
+
+def get_folder_state(user_id, folder):
+    # watched flags and saved positions for the present media in a folder, as
+    # ({media_id: watched}, {media_id: position_seconds}), using the folder and primary key indexes
+    watched_query = db.select(Media.media_id, user_watched.c.media_id.isnot(None)) \
+                      .outerjoin(user_watched, and_(user_watched.c.media_id == Media.media_id, user_watched.c.user_id == user_id)) \
+                      .where(Media.folder == folder, Media.present)
+    watched = dict(db.session.execute(watched_query).all())
+
+    progress_query = db.select(MediaProgress.media_id, MediaProgress.position_seconds) \
+                       .join(Media, Media.media_id == MediaProgress.media_id) \
+                       .where(MediaProgress.user_id == user_id, Media.folder == folder, Media.present)
+    positions = dict(db.session.execute(progress_query).all())
+
+    return watched, positions
+
+# cursor pagination for folder listings, sorted case-insensitively by filename (media_id breaks ties)
+
+def encode_cursor(media):
+    data = json.dumps([media.filename, media.media_id]).encode("utf-8")
+    return base64.urlsafe_b64encode(data).decode("ascii")
+
+def decode_cursor(cursor):
+    # returns (filename, media_id), raises ValueError for malformed cursors
+    try:
+        filename, media_id = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        return str(filename), int(media_id)
+    except Exception:
+        raise ValueError("invalid cursor")
+
+def playable_filter():
+    # videos browsers can play, going by the extension until the metadata has been read
+    return or_(Media.playable == True, and_(Media.playable.is_(None), func.substr(Media.filename, -4) == ".mp4"))
+
+def get_next_video(media):
+    # the present video after media in its folder, in the order folder listings use
+    filename = Media.filename.collate("NOCASE")
+    return (Media.query.filter_by(folder=media.folder, present=True, is_video=True)
+            .filter(or_(filename > media.filename, and_(filename == media.filename, Media.media_id > media.media_id)))
+            .order_by(filename, Media.media_id)
+            .first())
+
+def json_ids(ids):
+    # ids as a subquery bound to a single parameter, so there is no limit on how many
+    return db.select(func.json_each(json.dumps(list(ids))).table_valued("value").c.value)
+
+def unwatched_filter(user_id, pending_watched = None):
+    # media the user hasn't marked as watched
+    # pending_watched: {media_id: watched} changes that aren't in user_watched yet (event log)
+    pending_watched = pending_watched or {}
+    marked = [media_id for media_id, watched in pending_watched.items() if watched]
+    unmarked = [media_id for media_id, watched in pending_watched.items() if not watched]
+
+    condition = ~exists().where(user_watched.c.user_id == user_id, user_watched.c.media_id == Media.media_id)
+    if unmarked:
+        condition = or_(condition, Media.media_id.in_(json_ids(unmarked)))
+    if marked:
+        condition = and_(condition, Media.media_id.not_in(json_ids(marked)))
+    return condition
+
+def get_folder_page(folder, limit, cursor = None, user_id = None, unwatched = False, mp4_only = False, pending_watched = None):
+    # one page of present media in a folder, returns (media_list, next_cursor or None)
+    # pending_watched: see unwatched_filter()
+    filename = Media.filename.collate("NOCASE")
+    query = Media.query.filter_by(folder=folder, present=True)
+
+    if cursor:
+        after_filename, after_id = decode_cursor(cursor)
+        query = query.filter(or_(filename > after_filename, and_(filename == after_filename, Media.media_id > after_id)))
+    if mp4_only:
+        query = query.filter(playable_filter())
+    if unwatched and user_id:
+        query = query.filter(unwatched_filter(user_id, pending_watched))
+
+    media_list = query.order_by(filename, Media.media_id).limit(limit + 1).all()
+
+    if len(media_list) > limit:
+        media_list = media_list[:limit]
+        return media_list, encode_cursor(media_list[-1])
+    return media_list, None
@@ -0,0 +1,390 @@
+# embedded_subtitles.py
+# text subtitle tracks inside video files (srt, ass/ssa and webvtt in .mkv, tx3g in .mp4),
+# written to SUBTITLE_CACHE_DIR as one .vtt per track
+#
+# runs as part of the metadata scan (see metadata.extract_metadata()), in its process pool: the
+# subtitles are read in a single pass over the file that skips over the video and audio data,
+# and the tracks found are recorded in the database (SubtitleTrack), so /play can list them
+# without opening the file
+
+import os
+import re
+import zlib
+import struct
+import tempfile
+
+import metadata
+from config import SUBTITLE_CACHE_DIR
+
+# matroska codec ids of text subtitles -> codec name as stored in the database
+MKV_TEXT_CODECS = {"S_TEXT/UTF8": "srt", "S_TEXT/ASCII": "srt", "S_TEXT/ASS": "ass", "S_TEXT/SSA": "ass",
+                   "S_TEXT/WEBVTT": "webvtt"}
+MKV_SUBTITLE_TRACK = 0x11
+
+# ebml element ids, see metadata.py for the others
+MKV_TRACK_NUMBER = 0xD7
+MKV_LANGUAGE = 0x22B59C
+MKV_LANGUAGE_IETF = 0x22B59D
+MKV_NAME = 0x536E
+MKV_FLAG_DEFAULT = 0x88
+MKV_FLAG_FORCED = 0x55AA
+MKV_CONTENT_ENCODINGS = 0x6D80
+MKV_CONTENT_ENCODING = 0x6240
+MKV_CONTENT_COMPRESSION = 0x5034
+MKV_CONTENT_COMP_ALGO = 0x4254
+MKV_CONTENT_COMP_SETTINGS = 0x4255
+MKV_CLUSTER_TIMECODE = 0xE7
+MKV_SIMPLE_BLOCK = 0xA3
+MKV_BLOCK_GROUP = 0xA0
+MKV_BLOCK = 0xA1
+MKV_BLOCK_DURATION = 0x9B
+
+DEFAULT_CUE_SECONDS = 5 # for cues without a duration, unless the next one starts earlier
+
+ASS_OVERRIDE_RE = re.compile(r"\{[^}]*\}")
+ASS_DRAWING_RE = re.compile(r"\{[^}]*\\p[1-9]")
+
+# cue text
+
+def srt_text(text):
+    return text
+
+def ass_text(text):
+    # matroska stores "ReadOrder, Layer, Style, Name, MarginL, MarginR, MarginV, Effect, Text"
+    fields = text.split(",", 8)
+    if len(fields) < 9 or ASS_DRAWING_RE.search(fields[8]):
+        return ""
+    text = ASS_OVERRIDE_RE.sub("", fields[8])
+    return text.replace("\\N", "\n").replace("\\n", "\n").replace("\\h", " ")
+
+CUE_TEXT = {"srt": srt_text, "ass": ass_text, "webvtt": srt_text, "tx3g": srt_text}
+
+def format_timestamp(seconds):
+    milliseconds = round(seconds * 1000)
+    hours, milliseconds = divmod(milliseconds, 3600000)
+    minutes, milliseconds = divmod(milliseconds, 60000)
+    seconds, milliseconds = divmod(milliseconds, 1000)
+    return f"{hours:02d}:{minutes:02d}:{seconds:02d}.{milliseconds:03d}"
+
+def iter_vtt(cues):
+    # cues: [(start, end or None, text)] in seconds, sorted by start
+    yield "WEBVTT\n\n"
+    for i, (start, end, text) in enumerate(cues):
+        if end is None:
+            end = start + DEFAULT_CUE_SECONDS
+            if i + 1 < len(cues):
+                end = min(end, cues[i + 1][0])
+
+        # blank lines would end the cue early, "-->" would start a new one
+        lines = [line.strip() for line in text.replace("\r", "").split("\n")]
+        text = "\n".join(line.replace("-->", "->") for line in lines if line)
+        if text and end > start:
+            yield f"{format_timestamp(start)} --> {format_timestamp(end)}\n{text}\n\n"
+
+# mkv
+
+def read_string(fp, start, end):
+    fp.seek(start)
+    return fp.read(end - start).rstrip(b"\0").decode("utf-8", "replace")
+
+def read_mkv_compression(fp, start, end):
+    # (algorithm, settings) of a track's content compression, None if it isn't compressed
+    fp.seek(start)
+    for encoding_id, encoding_start, encoding_end in metadata.iter_elements(fp, end):
+        if encoding_id != MKV_CONTENT_ENCODING:
+            continue
+        fp.seek(encoding_start)
+        for element_id, element_start, element_end in metadata.iter_elements(fp, encoding_end):
+            if element_id != MKV_CONTENT_COMPRESSION:
+                continue
+            algorithm, settings = 0, b"" # zlib unless specified
+            fp.seek(element_start)
+            for field_id, field_start, field_end in metadata.iter_elements(fp, element_end):
+                if field_id == MKV_CONTENT_COMP_ALGO:
+                    algorithm = metadata.read_uint(fp, field_start, field_end)
+                elif field_id == MKV_CONTENT_COMP_SETTINGS:
+                    fp.seek(field_start)
+                    settings = fp.read(field_end - field_start)
+            return algorithm, settings
+    return None
+
+def read_mkv_subtitle_tracks(fp, start, end):
+    # {track number: track} of the text subtitle tracks
+    tracks = {}
+    fp.seek(start)
+    for entry_id, entry_start, entry_end in metadata.iter_elements(fp, end):
+        if entry_id != metadata.MKV_TRACK_ENTRY:
+            continue
+
+        track = {"language": "eng", "name": None, "default": True, "forced": False, "compression": None} # matroska defaults
+        fields = {}
+        fp.seek(entry_start)
+        for element_id, element_start, element_end in metadata.iter_elements(fp, entry_end):
+            if element_id in (MKV_TRACK_NUMBER, metadata.MKV_TRACK_TYPE, MKV_FLAG_DEFAULT, MKV_FLAG_FORCED):
+                fields[element_id] = metadata.read_uint(fp, element_start, element_end)
+            elif element_id == metadata.MKV_CODEC_ID:
+                track["codec"] = MKV_TEXT_CODECS.get(read_string(fp, element_start, element_end))
+            elif element_id == MKV_LANGUAGE and "ietf" not in track:
+                track["language"] = read_string(fp, element_start, element_end)
+            elif element_id == MKV_LANGUAGE_IETF: # preferred over the iso 639-2 code
+                track["language"] = track["ietf"] = read_string(fp, element_start, element_end)
+            elif element_id == MKV_NAME:
+                track["name"] = read_string(fp, element_start, element_end) or None
+            elif element_id == MKV_CONTENT_ENCODINGS:
+                track["compression"] = read_mkv_compression(fp, element_start, element_end)
+
+        if fields.get(metadata.MKV_TRACK_TYPE) != MKV_SUBTITLE_TRACK or not track.get("codec") or MKV_TRACK_NUMBER not in fields:
+            continue # not text subtitles
+        if track["compression"] and track["compression"][0] not in (0, 3):
+            continue # compressed with something other than zlib or header stripping
+
+        track.pop("ietf", None)
+        track["number"] = fields[MKV_TRACK_NUMBER]
+        track["default"] = bool(fields.get(MKV_FLAG_DEFAULT, 1))
+        track["forced"] = bool(fields.get(MKV_FLAG_FORCED, 0))
+        track["cues"] = []
+        tracks[track["number"]] = track
+    return tracks
+
+def read_mkv_block(fp, start, end, tracks):
+    # (track, relative timecode, data) if the block belongs to a subtitle track, otherwise None
+    # only the few header bytes are read for the blocks of other tracks
+    fp.seek(start)
+    number, _ = metadata.read_vint(fp)
+    track = tracks.get(number)
+    if not track:
+        return None
+
+    timecode, flags = struct.unpack(">hB", fp.read(3))
+    if flags & 0x06: # laced, never done for subtitles
+        return None
+
+    data = fp.read(end - fp.tell())
+    if track["compression"]:
+        algorithm, settings = track["compression"]
+        data = zlib.decompress(data) if algorithm == 0 else settings + data
+    return track, timecode, data
+
+def read_mkv_subtitles(fp, file_size):
+    # one pass over the segment: track headers first, then the blocks of every cluster
+    element_id, _, header_end = next(metadata.iter_elements(fp, file_size), (None, None, None))
+    if element_id != metadata.EBML_HEADER:
+        raise ValueError("not an ebml file")
+
+    fp.seek(header_end)
+    element_id, segment_start, segment_end = next(metadata.iter_elements(fp, file_size), (None, None, None))
+    if element_id != metadata.MKV_SEGMENT:
+        raise ValueError("no mkv segment")
+
+    timecode_scale = 1000000 # nanoseconds per timestamp unit
+    tracks = {}
+    cluster_timecode = 0
+
+    fp.seek(segment_start)
+    try:
+        while fp.tell() < segment_end:
+            element_id, _ = metadata.read_vint(fp, keep_marker = True)
+            size, unknown = metadata.read_vint(fp)
+            start = fp.tell()
+            end = segment_end if unknown else min(start + size, segment_end)
+
+            if element_id == metadata.MKV_CLUSTER:
+                if not tracks:
+                    break # tracks come before the clusters, nothing to read
+                continue # step into the cluster (which can have an unknown size), its elements follow
+
+            if element_id == metadata.MKV_INFO:
+                fp.seek(start)
+                for info_id, info_start, info_end in metadata.iter_elements(fp, end):
+                    if info_id == metadata.MKV_TIMECODE_SCALE:
+                        timecode_scale = metadata.read_uint(fp, info_start, info_end)
+            elif element_id == metadata.MKV_TRACKS:
+                tracks = read_mkv_subtitle_tracks(fp, start, end)
+            elif element_id == MKV_CLUSTER_TIMECODE:
+                cluster_timecode = metadata.read_uint(fp, start, end)
+            elif element_id == MKV_SIMPLE_BLOCK and tracks:
+                block = read_mkv_block(fp, start, end, tracks)
+                if block:
+                    track, timecode, data = block
+                    track["cues"].append([cluster_timecode + timecode, None, data])
+            elif element_id == MKV_BLOCK_GROUP and tracks:
+                block, duration = None, None
+                fp.seek(start)
+                for group_id, group_start, group_end in metadata.iter_elements(fp, end):
+                    if group_id == MKV_BLOCK:
+                        block = read_mkv_block(fp, group_start, group_end, tracks)
+                    elif group_id == MKV_BLOCK_DURATION:
+                        duration = metadata.read_uint(fp, group_start, group_end)
+                if block:
+                    track, timecode, data = block
+                    track["cues"].append([cluster_timecode + timecode, duration, data])
+
+            fp.seek(end)
+    except EOFError:
+        pass # truncated file, keep the cues read so far
+
+    # timestamps in seconds, text decoded
+    scale = timecode_scale / 1e9
+    for track in tracks.values():
+        to_text = CUE_TEXT[track["codec"]]
+        cues = [(timecode * scale, None if duration is None else (timecode + duration) * scale,
+                 to_text(data.decode("utf-8", "replace")))
+                for timecode, duration, data in track["cues"]]
+        track["cues"] = sorted(cues, key=lambda cue: cue[0]) # ends can be None
+    return list(tracks.values())
+
+# mp4
+
+def read_full_box(fp, box, fmt):
+    # fields after the version and flags of a "full box"
+    fp.seek(box[0] + 4)
+    return struct.unpack(fmt, fp.read(struct.calcsize(fmt)))
+
+def read_table(fp, box, fmt):
+    # entries of an mp4 sample table box (entry count, then the entries)
+    fp.seek(box[0] + 4)
+    count = struct.unpack(">I", fp.read(4))[0]
+    entry_size = struct.calcsize(fmt)
+    data = fp.read(count * entry_size)
+    return list(struct.iter_unpack(fmt, data[:len(data) - len(data) % entry_size]))
+
+def read_mp4_subtitle_track(fp, start, end):
+    # track with the file offsets and times of its samples, or None if it isn't tx3g text
+    mdia = metadata.find_box(fp, start, end, b"mdia")
+    hdlr = mdia and metadata.find_box(fp, *mdia, b"hdlr")
+    mdhd = mdia and metadata.find_box(fp, *mdia, b"mdhd")
+    minf = mdia and metadata.find_box(fp, *mdia, b"minf")
+    stbl = minf and metadata.find_box(fp, *minf, b"stbl")
+    stsd = stbl and metadata.find_box(fp, *stbl, b"stsd")
+    tkhd = metadata.find_box(fp, start, end, b"tkhd")
+    if not (hdlr and mdhd and stsd and tkhd):
+        return None
+
+    fp.seek(hdlr[0] + 8)
+    handler = fp.read(4)
+    fp.seek(stsd[0] + 12)
+    if handler not in (b"sbtl", b"text") or fp.read(4) != b"tx3g":
+        return None
+
+    fp.seek(mdhd[0])
+    version = fp.read(1)[0]
+    if version == 1:
+        timescale, _, language = read_full_box(fp, mdhd, ">16xIQH")
+    else:
+        timescale, _, language = read_full_box(fp, mdhd, ">8xIIH")
+    language = "".join(chr(((language >> shift) & 0x1F) + 0x60) for shift in (10, 5, 0)) # packed iso 639-2
+
+    fp.seek(tkhd[0])
+    tkhd_version, tkhd_flags = fp.read(1)[0], int.from_bytes(fp.read(3), "big")
+    track_id = read_full_box(fp, tkhd, ">16xI" if tkhd_version == 1 else ">8xI")[0]
+
+    stts = metadata.find_box(fp, *stbl, b"stts")
+    stsz = metadata.find_box(fp, *stbl, b"stsz")
+    stsc = metadata.find_box(fp, *stbl, b"stsc")
+    stco = metadata.find_box(fp, *stbl, b"stco")
+    co64 = metadata.find_box(fp, *stbl, b"co64")
+    if not (stts and stsz and stsc and (stco or co64)) or not timescale:
+        return None
+
+    sample_size, sample_count = read_full_box(fp, stsz, ">II")
+    sizes = [sample_size] * sample_count if sample_size else [size for (size,) in read_table(fp, (stsz[0] + 4,), ">I")]
+    chunk_offsets = [offset for (offset,) in (read_table(fp, stco, ">I") if stco else read_table(fp, co64, ">Q"))]
+    chunk_runs = read_table(fp, stsc, ">III") # (first chunk, samples per chunk, description index)
+
+    # file offset of every sample, from the chunks they're in
+    offsets = []
+    for i, (first_chunk, samples_per_chunk, _) in enumerate(chunk_runs):
+        last_chunk = chunk_runs[i + 1][0] - 1 if i + 1 < len(chunk_runs) else len(chunk_offsets)
+        for chunk in range(first_chunk, last_chunk + 1):
+            offset = chunk_offsets[chunk - 1]
+            for _ in range(samples_per_chunk):
+                if len(offsets) == len(sizes):
+                    break
+                offsets.append(offset)
+                offset += sizes[len(offsets) - 1]
+
+    samples = []
+    time = 0
+    for count, delta in read_table(fp, stts, ">II"):
+        for _ in range(count):
+            if len(samples) == len(offsets):
+                break
+            index = len(samples)
+            samples.append((offsets[index], sizes[index], time / timescale, (time + delta) / timescale))
+            time += delta
+
+    return {"number": track_id, "codec": "tx3g", "language": language, "name": None,
+            "default": bool(tkhd_flags & 1), "forced": False, "samples": samples}
+
+def read_mp4_subtitles(fp, file_size):
+    moov = metadata.find_box(fp, 0, file_size, b"moov")
+    if not moov:
+        raise ValueError("no moov box")
+
+    fp.seek(moov[0])
+    traks = [(start, end) for box_type, start, end in metadata.iter_boxes(fp, moov[1]) if box_type == b"trak"]
+    tracks = [track for track in (read_mp4_subtitle_track(fp, start, end) for start, end in traks) if track]
+
+    # the samples of all tracks in file order, so the file is read front to back once
+    samples = sorted(((offset, size, start, end, track) for track in tracks
+                      for offset, size, start, end in track.pop("samples")), key=lambda sample: sample[0])
+    for track in tracks:
+        track["cues"] = []
+    for offset, size, start, end, track in samples:
+        if size < 2:
+            continue
+        fp.seek(offset)
+        data = fp.read(size)
+        length = struct.unpack(">H", data[:2])[0] # text, then optional style boxes
+        if length:
+            track["cues"].append((start, end, data[2:2 + length].decode("utf-8", "replace")))
+
+    for track in tracks:
+        track["cues"].sort(key=lambda cue: cue[0])
+    return tracks
+
+# extraction
+
+def write_vtt(path, cues):
+    fd, temp_path = tempfile.mkstemp(suffix=".tmp", dir=SUBTITLE_CACHE_DIR)
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as fp:
+            for chunk in iter_vtt(cues):
+                fp.write(chunk)
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+def extract_subtitles(path, key):
+    # writes every text subtitle track to SUBTITLE_CACHE_DIR/<key>-<track number>.vtt
+    # returns [{"number", "codec", "language", "name", "default", "forced", "filename"}],
+    # raises ValueError for files that can't be parsed
+    file_size = os.path.getsize(path)
+    with open(path, "rb", buffering=1024 * 1024) as fp:
+        try:
+            if path.lower().endswith(".mkv"):
+                tracks = read_mkv_subtitles(fp, file_size)
+            else:
+                tracks = read_mp4_subtitles(fp, file_size)
+        except (EOFError, struct.error, IndexError, zlib.error) as e:
+            raise ValueError(f"truncated or corrupt file: {e}")
+
+    os.makedirs(SUBTITLE_CACHE_DIR, exist_ok=True)
+    found = []
+    for track in tracks:
+        if not track["cues"]:
+            continue
+
+        filename = f"{key}-{track['number']}.vtt"
+        write_vtt(os.path.join(SUBTITLE_CACHE_DIR, filename), track["cues"])
+
+        language = track["language"]
+        found.append({"number": track["number"],
+                      "codec": track["codec"],
+                      "language": None if language in ("und", "") else language,
+                      "name": track["name"],
+                      "default": track["default"],
+                      "forced": track["forced"],
+                      "filename": filename})
+    return found
@@ -0,0 +1,197 @@
+# epub.py
+# serves .epub books chapter by chapter instead of having the reader download the whole file:
+# the OPF (manifest, spine, table of contents) and the position of every member in the zip are
+# read once per file version and cached, after which a chapter or image is a single seek + read
+
+import os
+import json
+import zlib
+import struct
+import zipfile
+import posixpath
+import mimetypes
+from functools import lru_cache
+from urllib.parse import unquote
+from xml.etree import ElementTree
+
+from subtitles import cache_key
+from config import BOOK_CACHE_DIR
+
+READ_SIZE = 256 * 1024
+
+NS = {
+    "container": "urn:oasis:names:tc:opendocument:xmlns:container",
+    "opf": "http://www.idpf.org/2007/opf",
+    "dc": "http://purl.org/dc/elements/1.1/",
+    "ncx": "http://www.daisy.org/z3986/2005/ncx/",
+    "xhtml": "http://www.w3.org/1999/xhtml",
+    "epub": "http://www.idpf.org/2007/ops",
+}
+
+LOCAL_HEADER = struct.Struct("<4s5H3I2H") # zip local file header, followed by the name and extra field
+
+def resolve(base_dir, href):
+    # member path inside the zip for an href relative to base_dir (fragment dropped)
+    href = unquote(href.split("#")[0])
+    return posixpath.normpath(posixpath.join(base_dir, href)) if href else ""
+
+def read_entries(path, archive):
+    # {member: {"offset", "method", "compressed_size", "size", "crc"}}, where offset is the start of the data
+    # the central directory doesn't know the length of each local header, so they are read once here
+    entries = {}
+    with open(path, "rb") as fp:
+        for info in archive.infolist():
+            if info.is_dir():
+                continue
+
+            fp.seek(info.header_offset)
+            header = LOCAL_HEADER.unpack(fp.read(LOCAL_HEADER.size))
+            if header[0] != b"PK\x03\x04":
+                raise ValueError(f"bad local header for '{info.filename}'")
+            name_length, extra_length = header[-2:]
+
+            entries[info.filename] = {
+                "offset": info.header_offset + LOCAL_HEADER.size + name_length + extra_length,
+                "method": info.compress_type,
+                "compressed_size": info.compress_size,
+                "size": info.file_size,
+                "crc": info.CRC,
+            }
+    return entries
+
+def read_nav_toc(archive, nav_path):
+    # epub 3 navigation document: links inside <nav epub:type="toc">
+    root = ElementTree.fromstring(archive.read(nav_path))
+    base_dir = posixpath.dirname(nav_path)
+    toc = []
+
+    def walk(element, level):
+        for child in element:
+            if child.tag == f"{{{NS['xhtml']}}}a" and child.get("href"):
+                toc.append({"label": "".join(child.itertext()).strip(), "href": resolve(base_dir, child.get("href")),
+                            "fragment": child.get("href").partition("#")[2], "level": level})
+            walk(child, level + (child.tag == f"{{{NS['xhtml']}}}ol"))
+
+    for nav in root.iter(f"{{{NS['xhtml']}}}nav"):
+        if nav.get(f"{{{NS['epub']}}}type") == "toc":
+            walk(nav, -1) # the outermost <ol> is level 0
+            break
+    return toc
+
+def read_ncx_toc(archive, ncx_path):
+    # epub 2 table of contents
+    root = ElementTree.fromstring(archive.read(ncx_path))
+    base_dir = posixpath.dirname(ncx_path)
+    toc = []
+
+    def walk(element, level):
+        for point in element.findall("ncx:navPoint", NS):
+            content = point.find("ncx:content", NS)
+            if content is not None and content.get("src"):
+                toc.append({"label": (point.findtext("ncx:navLabel/ncx:text", "", NS)).strip(),
+                            "href": resolve(base_dir, content.get("src")),
+                            "fragment": content.get("src").partition("#")[2], "level": level})
+            walk(point, level + 1)
+
+    nav_map = root.find("ncx:navMap", NS)
+    if nav_map is not None:
+        walk(nav_map, 0)
+    return toc
+
+def parse_book(path):
+    # reads the container, OPF and table of contents, raises ValueError for broken books
+    try:
+        with zipfile.ZipFile(path) as archive:
+            container = ElementTree.fromstring(archive.read("META-INF/container.xml"))
+            rootfile = container.find(".//container:rootfile", NS)
+            opf_path = rootfile.get("full-path")
+            opf = ElementTree.fromstring(archive.read(opf_path))
+            opf_dir = posixpath.dirname(opf_path)
+
+            items = {}
+            for item in opf.findall("opf:manifest/opf:item", NS):
+                items[item.get("id")] = {"href": resolve(opf_dir, item.get("href", "")),
+                                         "media_type": item.get("media-type"),
+                                         "properties": (item.get("properties") or "").split()}
+
+            spine_element = opf.find("opf:spine", NS)
+            spine = [items[itemref.get("idref")]["href"] for itemref in spine_element.findall("opf:itemref", NS)
+                     if itemref.get("idref") in items and itemref.get("linear") != "no"]
+
+            toc = []
+            nav = next((item for item in items.values() if "nav" in item["properties"]), None)
+            ncx = items.get(spine_element.get("toc"))
+            try:
+                if nav:
+                    toc = read_nav_toc(archive, nav["href"])
+                if not toc and ncx:
+                    toc = read_ncx_toc(archive, ncx["href"])
+            except (KeyError, ElementTree.ParseError):
+                pass # the book is still readable without a table of contents
+
+            entries = read_entries(path, archive)
+            for item in items.values():
+                if item["href"] in entries and item["media_type"]:
+                    entries[item["href"]]["media_type"] = item["media_type"]
+
+            return {
+                "title": opf.findtext("opf:metadata/dc:title", "", NS).strip(),
+                "spine": spine,
+                "toc": toc,
+                "entries": entries,
+            }
+    except (zipfile.BadZipFile, KeyError, AttributeError, ElementTree.ParseError, struct.error) as e:
+        raise ValueError(f"invalid epub: {e}")
+
+@lru_cache(maxsize=64)
+def load_cached(cache_path):
+    with open(cache_path) as fp:
+        return json.load(fp)
+
+def load_book(media_dir, subpath):
+    # the parsed book (see parse_book()) plus its "version", parsed at most once per file version
+    stat = os.stat(os.path.join(media_dir, subpath))
+    version = cache_key(subpath, stat)[:16]
+    cache_path = os.path.join(BOOK_CACHE_DIR, f"{version}.json")
+
+    try:
+        return load_cached(cache_path)
+    except (FileNotFoundError, ValueError):
+        pass
+
+    book = parse_book(os.path.join(media_dir, subpath))
+    book["version"] = version
+
+    os.makedirs(BOOK_CACHE_DIR, exist_ok=True)
+    temp_path = f"{cache_path}.{os.getpid()}.tmp"
+    with open(temp_path, "w") as fp:
+        json.dump(book, fp)
+    os.replace(temp_path, cache_path)
+    return load_cached(cache_path)
+
+def get_media_type(name, entry):
+    return entry.get("media_type") or mimetypes.guess_type(name)[0] or "application/octet-stream"
+
+def iter_member(path, name, entry):
+    # the uncompressed bytes of one zip member, read straight from its offset in the file
+    # zipfile handles compression methods other than stored/deflate, but reads the central directory first
+    if entry["method"] not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+        with zipfile.ZipFile(path) as archive, archive.open(name) as member:
+            while data := member.read(READ_SIZE):
+                yield data
+        return
+
+    decompressor = zlib.decompressobj(-zlib.MAX_WBITS) if entry["method"] == zipfile.ZIP_DEFLATED else None
+    with open(path, "rb") as fp:
+        fp.seek(entry["offset"])
+        remaining = entry["compressed_size"]
+
+        while remaining > 0:
+            data = fp.read(min(READ_SIZE, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            yield decompressor.decompress(data) if decompressor else data
+
+    if decompressor:
+        yield decompressor.flush()
@@ -0,0 +1,297 @@
+# event_log.py
+# alternative to ProgressBuffer (PROGRESS_STORE = "log" in config.py): progress heartbeats and
+# watched changes are appended to a per-day log file instead of being written to sqlite,
+# and folded back into media_progress / user_watched by a periodic compaction
+#
+# - appends from all request threads are group-committed: one write (+ fsync) per batch
+# - every worker keeps the latest state in memory, rebuilt from the log at startup and
+#   kept up to date by reading what other workers appended since
+# - compaction upserts the latest state into the database and deletes the log files of past days
+# - media rows deleted by reconcile.py are logged too, so no worker folds their state back in
+
+import os
+import json
+import time
+import atexit
+import logging
+import threading
+from datetime import datetime, timezone
+
+from sqlalchemy.dialects.sqlite import insert
+
+from database import db, MediaProgress, user_watched, get_known_media_ids
+
+log = logging.getLogger(__name__)
+
+try:
+    import fcntl
+except ImportError: # Windows
+    fcntl = None
+
+class EventLog:
+    def __init__(self, log_dir, group_commit_interval = 0, fsync = True):
+        self.log_dir = log_dir
+        self.group_commit_interval = group_commit_interval
+        self.fsync = fsync
+
+        self.progress = {} # (user_id, media_id) -> (position, time), not yet compacted
+        self.watched = {} # (user_id, media_id) -> (watched, time)
+        self.removed = {} # media_id -> time its row was deleted, older events for it are ignored
+        self.offsets = {} # log filename -> bytes already read into the maps above
+        self.lock = threading.Lock()
+
+        self.queue = [] # encoded events waiting to be written
+        self.queued = 0 # sequence number of the last queued event
+        self.committed = 0 # sequence number of the last written event
+        self.commit_cond = threading.Condition(threading.Lock())
+        self.writer = None
+
+        self.lock_path = os.path.join(log_dir, "compaction.lock")
+        os.makedirs(log_dir, exist_ok=True)
+        self.refresh() # rebuild the state from the log
+
+    # log files
+
+    def log_files(self):
+        return sorted(name for name in os.listdir(self.log_dir) if name.startswith("events-") and name.endswith(".log"))
+
+    def current_log_file(self):
+        return f"events-{datetime.now(timezone.utc):%Y-%m-%d}.log"
+
+    def apply(self, event):
+        # last write wins, events read back from the log may be older than what is in memory
+        if "x" in event: # media row deleted
+            media_id = event["m"]
+            self.removed[media_id] = max(event["t"], self.removed.get(media_id, 0))
+            for target in (self.progress, self.watched):
+                for key in [key for key, (_, updated_at) in target.items() if key[1] == media_id and updated_at <= event["t"]]:
+                    del target[key]
+            return
+        if event["t"] <= self.removed.get(event["m"], -1):
+            return
+
+        key = (event["u"], event["m"])
+        target, value = (self.progress, event["p"]) if "p" in event else (self.watched, event["w"])
+        current = target.get(key)
+        if not current or event["t"] >= current[1]:
+            target[key] = (value, event["t"])
+
+    def refresh(self):
+        # read events appended (by any worker) since the last refresh
+        for name in self.log_files():
+            path = os.path.join(self.log_dir, name)
+            offset = self.offsets.get(name, 0)
+            try:
+                if os.path.getsize(path) <= offset:
+                    continue
+                with open(path, "rb") as fp:
+                    fp.seek(offset)
+                    data = fp.read()
+            except FileNotFoundError:
+                continue # compacted in the meantime
+
+            data = data[:data.rfind(b"\n") + 1] # a batch may be half-written
+            with self.lock:
+                for line in data.splitlines():
+                    try:
+                        self.apply(json.loads(line))
+                    except (ValueError, KeyError):
+                        pass # damaged line, e.g. after a crash
+                self.offsets[name] = offset + len(data)
+
+    # writing
+
+    def append(self, events):
+        # queue events and wait until the writer thread has written them
+        with self.lock:
+            for event in events:
+                self.apply(event)
+
+        with self.commit_cond:
+            self.queue.extend(json.dumps(event, separators=(",", ":")) + "\n" for event in events)
+            self.queued += len(events)
+            sequence = self.queued
+            self.commit_cond.notify_all()
+
+            if self.writer is None: # not started (yet), write from this thread
+                self.write_batch()
+                return
+            while self.committed < sequence:
+                self.commit_cond.wait()
+
+    def write_batch(self):
+        # called with commit_cond held
+        if not self.queue:
+            return
+
+        batch, self.queue = self.queue, []
+        sequence = self.queued
+
+        fd = os.open(os.path.join(self.log_dir, self.current_log_file()), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, "".join(batch).encode("utf-8")) # a single append, so batches from different workers don't interleave
+            if self.fsync:
+                os.fsync(fd)
+        finally:
+            os.close(fd)
+
+        self.committed = sequence
+        self.commit_cond.notify_all()
+
+    def run_writer(self):
+        while True:
+            with self.commit_cond:
+                while not self.queue:
+                    self.commit_cond.wait()
+            if self.group_commit_interval:
+                time.sleep(self.group_commit_interval) # let more events join the batch
+            with self.commit_cond:
+                try:
+                    self.write_batch()
+                except Exception:
+                    log.exception("event log write failed")
+                    self.committed = self.queued # don't leave requests waiting, the state is still in memory
+                    self.commit_cond.notify_all()
+
+    # same interface as ProgressBuffer
+
+    def set(self, user_id, media_id, position):
+        self.append([{"t": time.time(), "u": user_id, "m": media_id, "p": position}])
+
+    def get(self, user_id, media_id):
+        # latest logged position, None if the database is up to date
+        self.refresh()
+        with self.lock:
+            entry = self.progress.get((user_id, media_id))
+        return entry[0] if entry else None
+
+    def get_many(self, user_id, media_ids):
+        self.refresh()
+        with self.lock:
+            return {media_id: self.progress[(user_id, media_id)][0] for media_id in media_ids
+                    if (user_id, media_id) in self.progress}
+
+    def flush(self):
+        # write anything still queued to the log
+        with self.commit_cond:
+            self.write_batch()
+
+    # watched state
+
+    def set_watched(self, user_id, media_ids, watched):
+        now = time.time()
+        self.append([{"t": now, "u": user_id, "m": media_id, "w": bool(watched)} for media_id in media_ids])
+
+    def get_watched(self, user_id):
+        # {media_id: watched} for changes that may not be in user_watched yet
+        self.refresh()
+        with self.lock:
+            return {media_id: watched for (event_user_id, media_id), (watched, _) in self.watched.items()
+                    if event_user_id == user_id}
+
+    # deleted media
+
+    def remove_media(self, media_ids):
+        # forget the state of deleted media rows, in every worker (media_ids can be reused by new rows)
+        now = time.time()
+        self.append([{"t": now, "m": media_id, "x": True} for media_id in media_ids])
+
+    # compaction
+
+    def compact(self):
+        # fold the logged state into the database, then delete the log files of past days
+        # returns the number of rows written, call with the compaction lock held (see locked_compact())
+        self.flush()
+        files = self.log_files()
+        self.refresh()
+
+        with self.lock:
+            progress = dict(self.progress)
+            watched = dict(self.watched)
+
+        # rows deleted since their events were logged
+        known = get_known_media_ids({media_id for _, media_id in [*progress, *watched]})
+        progress = {key: value for key, value in progress.items() if key[1] in known}
+        watched = {key: value for key, value in watched.items() if key[1] in known}
+
+        rows = [{"user_id": user_id, "media_id": media_id, "position_seconds": position, "updated_at": updated_at}
+                for (user_id, media_id), (position, updated_at) in progress.items()]
+        if rows:
+            table = MediaProgress.__table__
+            stmt = insert(table)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[table.c.user_id, table.c.media_id],
+                set_={"position_seconds": stmt.excluded.position_seconds, "updated_at": stmt.excluded.updated_at},
+                where=table.c.updated_at.is_(None) | (stmt.excluded.updated_at >= table.c.updated_at))
+
+        added = [{"user_id": user_id, "media_id": media_id} for (user_id, media_id), (is_watched, _) in watched.items() if is_watched]
+        removed = [(user_id, media_id) for (user_id, media_id), (is_watched, _) in watched.items() if not is_watched]
+        try:
+            if rows:
+                db.session.execute(stmt, rows)
+            if added:
+                db.session.execute(insert(user_watched).on_conflict_do_nothing(), added)
+            for user_id, media_id in removed:
+                db.session.execute(user_watched.delete().where(user_watched.c.user_id == user_id, user_watched.c.media_id == media_id))
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+
+        # today's file is still being appended to, it gets folded again next time
+        current = self.current_log_file()
+        for name in files:
+            if name != current:
+                os.remove(os.path.join(self.log_dir, name))
+
+        self.prune()
+        return len(rows) + len(added) + len(removed)
+
+    def locked_compact(self, blocking = True):
+        # compact with the lock shared by all workers, returns None when another worker is compacting (blocking=False)
+        with open(self.lock_path, "w") as fp:
+            if fcntl:
+                try:
+                    fcntl.flock(fp, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+                except BlockingIOError:
+                    self.prune() # another worker is compacting
+                    return None
+            return self.compact()
+
+    def prune(self):
+        # forget state from log files that were compacted (by any worker), it is in the database now
+        files = self.log_files()
+        if not files:
+            return
+        # with some margin, events from just before midnight can end up in the next day's file
+        oldest = datetime.strptime(files[0], "events-%Y-%m-%d.log").replace(tzinfo=timezone.utc).timestamp() - 3600
+
+        with self.lock:
+            for target in (self.progress, self.watched):
+                for key in [key for key, (_, updated_at) in target.items() if updated_at < oldest]:
+                    del target[key]
+            self.removed = {media_id: removed_at for media_id, removed_at in self.removed.items() if removed_at >= oldest}
+            self.offsets = {name: offset for name, offset in self.offsets.items() if name in files}
+
+    def start(self, app, interval):
+        # start the group commit writer, and compact every interval seconds (one worker at a time)
+        self.writer = threading.Thread(target=self.run_writer, name="event-log-writer", daemon=True)
+        self.writer.start()
+
+        def compact_with_context():
+            with app.app_context():
+                self.locked_compact(blocking = False)
+
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    compact_with_context()
+                except Exception:
+                    log.exception("event log compaction failed")
+
+        atexit.register(self.flush)
+
+        thread = threading.Thread(target=run, name="event-log-compactor", daemon=True)
+        thread.start()
+        return thread
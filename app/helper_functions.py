@@ -1,9 +1,12 @@
 import re
 import os
 import json
-import convert
+import logging
+import subtitles
 from pathlib import PurePosixPath
 
+log = logging.getLogger(__name__)
+
 def allowed_file(filename, allowed_extensions):
     return '.' in filename and os.path.splitext(filename)[1].lower() in allowed_extensions
 
@@ -25,8 +28,8 @@ def save_watched(watched_movies, watched_file):
     with open(watched_file, "w") as fp:
         json.dump(watched_movies, fp, indent=4)
 
-def get_subtitle_url(subpath, media_dir, verbose = False):
-    # check if .vtt subtitles exist, if not check for .srt and convert to .vtt
+def get_subtitle_url(subpath, media_dir):
+    # check if .vtt subtitles exist, if not look up the .srt converted to .vtt by subtitles.py
     
     root = os.path.splitext(subpath)[0]
     url = str(PurePosixPath(root)) # fix backslashes on Windows machines
@@ -34,35 +37,29 @@ def get_subtitle_url(subpath, media_dir, verbose = False):
     subtitle_url = f"/media/{url}.vtt"
     subtitle_path = os.path.join(media_dir, f"{root}.vtt")
 
-    if verbose:
-        print("checking", subtitle_path)
+    log.debug("checking %s", subtitle_path)
     
     if os.path.exists(subtitle_path):
-        if verbose:
-            print(".vtt subtitles found")
+        log.debug(".vtt subtitles found")
 
         return subtitle_url
         
-    srt_path = os.path.join(media_dir, f"{root}.srt")
+    srt_subpath = f"{root}.srt"
 
-    if verbose:
-        print("checking", srt_path)
+    log.debug("checking %s", srt_subpath)
 
-    if not os.path.exists(srt_path):
-        if verbose:
-            print("no subtitles found")
+    if not os.path.exists(os.path.join(media_dir, srt_subpath)):
+        log.debug("no subtitles found")
         return ""
-        
-    if verbose:
-        print(".srt subtitles found")
-        
-    try:
-        convert.to_utf_8(srt_path, verbose = verbose)
-        convert.srt_to_vtt(srt_path, subtitle_path, verbose = verbose)
-        return subtitle_url
-        
-    except Exception as e:
-        if verbose:
-            print(".srt to .vtt conversion failed:", e)
-            print("subpath:", subpath)
-        return ""
\ No newline at end of file
+
+    vtt_name = subtitles.cached_vtt_name(media_dir, srt_subpath)
+
+    if not vtt_name:
+        # normally converted at scan/upload time already, only happens for new or edited files
+        log.debug(".srt subtitles not converted yet")
+        subtitles.queue_conversion(media_dir, srt_subpath)
+        return ""
+
+    log.debug("converted .srt subtitles found")
+
+    return f"/subtitles/{vtt_name}"
@@ -0,0 +1,298 @@
+# library.py
+# keeps an index of MEDIA_DIR (folder tree + media files) in the database,
+# so that index() can be served without touching the filesystem
+
+import os
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+import metrics
+from database import db, Media, Folder, SubtitleFile, SubtitleTrack, get_folder_media, bulk_create_media
+from subtitles import queue_conversion, detect_encodings
+from metadata import extract_many, METADATA_VERSION
+from uploads import expire_uploads
+from config import VIDEO_EXT, BOOK_EXT, SUBTITLE_EXT, METADATA_BATCH_SIZE, UPLOAD_EXPIRE_AGE
+
+try:
+    import fcntl
+except ImportError: # Windows
+    fcntl = None
+
+MEDIA_EXT = tuple(VIDEO_EXT | BOOK_EXT)
+
+log = logging.getLogger(__name__)
+
+scan_seconds = metrics.histogram("library_scan_seconds", "Time for an incremental scan of the whole library")
+folder_scan_seconds = metrics.histogram("library_folder_scan_seconds", "Time to reindex one folder, including the database updates")
+listdir_seconds = metrics.histogram("library_listdir_seconds", "Time to list the entries of one folder")
+folders_scanned = metrics.counter("library_folders_scanned_total", "Folders reindexed because their mtime changed")
+metadata_seconds = metrics.histogram("metadata_batch_seconds", "Time to read the metadata of one batch of videos")
+
+def is_inside(column, subpath):
+    # sql filter matching everything below a folder subpath
+    return column.startswith(subpath + os.sep, autoescape=True)
+
+def scan_folder(media_dir, subpath, mtime=None, in_pool=False):
+    # (re)index the direct contents of one folder, returns the subpaths of its subfolders
+    # in_pool: detect subtitle encodings in a forked process pool, for scans outside request threads
+    with folder_scan_seconds.time():
+        subfolders = index_folder(media_dir, subpath, mtime, in_pool)
+    folders_scanned.inc()
+    return subfolders
+
+def index_folder(media_dir, subpath, mtime, in_pool):
+    path = os.path.join(media_dir, subpath)
+    listing_start = time.perf_counter()
+
+    folder_names = []
+    media_entries = {}
+    subtitle_basenames = set()
+    srt_entries = {}
+    vtt_basenames = set()
+
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                if not entry.name.startswith("."):
+                    folder_names.append(entry.name)
+            elif entry.name.endswith(MEDIA_EXT):
+                media_entries[entry.name] = entry
+            elif entry.name.endswith(tuple(SUBTITLE_EXT)):
+                basename, ext = os.path.splitext(entry.name)
+                subtitle_basenames.add(basename)
+
+                if ext == ".srt":
+                    srt_entries[entry.name] = entry
+                else:
+                    vtt_basenames.add(basename)
+
+    listdir_seconds.observe(time.perf_counter() - listing_start)
+
+    # media files
+    existing = {media.filename: media for media in get_folder_media(subpath)}
+    new_stats = {}
+
+    for filename, entry in media_entries.items():
+        media = existing.pop(filename, None)
+
+        if not media:
+            new_stats[filename] = entry.stat()
+            continue
+
+        stat = entry.stat()
+        if media.size != stat.st_size or media.mtime != stat.st_mtime:
+            media.partial_hash = None # file changed, see reconcile.py
+        media.present = True
+        media.missing_since = None
+        media.has_subtitles = media.get_subtitles_bool(subtitle_basenames)
+        media.size = stat.st_size
+        media.mtime = stat.st_mtime
+
+    bulk_create_media(subpath, new_stats, subtitle_basenames, new_stats)
+
+    for media in existing.values(): # file was removed or renamed, reconcile.py deals with it later
+        if media.present:
+            media.present = False
+            media.missing_since = time.time()
+
+    subtitle_files = update_subtitle_files(media_dir, subpath, srt_entries, in_pool)
+
+    # subfolders
+    existing = {folder.name: folder for folder in Folder.query.filter_by(parent=subpath)}
+
+    for name in folder_names:
+        if not existing.pop(name, None):
+            db.session.add(Folder(subpath=os.path.join(subpath, name), parent=subpath, name=name))
+
+    for folder in existing.values(): # folder was removed or renamed
+        Folder.query.filter(is_inside(Folder.subpath, folder.subpath)).delete(synchronize_session=False)
+        Media.query.filter((Media.folder == folder.subpath) | is_inside(Media.folder, folder.subpath), Media.present) \
+                   .update({Media.present: False, Media.missing_since: time.time()}, synchronize_session=False)
+        db.session.delete(folder)
+
+    folder = Folder.query.filter_by(subpath=subpath).first()
+    if not folder:
+        folder = Folder(subpath=subpath, parent=os.path.dirname(subpath) if subpath else None, name=os.path.basename(subpath))
+        db.session.add(folder)
+    folder.mtime = mtime
+
+    db.session.commit()
+
+    # convert .srt subtitles ahead of time, so /play only has to look them up
+    for filename, subtitle_file in subtitle_files.items():
+        if os.path.splitext(filename)[0] not in vtt_basenames and subtitle_file.encoding:
+            queue_conversion(media_dir, subtitle_file.subpath, subtitle_file.encoding)
+
+    return [os.path.join(subpath, name) for name in folder_names]
+
+def update_subtitle_files(media_dir, subpath, srt_entries, in_pool):
+    # record the .srt files of a folder, detecting encodings only for new or changed files
+    # returns {filename: subtitle_file}
+    existing = {subtitle_file.subpath: subtitle_file for subtitle_file in SubtitleFile.query.filter_by(folder=subpath)}
+    subtitle_files = {}
+    changed = []
+
+    for filename, entry in srt_entries.items():
+        subtitle_file = existing.pop(os.path.join(subpath, filename), None)
+        if not subtitle_file:
+            subtitle_file = SubtitleFile(subpath=os.path.join(subpath, filename), folder=subpath)
+            db.session.add(subtitle_file)
+
+        stat = entry.stat()
+        if subtitle_file.size != stat.st_size or subtitle_file.mtime != stat.st_mtime:
+            subtitle_file.size = stat.st_size
+            subtitle_file.mtime = stat.st_mtime
+            changed.append(subtitle_file)
+
+        subtitle_files[filename] = subtitle_file
+
+    for subtitle_file in existing.values(): # removed
+        db.session.delete(subtitle_file)
+
+    encodings = detect_encodings([os.path.join(media_dir, subtitle_file.subpath) for subtitle_file in changed], in_pool)
+    for subtitle_file, encoding in zip(changed, encodings):
+        subtitle_file.encoding = encoding
+
+    return subtitle_files
+
+def scan_library(media_dir, verbose = False, full = False, in_pool = False):
+    # walk the folder tree, only rescanning folders whose mtime changed since the last scan
+    # (or every folder with full=True, which also picks up files that changed in place)
+    start = time.perf_counter()
+
+    known = {}
+    children = {}
+    for folder in Folder.query:
+        known[folder.subpath] = folder.mtime
+        children.setdefault(folder.parent, []).append(folder.subpath)
+
+    pending = [""]
+    scanned = 0
+    visited = 0
+
+    while pending:
+        subpath = pending.pop()
+        visited += 1
+
+        try:
+            # stat before listing, so changes made during the scan get picked up next time
+            mtime = os.stat(os.path.join(media_dir, subpath)).st_mtime
+        except FileNotFoundError:
+            continue # removed since, the parent folder scan will clean it up
+
+        if not full and subpath in known and known[subpath] == mtime:
+            pending.extend(children.get(subpath, []))
+            continue
+
+        pending.extend(scan_folder(media_dir, subpath, mtime, in_pool))
+        scanned += 1
+
+    elapsed = time.perf_counter() - start
+    scan_seconds.observe(elapsed)
+    log.log(logging.INFO if verbose else logging.DEBUG,
+            "library scan: %d/%d folders rescanned in %.2fs", scanned, visited, elapsed)
+
+def update_metadata(media_dir, verbose = False):
+    # read duration, resolution, codecs, embedded subtitles (and posters) of videos that are new or
+    # changed since their metadata was last read, a batch at a time so progress is committed as it goes
+    start = time.perf_counter()
+    updated = 0
+
+    while True:
+        batch = Media.query.filter(Media.is_video, Media.present, Media.mtime.isnot(None),
+                                   (Media.metadata_mtime.is_(None)) | (Media.metadata_mtime != Media.mtime)
+                                   | (Media.metadata_version.is_(None)) | (Media.metadata_version != METADATA_VERSION)) \
+                           .limit(METADATA_BATCH_SIZE).all()
+        if not batch:
+            break
+
+        with metadata_seconds.time():
+            results = extract_many(media_dir, [media.subpath for media in batch])
+
+        SubtitleTrack.query.filter(SubtitleTrack.media_id.in_([media.media_id for media in batch])) \
+                           .delete(synchronize_session=False)
+
+        for media, info in zip(batch, results):
+            media.metadata_mtime = media.mtime # don't retry files that couldn't be read until they change
+            media.metadata_version = METADATA_VERSION
+            if not info:
+                continue # gone since the scan, the next scan marks it missing
+
+            media.duration = info.get("duration")
+            media.width = info.get("width")
+            media.height = info.get("height")
+            media.video_codec = info.get("video_codec")
+            media.audio_codec = info.get("audio_codec")
+            media.playable = info["playable"]
+            media.poster = info["poster"]
+
+            tracks = info.get("subtitle_tracks", [])
+            db.session.add_all(SubtitleTrack(media_id=media.media_id, 
+                                             track_number=track["number"], 
+                                             codec=track["codec"], 
+                                             language=track["language"], 
+                                             name=track["name"], 
+                                             is_default=track["default"], 
+                                             is_forced=track["forced"], 
+                                             filename=track["filename"]) for track in tracks)
+            if tracks or media.has_embedded_subtitles:
+                media.has_embedded_subtitles = bool(tracks)
+                media.has_subtitles = bool(tracks) or has_sidecar_subtitles(media_dir, media.subpath)
+
+            if info["error"]:
+                log.log(logging.INFO if verbose else logging.DEBUG,
+                        "unable to read metadata of '%s': %s", media.subpath, info["error"])
+
+        db.session.commit()
+        updated += len(batch)
+
+    if updated:
+        log.log(logging.INFO if verbose else logging.DEBUG,
+                "metadata: %d videos updated in %.2fs", updated, time.perf_counter() - start)
+
+def has_sidecar_subtitles(media_dir, subpath):
+    basename = os.path.splitext(os.path.join(media_dir, subpath))[0]
+    return any(os.path.exists(basename + ext) for ext in SUBTITLE_EXT)
+
+@contextmanager
+def scan_lock(lock_path, blocking = True):
+    # keeps multiple gunicorn workers from scanning at the same time
+    # yields False if the lock is held elsewhere and blocking is False
+    if not fcntl:
+        yield True
+        return
+
+    with open(lock_path, "w") as fp:
+        try:
+            fcntl.flock(fp, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+
+        try:
+            yield True
+        finally:
+            fcntl.flock(fp, fcntl.LOCK_UN)
+
+def start_scanner(app, media_dir, interval):
+    # periodically rescan MEDIA_DIR in a background thread, reading the metadata of new videos
+    # and discarding abandoned uploads (the first run is right away, startup only does the quick folder scan)
+    lock_path = os.path.join(app.instance_path, "library-scan.lock")
+
+    def run():
+        while True:
+            try:
+                with app.app_context(), scan_lock(lock_path, blocking = False) as acquired:
+                    if acquired:
+                        scan_library(media_dir, in_pool=True)
+                        update_metadata(media_dir)
+                        expire_uploads(UPLOAD_EXPIRE_AGE)
+            except Exception:
+                log.exception("library scan failed")
+            time.sleep(interval)
+
+    thread = threading.Thread(target=run, name="library-scanner", daemon=True)
+    thread.start()
+    return thread
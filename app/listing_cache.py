@@ -0,0 +1,157 @@
+# listing_cache.py
+# rendered folder pages (index.html), so popular folders aren't queried and rendered on every hit
+#
+# pages are cached under a key of everything they depend on: the folder and filters, the folder's
+# directory mtime and version, and for logged in users who they are and their watched version.
+# sqlite triggers bump those versions whenever media rows, subfolders or watched flags change, so
+# the scanner, uploads, reconcile.py and toggling watched don't have to invalidate anything
+# themselves; pages under old keys are no longer asked for and fall out of the cache
+#
+# the key doubles as the ETag, so a browser revalidating a page gets a 304 without any rendering
+
+import os
+import json
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+from sqlalchemy import text
+
+import metrics
+from database import db
+
+PRUNE_EVERY = 100 # disk writes between removing the oldest pages
+
+log = logging.getLogger(__name__)
+
+lookups = metrics.counter("listing_cache_requests_total", "Folder page requests by where the page came from", ("result",))
+
+VERSION_SETUP = [
+    # media shown in (or filtered out of) a folder page
+    """CREATE TRIGGER IF NOT EXISTS folder_version_media_insert AFTER INSERT ON media BEGIN
+           UPDATE folder SET version = version + 1 WHERE subpath = new.folder;
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS folder_version_media_delete AFTER DELETE ON media BEGIN
+           UPDATE folder SET version = version + 1 WHERE subpath = old.folder;
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS folder_version_media_update AFTER UPDATE OF
+           filename, subpath, folder, present, has_subtitles, duration, width, height, playable, poster ON media BEGIN
+           UPDATE folder SET version = version + 1 WHERE subpath IN (old.folder, new.folder);
+       END""",
+    # subfolders listed on the parent's page
+    """CREATE TRIGGER IF NOT EXISTS folder_version_folder_insert AFTER INSERT ON folder BEGIN
+           UPDATE folder SET version = version + 1 WHERE subpath = new.parent;
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS folder_version_folder_delete AFTER DELETE ON folder BEGIN
+           UPDATE folder SET version = version + 1 WHERE subpath = old.parent;
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS folder_version_folder_update AFTER UPDATE OF name, parent ON folder BEGIN
+           UPDATE folder SET version = version + 1 WHERE subpath IN (old.parent, new.parent);
+       END""",
+    # watched flags, also behind the "unwatched" filter
+    """CREATE TRIGGER IF NOT EXISTS watched_version_insert AFTER INSERT ON user_watched BEGIN
+           UPDATE "user" SET watched_version = watched_version + 1 WHERE user_id = new.user_id;
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS watched_version_delete AFTER DELETE ON user_watched BEGIN
+           UPDATE "user" SET watched_version = watched_version + 1 WHERE user_id = old.user_id;
+       END""",
+]
+
+def create_version_triggers():
+    for statement in VERSION_SETUP:
+        db.session.execute(text(statement))
+    db.session.commit()
+
+def page_key(*parts):
+    return hashlib.sha1(json.dumps(parts).encode("utf-8")).hexdigest()
+
+class ListingCache:
+    def __init__(self, size, cache_dir = None, disk_entries = 0, namespace = ""):
+        self.size = size # pages kept in memory per worker process
+        self.cache_dir = cache_dir # shared by all workers, None to only cache in memory
+        self.disk_entries = disk_entries
+        self.namespace = namespace # e.g. the template version, so pages on disk from older releases aren't used
+        self.pages = OrderedDict() # key -> html, least recently used first
+        self.lock = threading.Lock()
+        self.writes = 0
+
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, *parts):
+        return page_key(self.namespace, *parts)
+
+    def get(self, key):
+        with self.lock:
+            page = self.pages.get(key)
+            if page is not None:
+                self.pages.move_to_end(key)
+        if page is not None:
+            lookups.inc(result="memory")
+            return page
+
+        if self.cache_dir:
+            try:
+                with open(os.path.join(self.cache_dir, key), encoding="utf-8") as fp:
+                    page = fp.read()
+            except FileNotFoundError:
+                pass
+            else:
+                self.remember(key, page)
+                lookups.inc(result="disk")
+                return page
+
+        lookups.inc(result="miss")
+        return None
+
+    def put(self, key, page):
+        self.remember(key, page)
+        if not self.cache_dir:
+            return
+
+        path = os.path.join(self.cache_dir, key)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as fp:
+                fp.write(page)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            log.warning("couldn't write folder page to '%s': %s", path, e)
+            return
+
+        with self.lock:
+            self.writes += 1
+            prune = self.writes % PRUNE_EVERY == 0
+        if prune:
+            self.prune()
+
+    def remember(self, key, page):
+        with self.lock:
+            self.pages[key] = page
+            self.pages.move_to_end(key)
+            while len(self.pages) > self.size:
+                self.pages.popitem(last=False)
+
+    def prune(self):
+        # keep the disk_entries most recently written pages
+        try:
+            entries = [entry for entry in os.scandir(self.cache_dir) if entry.is_file() and not entry.name.endswith(".tmp")]
+        except OSError:
+            return
+        if len(entries) <= self.disk_entries:
+            return
+
+        pages = []
+        for entry in entries:
+            try:
+                pages.append((entry.stat().st_mtime, entry.path))
+            except OSError:
+                pass # removed by another worker
+
+        pages.sort()
+        for _, path in pages[:len(pages) - self.disk_entries]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
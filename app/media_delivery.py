@@ -0,0 +1,103 @@
+# media_delivery.py
+# serves files from MEDIA_DIR when not running behind the Docker nginx, see MEDIA_DELIVERY in config.py:
+#   "direct" - serve Range requests ourselves, handing the bytes to gunicorn's sendfile (zero-copy)
+#   "accel"  - let a fronting nginx serve the bytes through X-Accel-Redirect
+#   "flask"  - plain send_from_directory
+
+import os
+import mimetypes
+from datetime import datetime, timezone
+from urllib.parse import quote
+
+from flask import Response, abort, request, send_from_directory
+from werkzeug.http import http_date, is_resource_modified
+from werkzeug.security import safe_join
+
+from config import MEDIA_DELIVERY, MEDIA_ACCEL_PREFIX, MEDIA_CACHE_MAX_AGE
+
+mimetypes.add_type("video/x-matroska", ".mkv")
+mimetypes.add_type("text/vtt", ".vtt")
+mimetypes.add_type("application/epub+zip", ".epub")
+
+READ_SIZE = 256 * 1024
+
+def read_range(fp, length):
+    # fallback for servers without sendfile support: stream the range in blocks
+    try:
+        while length > 0:
+            data = fp.read(min(READ_SIZE, length))
+            if not data:
+                break
+            length -= len(data)
+            yield data
+    finally:
+        fp.close()
+
+def file_body(fp, length):
+    # gunicorn sends a wsgi.file_wrapper with os.sendfile, starting at the current
+    # file position and stopping after Content-Length bytes
+    file_wrapper = request.environ.get("wsgi.file_wrapper")
+    if file_wrapper and request.environ.get("SERVER_SOFTWARE", "").startswith("gunicorn"):
+        return file_wrapper(fp, READ_SIZE)
+    return read_range(fp, length)
+
+def range_is_current(etag, mtime):
+    # a Range request with If-Range for an older version of the file gets the whole file
+    if_range = request.if_range
+    if if_range.etag:
+        return if_range.etag == etag
+    if if_range.date:
+        return int(mtime) <= if_range.date.timestamp()
+    return True
+
+def send_media(media_dir, subpath):
+    if MEDIA_DELIVERY == "flask":
+        return send_from_directory(media_dir, subpath)
+
+    path = safe_join(os.path.abspath(media_dir), subpath)
+    if not path or not os.path.isfile(path):
+        abort(404)
+
+    mimetype = mimetypes.guess_type(path)[0] or "application/octet-stream"
+
+    if MEDIA_DELIVERY == "accel":
+        response = Response(mimetype=mimetype)
+        response.headers["X-Accel-Redirect"] = MEDIA_ACCEL_PREFIX + quote(subpath)
+        return response
+
+    stat = os.stat(path)
+    size = stat.st_size
+    etag = f"{stat.st_mtime_ns:x}-{size:x}"
+    last_modified = datetime.fromtimestamp(stat.st_mtime, timezone.utc)
+
+    headers = {
+        "Accept-Ranges": "bytes",
+        "ETag": f'"{etag}"',
+        "Last-Modified": http_date(last_modified),
+        "Cache-Control": f"public, max-age={MEDIA_CACHE_MAX_AGE}",
+    }
+
+    if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        return Response(status=304, headers=headers)
+
+    start, stop, status = 0, size, 200
+
+    if request.range and range_is_current(etag, stat.st_mtime):
+        byte_range = request.range.range_for_length(size)
+        if byte_range is None:
+            headers["Content-Range"] = f"bytes */{size}"
+            return Response(status=416, headers=headers)
+
+        start, stop = byte_range
+        status = 206
+        headers["Content-Range"] = f"bytes {start}-{stop - 1}/{size}"
+
+    headers["Content-Length"] = str(stop - start)
+
+    if request.method == "HEAD":
+        return Response(status=status, headers=headers, mimetype=mimetype)
+
+    fp = open(path, "rb")
+    fp.seek(start)
+    return Response(file_body(fp, stop - start), status=status, headers=headers,
+                    mimetype=mimetype, direct_passthrough=True)
@@ -0,0 +1,406 @@
+# metadata.py
+# reads duration, resolution and codecs of videos from their mp4/mkv container headers
+# (only the boxes/elements that hold them, never the media data itself) and optionally
+# grabs a poster frame with a local ffmpeg binary; embedded subtitles are extracted along the way
+# (see embedded_subtitles.py)
+# results are cached on disk per file version (subpath + size + mtime), see extract_metadata()
+
+import os
+import json
+import shutil
+import struct
+import logging
+import tempfile
+import subprocess
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import embedded_subtitles
+from subtitles import cache_key
+from config import METADATA_CACHE_DIR, METADATA_WORKERS, GENERATE_POSTERS, FFMPEG_PATH, POSTER_WIDTH
+
+# codec names as stored in the database
+MP4_CODECS = {
+    b"avc1": "h264", b"avc3": "h264", b"hvc1": "hevc", b"hev1": "hevc",
+    b"vp09": "vp9", b"av01": "av1", b"mp4v": "mpeg4",
+    b"mp4a": "aac", b"Opus": "opus", b"fLaC": "flac", b"ac-3": "ac3", b"ec-3": "eac3", b".mp3": "mp3",
+}
+MKV_CODECS = {
+    "V_MPEG4/ISO/AVC": "h264", "V_MPEGH/ISO/HEVC": "hevc", "V_VP8": "vp8", "V_VP9": "vp9", "V_AV1": "av1",
+    "A_AAC": "aac", "A_OPUS": "opus", "A_VORBIS": "vorbis", "A_FLAC": "flac", "A_AC3": "ac3",
+    "A_EAC3": "eac3", "A_DTS": "dts", "A_MPEG/L3": "mp3", "A_TRUEHD": "truehd",
+}
+
+# what browsers can play inside an .mp4
+PLAYABLE_VIDEO_CODECS = {"h264", "vp9", "av1"}
+PLAYABLE_AUDIO_CODECS = {"aac", "mp3", "opus", "flac", None}
+
+# ebml element ids
+EBML_HEADER = 0x1A45DFA3
+MKV_SEGMENT = 0x18538067
+MKV_INFO = 0x1549A966
+MKV_TIMECODE_SCALE = 0x2AD7B1
+MKV_DURATION = 0x4489
+MKV_TRACKS = 0x1654AE6B
+MKV_TRACK_ENTRY = 0xAE
+MKV_TRACK_TYPE = 0x83
+MKV_CODEC_ID = 0x86
+MKV_VIDEO = 0xE0
+MKV_PIXEL_WIDTH = 0xB0
+MKV_PIXEL_HEIGHT = 0xBA
+MKV_CLUSTER = 0x1F43B675
+
+METADATA_VERSION = 2 # bumped when extract_metadata() returns more, so existing videos are read again
+
+pool = None # created on first use, see extract_many()
+
+log = logging.getLogger(__name__)
+
+def reset_after_fork():
+    global pool
+    pool = None
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=reset_after_fork)
+
+# mp4
+
+def iter_boxes(fp, end):
+    # yields (type, payload_start, box_end) for the boxes between the current position and end
+    while fp.tell() + 8 <= end:
+        start = fp.tell()
+        size, box_type = struct.unpack(">I4s", fp.read(8))
+        header_size = 8
+
+        if size == 1: # 64-bit size
+            size = struct.unpack(">Q", fp.read(8))[0]
+            header_size = 16
+        elif size == 0: # box extends to the end of the file
+            size = end - start
+
+        if size < header_size:
+            raise ValueError("invalid mp4 box size")
+        if start + header_size > end:
+            return # header runs past the parent box
+
+        box_end = min(start + size, end) # sizes past the parent can't be trusted
+        yield box_type, start + header_size, box_end
+        fp.seek(box_end) # skips mdat without reading it
+
+def find_box(fp, start, end, box_type):
+    fp.seek(start)
+    for found_type, payload_start, box_end in iter_boxes(fp, end):
+        if found_type == box_type:
+            return payload_start, box_end
+    return None
+
+def read_mp4_track(fp, start, end, info):
+    mdia = find_box(fp, start, end, b"mdia")
+    if not mdia:
+        return
+
+    hdlr = find_box(fp, *mdia, b"hdlr")
+    if not hdlr:
+        return
+    fp.seek(hdlr[0] + 8) # version, flags, pre_defined
+    handler = fp.read(4)
+
+    codec = None
+    minf = find_box(fp, *mdia, b"minf")
+    stbl = minf and find_box(fp, *minf, b"stbl")
+    stsd = stbl and find_box(fp, *stbl, b"stsd")
+    if stsd:
+        fp.seek(stsd[0] + 12) # version, flags, entry count, size of the first entry
+        fourcc = fp.read(4)
+        codec = MP4_CODECS.get(fourcc, fourcc.decode("latin-1").strip())
+
+    if handler == b"vide" and "video_codec" not in info:
+        info["video_codec"] = codec
+        tkhd = find_box(fp, start, end, b"tkhd")
+        if tkhd:
+            fp.seek(tkhd[1] - 8) # width and height are the last fields, 16.16 fixed point
+            width, height = struct.unpack(">II", fp.read(8))
+            info["width"], info["height"] = width >> 16, height >> 16
+    elif handler == b"soun" and "audio_codec" not in info:
+        info["audio_codec"] = codec
+
+def read_mp4(fp, file_size):
+    moov = find_box(fp, 0, file_size, b"moov")
+    if not moov:
+        raise ValueError("no moov box")
+
+    info = {}
+    mvhd = find_box(fp, *moov, b"mvhd")
+    if mvhd:
+        fp.seek(mvhd[0])
+        version = fp.read(1)[0]
+        if version == 1:
+            fp.seek(mvhd[0] + 20)
+            timescale, duration = struct.unpack(">IQ", fp.read(12))
+        else:
+            fp.seek(mvhd[0] + 12)
+            timescale, duration = struct.unpack(">II", fp.read(8))
+        if timescale:
+            info["duration"] = duration / timescale
+
+    fp.seek(moov[0])
+    traks = [(start, end) for box_type, start, end in iter_boxes(fp, moov[1]) if box_type == b"trak"]
+    for start, end in traks:
+        read_mp4_track(fp, start, end, info)
+
+    return info
+
+# mkv
+
+def read_vint(fp, keep_marker = False):
+    # ebml variable length integer, returns (value, is_unknown_size)
+    first = fp.read(1)
+    if not first:
+        raise EOFError
+    length = 1
+    while length <= 8 and not first[0] & (0x80 >> (length - 1)):
+        length += 1
+    if length > 8:
+        raise ValueError("invalid ebml vint")
+
+    value = int.from_bytes(first + fp.read(length - 1), "big")
+    if keep_marker: # element ids keep their length marker
+        return value, False
+
+    value &= (1 << (7 * length)) - 1
+    return value, value == (1 << (7 * length)) - 1
+
+def iter_elements(fp, end):
+    # yields (id, data_start, data_end) for the elements between the current position and end
+    while fp.tell() < end:
+        element_id, _ = read_vint(fp, keep_marker = True)
+        size, unknown = read_vint(fp)
+        start = fp.tell()
+        if start > end:
+            return # header runs past the parent element
+
+        if unknown: # only allowed for the segment and clusters, nothing past here is needed
+            yield element_id, start, end
+            return
+
+        data_end = min(start + size, end) # sizes past the parent can't be trusted
+        yield element_id, start, data_end
+        fp.seek(data_end)
+
+def read_uint(fp, start, end):
+    if not 0 <= end - start <= 8:
+        raise ValueError("invalid ebml integer size")
+    fp.seek(start)
+    return int.from_bytes(fp.read(end - start), "big")
+
+def read_mkv_track(fp, start, end, info):
+    fields = {}
+    fp.seek(start)
+    for element_id, data_start, data_end in iter_elements(fp, end):
+        if element_id == MKV_TRACK_TYPE:
+            fields["type"] = read_uint(fp, data_start, data_end)
+        elif element_id == MKV_CODEC_ID:
+            fp.seek(data_start)
+            fields["codec"] = fp.read(data_end - data_start).rstrip(b"\0").decode("ascii", "replace")
+        elif element_id == MKV_VIDEO:
+            fp.seek(data_start)
+            for video_id, video_start, video_end in iter_elements(fp, data_end):
+                if video_id == MKV_PIXEL_WIDTH:
+                    fields["width"] = read_uint(fp, video_start, video_end)
+                elif video_id == MKV_PIXEL_HEIGHT:
+                    fields["height"] = read_uint(fp, video_start, video_end)
+
+    codec = fields.get("codec")
+    if codec:
+        codec = MKV_CODECS.get(codec, MKV_CODECS.get(codec.split("/")[0], codec)) # e.g. A_AAC/MPEG4/LC
+
+    if fields.get("type") == 1 and "video_codec" not in info:
+        info["video_codec"] = codec
+        if "width" in fields and "height" in fields:
+            info["width"], info["height"] = fields["width"], fields["height"]
+    elif fields.get("type") == 2 and "audio_codec" not in info:
+        info["audio_codec"] = codec
+
+def read_mkv(fp, file_size):
+    element_id, _, header_end = next(iter_elements(fp, file_size))
+    if element_id != EBML_HEADER:
+        raise ValueError("not an ebml file")
+
+    fp.seek(header_end)
+    element_id, segment_start, segment_end = next(iter_elements(fp, file_size))
+    if element_id != MKV_SEGMENT:
+        raise ValueError("no mkv segment")
+
+    info = {}
+    timecode_scale = 1000000 # nanoseconds per timestamp unit, the default
+    duration = None
+    found = set()
+
+    fp.seek(segment_start)
+    for element_id, start, end in iter_elements(fp, segment_end):
+        if element_id == MKV_INFO:
+            fp.seek(start)
+            for info_id, info_start, info_end in iter_elements(fp, end):
+                if info_id == MKV_TIMECODE_SCALE:
+                    timecode_scale = read_uint(fp, info_start, info_end)
+                elif info_id == MKV_DURATION:
+                    fp.seek(info_start)
+                    data = fp.read(info_end - info_start)
+                    duration = struct.unpack(">f" if len(data) == 4 else ">d", data)[0]
+            found.add(element_id)
+        elif element_id == MKV_TRACKS:
+            fp.seek(start)
+            for track_id, track_start, track_end in iter_elements(fp, end):
+                if track_id == MKV_TRACK_ENTRY:
+                    read_mkv_track(fp, track_start, track_end, info)
+            found.add(element_id)
+        elif element_id == MKV_CLUSTER:
+            break # media data starts here, the headers come before it
+
+        if len(found) == 2:
+            break
+
+    if duration is not None:
+        info["duration"] = duration * timecode_scale / 1e9
+    return info
+
+# extraction
+
+def probe(path):
+    # {"duration", "width", "height", "video_codec", "audio_codec"}, missing keys weren't found
+    # raises ValueError for files that can't be parsed
+    file_size = os.path.getsize(path)
+    with open(path, "rb") as fp:
+        try:
+            if path.lower().endswith(".mkv"):
+                return read_mkv(fp, file_size)
+            return read_mp4(fp, file_size)
+        except (EOFError, struct.error, IndexError, StopIteration) as e: # StopIteration: no elements at all
+            raise ValueError(f"truncated or corrupt header: {e}")
+
+def is_playable(path, info):
+    # whether browsers can play the file in a <video> element
+    return (path.lower().endswith(".mp4")
+            and info.get("video_codec") in PLAYABLE_VIDEO_CODECS
+            and info.get("audio_codec") in PLAYABLE_AUDIO_CODECS)
+
+def generate_poster(path, poster_path, duration):
+    # grab a frame 10% into the video, returns False if ffmpeg is missing or fails
+    ffmpeg = shutil.which(FFMPEG_PATH)
+    if not ffmpeg:
+        return False
+
+    fd, temp_path = tempfile.mkstemp(suffix=".jpg", dir=METADATA_CACHE_DIR)
+    os.close(fd)
+
+    try:
+        seek = (duration or 0) * 0.1
+        result = subprocess.run([ffmpeg, "-v", "error", "-y", "-ss", f"{seek:.2f}", "-i", path,
+                                 "-frames:v", "1", "-vf", f"scale={POSTER_WIDTH}:-2", temp_path],
+                                stdin=subprocess.DEVNULL, capture_output=True, timeout=60)
+        if result.returncode != 0 or not os.path.getsize(temp_path):
+            return False
+        os.replace(temp_path, poster_path)
+        return True
+    except (OSError, subprocess.TimeoutExpired):
+        return False
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+def extract_metadata(media_dir, subpath):
+    # metadata of one video (see probe()) plus "playable", "poster" (filename in METADATA_CACHE_DIR or None),
+    # "subtitle_tracks" (see embedded_subtitles.extract_subtitles()) and "error",
+    # read from the cache if this version of the file was seen before
+    path = os.path.join(media_dir, subpath)
+    key = cache_key(subpath, os.stat(path))
+    cache_path = os.path.join(METADATA_CACHE_DIR, f"{key}.json")
+
+    try:
+        with open(cache_path) as fp:
+            info = json.load(fp)
+        if info.get("version") == METADATA_VERSION:
+            return info
+    except (FileNotFoundError, ValueError):
+        pass
+
+    try:
+        info = probe(path)
+        info["error"] = None
+    except ValueError as e:
+        info = {"error": str(e)}
+
+    info["version"] = METADATA_VERSION
+    info["playable"] = is_playable(path, info)
+    info["poster"] = None
+    info["subtitle_tracks"] = []
+
+    if not info["error"]:
+        try:
+            info["subtitle_tracks"] = embedded_subtitles.extract_subtitles(path, key)
+        except ValueError:
+            pass # headers were fine, the rest of the file isn't
+
+    os.makedirs(METADATA_CACHE_DIR, exist_ok=True)
+    if GENERATE_POSTERS and not info["error"]:
+        poster = f"{key}.jpg"
+        poster_path = os.path.join(METADATA_CACHE_DIR, poster)
+        if os.path.exists(poster_path) or generate_poster(path, poster_path, info.get("duration")):
+            info["poster"] = poster # kept from an older METADATA_VERSION
+
+    temp_path = f"{cache_path}.{os.getpid()}.tmp"
+    with open(temp_path, "w") as fp:
+        json.dump(info, fp)
+    os.replace(temp_path, cache_path)
+    return info
+
+def extract_many(media_dir, subpaths):
+    # extract_metadata() for many files, in a bounded process pool since parsing and ffmpeg
+    # shouldn't hold up the scanner thread's process
+    # returns a list in the same order, with None for files that have disappeared
+    if len(subpaths) < 2:
+        return [safe_extract(media_dir, subpath) for subpath in subpaths]
+
+    try:
+        return list(get_pool().map(safe_extract, [media_dir] * len(subpaths), subpaths))
+    except BrokenProcessPool:
+        # a worker died (e.g. killed for running out of memory), find the file it died on
+        log.warning("metadata worker died, reading the batch again one file at a time")
+        discard_pool()
+        return [extract_alone(media_dir, subpath) for subpath in subpaths]
+
+def get_pool():
+    global pool
+    if pool is None:
+        # fork, spawned processes would re-run app.py when it is __main__
+        pool = ProcessPoolExecutor(max_workers=METADATA_WORKERS, mp_context=multiprocessing.get_context("fork"))
+    return pool
+
+def discard_pool():
+    global pool
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+    pool = None
+
+def extract_alone(media_dir, subpath):
+    # in the pool, but the only file in it, so a worker dying only takes this file down with it
+    try:
+        return get_pool().submit(safe_extract, media_dir, subpath).result()
+    except BrokenProcessPool:
+        log.warning("metadata worker died reading '%s'", subpath)
+        discard_pool()
+        return error_info("metadata worker died reading the file")
+
+def error_info(error):
+    # result for files that couldn't be read, so they aren't retried until they change
+    return {"error": error, "version": METADATA_VERSION, "playable": False, "poster": None, "subtitle_tracks": []}
+
+def safe_extract(media_dir, subpath):
+    try:
+        return extract_metadata(media_dir, subpath)
+    except OSError:
+        return None # gone since the scan
+    except Exception as e: # a bug or a file crafted to trip the parsers, shouldn't stop the other files
+        log.warning("couldn't read metadata of '%s': %r", subpath, e)
+        return error_info(f"unexpected error: {e!r}")
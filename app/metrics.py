@@ -0,0 +1,251 @@
+# metrics.py
+# counters and histograms in the prometheus text format, for /metrics
+#
+# every gunicorn worker counts in its own memory and writes a snapshot to METRICS_DIR
+# every few seconds; /metrics adds up the snapshots of all workers, so it doesn't matter
+# which worker answers the scrape
+
+import os
+import json
+import time
+import atexit
+import bisect
+import threading
+from contextlib import contextmanager
+
+from flask import g, request, has_request_context, before_render_template, template_rendered
+from sqlalchemy import event
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+registry = {} # name -> metric
+registry_lock = threading.Lock()
+
+class Metric:
+    type = None
+
+    def __init__(self, name, description, labels = ()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.values = {} # label values -> value
+        self.lock = threading.Lock()
+
+    def key(self, labels):
+        return tuple(str(labels.get(label, "")) for label in self.labels)
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount = 1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, description, labels = (), buckets = DEFAULT_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        # values are [count per bucket (not cumulative)..., count above the last bucket, sum]
+        key = self.key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            values = self.values.get(key)
+            if values is None:
+                values = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            values[index] += 1
+            values[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+def register(metric):
+    # returns the already registered metric of the same name, so modules can be reloaded
+    with registry_lock:
+        return registry.setdefault(metric.name, metric)
+
+def counter(name, description, labels = ()):
+    return register(Counter(name, description, labels))
+
+def histogram(name, description, labels = (), buckets = DEFAULT_BUCKETS):
+    return register(Histogram(name, description, labels, buckets))
+
+def reset_after_fork():
+    # a forked worker starts counting from zero, the parent's counts are in the parent's snapshot
+    for metric in registry.values():
+        metric.values = {}
+        metric.lock = threading.Lock()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=reset_after_fork)
+
+# snapshots shared between workers
+
+def snapshot():
+    with registry_lock:
+        metrics = list(registry.values())
+
+    data = {}
+    for metric in metrics:
+        with metric.lock:
+            values = [[list(key), value if metric.type == "counter" else list(value)] for key, value in metric.values.items()]
+        data[metric.name] = {"type": metric.type, "description": metric.description, "labels": list(metric.labels),
+                             "buckets": list(getattr(metric, "buckets", [])), "values": values}
+    return data
+
+def write_snapshot(metrics_dir):
+    os.makedirs(metrics_dir, exist_ok=True)
+    path = os.path.join(metrics_dir, f"{os.getpid()}.json")
+    with open(path + ".tmp", "w") as fp:
+        json.dump(snapshot(), fp)
+    os.replace(path + ".tmp", path)
+
+def remove_stale_snapshots(metrics_dir):
+    # snapshots of processes from earlier runs, workers that exited during this run are kept
+    # so that counters don't go backwards
+    if not os.path.isdir(metrics_dir):
+        return
+    for name in os.listdir(metrics_dir):
+        pid, ext = os.path.splitext(name)
+        if ext != ".json" or not pid.isdigit():
+            continue
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            os.remove(os.path.join(metrics_dir, name))
+        except PermissionError:
+            pass # running, as another user
+
+def collect(metrics_dir):
+    # all workers' snapshots added up, with this process' live values instead of its snapshot
+    snapshots = [snapshot()]
+    own = f"{os.getpid()}.json"
+    if os.path.isdir(metrics_dir):
+        for name in os.listdir(metrics_dir):
+            if name.endswith(".json") and name != own:
+                try:
+                    with open(os.path.join(metrics_dir, name)) as fp:
+                        snapshots.append(json.load(fp))
+                except (OSError, ValueError):
+                    pass # removed or being replaced
+
+    merged = {}
+    for data in snapshots:
+        for name, metric in data.items():
+            target = merged.setdefault(name, {**metric, "values": {}})
+            for key, value in metric["values"]:
+                key = tuple(key)
+                current = target["values"].get(key)
+                if current is None:
+                    target["values"][key] = value
+                elif metric["type"] == "counter":
+                    target["values"][key] = current + value
+                else:
+                    target["values"][key] = [a + b for a, b in zip(current, value)]
+    return merged
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def format_labels(names, values):
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def render(merged):
+    # prometheus text exposition format
+    lines = []
+    for name in sorted(merged):
+        metric = merged[name]
+        lines.append(f"# HELP {name} {metric['description']}")
+        lines.append(f"# TYPE {name} {metric['type']}")
+
+        for key, value in sorted(metric["values"].items()):
+            if metric["type"] == "counter":
+                lines.append(f"{name}{format_labels(metric['labels'], key)} {value}")
+                continue
+
+            cumulative = 0
+            for bound, count in zip(metric["buckets"] + ["+Inf"], value[:-1]):
+                cumulative += count
+                lines.append(f"{name}_bucket{format_labels(metric['labels'] + ['le'], key + (bound,))} {cumulative}")
+            lines.append(f"{name}_sum{format_labels(metric['labels'], key)} {value[-1]}")
+            lines.append(f"{name}_count{format_labels(metric['labels'], key)} {cumulative}")
+    return "\n".join(lines) + "\n"
+
+def start(metrics_dir, interval):
+    # write this worker's snapshot every interval seconds, and once more on shutdown
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                write_snapshot(metrics_dir)
+            except OSError:
+                pass
+
+    atexit.register(write_snapshot, metrics_dir)
+
+    thread = threading.Thread(target=run, name="metrics-writer", daemon=True)
+    thread.start()
+    return thread
+
+# flask and sqlalchemy instrumentation
+
+request_seconds = histogram("http_request_duration_seconds", "Time spent handling requests", ("route", "method", "status"))
+db_queries = counter("db_queries_total", "SQL queries run while handling requests", ("route",))
+db_seconds = counter("db_query_seconds_total", "Time spent in SQL queries while handling requests", ("route",))
+db_queries_per_request = histogram("db_queries_per_request", "SQL queries per request", ("route",), COUNT_BUCKETS)
+render_seconds = histogram("template_render_seconds", "Time spent rendering templates", ("template",))
+
+def get_route():
+    return request.url_rule.rule if request.url_rule else "unmatched"
+
+def instrument(app, engine):
+    @app.before_request
+    def start_timer():
+        g.metrics_start = time.perf_counter()
+        g.db_queries = 0
+        g.db_seconds = 0.0
+
+    @app.after_request
+    def observe_request(response):
+        if "metrics_start" in g:
+            route = get_route()
+            request_seconds.observe(time.perf_counter() - g.metrics_start, route=route, method=request.method, status=response.status_code)
+            db_queries.inc(g.db_queries, route=route)
+            db_seconds.inc(g.db_seconds, route=route)
+            db_queries_per_request.observe(g.db_queries, route=route)
+        return response
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info["query_start"] = time.perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        start = conn.info.pop("query_start", None)
+        if start is not None and has_request_context() and "db_queries" in g:
+            elapsed = time.perf_counter() - start
+            g.db_queries += 1
+            g.db_seconds += elapsed
+
+    def start_render(sender, template, context, **extra):
+        if has_request_context():
+            g.render_start = time.perf_counter()
+
+    def observe_render(sender, template, context, **extra):
+        if has_request_context() and "render_start" in g:
+            render_seconds.observe(time.perf_counter() - g.pop("render_start"), template=template.name)
+
+    # strong references, the handlers only live in this function
+    before_render_template.connect(start_render, app, weak=False)
+    template_rendered.connect(observe_render, app, weak=False)
@@ -0,0 +1,246 @@
+# prefetch.py
+# warms the page cache for the next episode while the current one is ending, for libraries on
+# spinning disks where the first reads of a freshly opened file stall playback
+#
+# once a progress heartbeat comes within PREFETCH_LEAD_SECONDS of the end of a video, the head
+# and tail (mp4 moov / mkv cues, which browsers read before playing) of the next video in the
+# folder and its subtitles are handed to the kernel with posix_fadvise(WILLNEED), on a single
+# background thread per worker process
+#
+# an I/O budget shared by all workers (a token bucket in PREFETCH_DIR) caps how much gets
+# warmed per minute, so prefetching can't push everything else out of the cache. a marker file
+# per warmed video, also in PREFETCH_DIR, keeps workers from warming the same file twice and
+# tells whether a video that starts playing was warmed beforehand (hit) or not (miss)
+
+import os
+import json
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import fcntl
+except ImportError: # windows, the budget is kept per worker process instead
+    fcntl = None
+
+import metrics
+import subtitles
+from config import SUBTITLE_EXT, SUBTITLE_CACHE_DIR
+
+READ_SIZE = 1024 * 1024 # bytes read at a time where posix_fadvise isn't available
+PRUNE_EVERY = 100 # warmed videos between removing old marker files
+
+log = logging.getLogger(__name__)
+
+prefetches = metrics.counter("prefetch_requests_total", "Next-video prefetches by result", ("result",))
+prefetch_bytes = metrics.counter("prefetch_bytes_total", "Bytes of media and subtitles handed to the page cache ahead of playback")
+playback_starts = metrics.counter("prefetch_playback_total", "Playback starts by whether the video was prefetched", ("result",))
+
+class IOBudget:
+    # token bucket of bytes: up to burst at once, refilled at per_minute bytes per minute
+    # kept in a file locked with fcntl, so it's shared by all worker processes
+
+    def __init__(self, path, per_minute, burst):
+        self.path = path
+        self.rate = per_minute / 60
+        self.burst = burst
+        self.state = None # (tokens, time), when there is no fcntl
+        self.lock = threading.Lock()
+
+    def refill(self, state, now):
+        tokens, last = state or (self.burst, now)
+        return min(self.burst, tokens + (now - last) * self.rate)
+
+    def take(self, amount):
+        # uses up amount bytes, False (and nothing used) if there aren't that many left
+        with self.lock:
+            if not fcntl:
+                now = time.time()
+                tokens = self.refill(self.state, now)
+                if tokens < amount:
+                    return False
+                self.state = (tokens - amount, now)
+                return True
+
+            with open(self.path, "a+") as fp:
+                fcntl.flock(fp, fcntl.LOCK_EX)
+                fp.seek(0)
+                try:
+                    state = json.load(fp)
+                except ValueError: # new or damaged, start full
+                    state = None
+
+                now = time.time()
+                tokens = self.refill(state, now)
+                if tokens < amount:
+                    return False
+
+                fp.seek(0)
+                fp.truncate()
+                json.dump([tokens - amount, now], fp)
+                return True
+
+def warm(path, offset, length):
+    # asks the kernel to read a byte range into the page cache, returns the bytes asked for
+    length = max(0, min(length, os.path.getsize(path) - offset))
+    if not length:
+        return 0
+
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(fd, offset, length, os.POSIX_FADV_WILLNEED) # starts the reads, doesn't wait for them
+        else:
+            os.lseek(fd, offset, os.SEEK_SET)
+            remaining = length
+            while remaining > 0:
+                data = os.read(fd, min(READ_SIZE, remaining))
+                if not data:
+                    break
+                remaining -= len(data)
+    finally:
+        os.close(fd)
+    return length
+
+class Prefetcher:
+    def __init__(self, media_dir, state_dir, lead_seconds, head_bytes, tail_bytes, budget, window):
+        self.media_dir = media_dir
+        self.state_dir = state_dir # marker files and the budget
+        self.lead_seconds = lead_seconds # how long before the end of a video the next one is warmed
+        self.head_bytes = head_bytes
+        self.tail_bytes = tail_bytes
+        self.budget = budget
+        self.window = window # seconds a warmed video counts as a hit, and isn't warmed again
+        self.reset()
+
+    def reset(self):
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="prefetch")
+        self.triggered = {} # media_id -> time the video after it was looked up, in this process
+        self.durations = {} # media_id -> (duration, time it was looked up), in this process
+        self.lock = threading.Lock()
+        self.warmed = 0
+
+    def get_duration(self, media_id, load):
+        # duration of a video from load(media_id), called at most once per window per process
+        # so progress heartbeats don't each go to the database
+        now = time.monotonic()
+        with self.lock:
+            cached = self.durations.get(media_id)
+        if cached and now - cached[1] < self.window:
+            return cached[0]
+
+        duration = load(media_id)
+        with self.lock:
+            self.durations = {key: value for key, value in self.durations.items() if now - value[1] < self.window}
+            self.durations[media_id] = (duration, now)
+        return duration
+
+    def near_end(self, media_id, position, duration):
+        # whether the video after media_id should be warmed now, at most once per window per process
+        if not duration or position < duration - self.lead_seconds:
+            return False
+
+        now = time.monotonic()
+        with self.lock:
+            if now - self.triggered.get(media_id, -self.window) < self.window:
+                return False
+            self.triggered = {key: value for key, value in self.triggered.items() if now - value < self.window}
+            self.triggered[media_id] = now
+        return True
+
+    def marker(self, media_id):
+        return os.path.join(self.state_dir, str(media_id))
+
+    def is_warm(self, media_id):
+        try:
+            return time.time() - os.path.getmtime(self.marker(media_id)) < self.window
+        except FileNotFoundError:
+            return False
+
+    def submit(self, media_id, subpath, subtitle_names = ()):
+        # subtitle_names: embedded subtitle tracks in SUBTITLE_CACHE_DIR (see embedded_subtitles.py)
+        self.executor.submit(self.prefetch, media_id, subpath, subtitle_names)
+
+    def playback_started(self, media_id):
+        playback_starts.inc(result="hit" if self.is_warm(media_id) else "miss")
+
+    def subtitle_paths(self, subpath, subtitle_names):
+        basename = os.path.splitext(subpath)[0]
+        paths = [os.path.join(SUBTITLE_CACHE_DIR, name) for name in subtitle_names]
+
+        for ext in SUBTITLE_EXT:
+            if not os.path.exists(os.path.join(self.media_dir, basename + ext)):
+                continue
+            paths.append(os.path.join(self.media_dir, basename + ext))
+
+            if ext == ".srt":
+                vtt_name = subtitles.cached_vtt_name(self.media_dir, basename + ext)
+                if vtt_name:
+                    paths.append(os.path.join(SUBTITLE_CACHE_DIR, vtt_name))
+                else:
+                    subtitles.queue_conversion(self.media_dir, basename + ext)
+        return paths
+
+    def prefetch(self, media_id, subpath, subtitle_names):
+        if self.is_warm(media_id): # by another worker
+            prefetches.inc(result="recent")
+            return
+
+        try:
+            path = os.path.join(self.media_dir, subpath)
+            size = os.path.getsize(path)
+            head = min(self.head_bytes, size)
+            tail = min(self.tail_bytes, size - head)
+            ranges = [(path, 0, head), (path, size - tail, tail)]
+            ranges += [(subtitle_path, 0, os.path.getsize(subtitle_path))
+                       for subtitle_path in self.subtitle_paths(subpath, subtitle_names) if os.path.exists(subtitle_path)]
+
+            if not self.budget.take(sum(length for _, _, length in ranges)):
+                prefetches.inc(result="budget")
+                log.debug("prefetch of '%s' skipped, over the I/O budget", subpath)
+                return
+
+            warmed = sum(warm(*byte_range) for byte_range in ranges)
+            with open(self.marker(media_id), "w"):
+                pass
+        except OSError as e:
+            prefetches.inc(result="failed")
+            log.warning("couldn't prefetch '%s': %s", subpath, e)
+            return
+
+        prefetches.inc(result="warmed")
+        prefetch_bytes.inc(warmed)
+        log.debug("prefetched %d bytes of '%s'", warmed, subpath)
+
+        self.warmed += 1
+        if self.warmed % PRUNE_EVERY == 0:
+            self.prune()
+
+    def prune(self):
+        # remove markers older than window
+        now = time.time()
+        for entry in os.scandir(self.state_dir):
+            if not entry.name.isdigit():
+                continue
+            try:
+                if now - entry.stat().st_mtime >= self.window:
+                    os.remove(entry.path)
+            except FileNotFoundError:
+                pass # removed by another worker
+
+prefetchers = [] # reset in forked workers, the parent's thread doesn't survive the fork
+
+def create_prefetcher(media_dir, state_dir, lead_seconds, head_bytes, tail_bytes, budget_per_minute, budget_burst, window):
+    os.makedirs(state_dir, exist_ok=True)
+    budget = IOBudget(os.path.join(state_dir, "budget"), budget_per_minute, budget_burst)
+    prefetcher = Prefetcher(media_dir, state_dir, lead_seconds, head_bytes, tail_bytes, budget, window)
+    prefetchers.append(prefetcher)
+    return prefetcher
+
+def reset_after_fork():
+    for prefetcher in prefetchers:
+        prefetcher.reset()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=reset_after_fork)
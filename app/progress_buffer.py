@@ -0,0 +1,97 @@
+# progress_buffer.py
+# collects video progress heartbeats in memory and writes them to the database in batches,
+# instead of one transaction per heartbeat
+
+import time
+import atexit
+import logging
+import threading
+
+from sqlalchemy.dialects.sqlite import insert
+
+from database import db, MediaProgress
+
+log = logging.getLogger(__name__)
+
+class ProgressBuffer:
+    def __init__(self):
+        self.pending = {} # (user_id, media_id) -> (position, updated_at), last write wins
+        self.flushing = {} # batch currently being written, still readable by get()
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+
+    def set(self, user_id, media_id, position):
+        with self.lock:
+            self.pending[(user_id, media_id)] = (position, time.time())
+
+    def get(self, user_id, media_id):
+        # latest buffered position, None if there is nothing newer than the database
+        with self.lock:
+            entry = self.pending.get((user_id, media_id)) or self.flushing.get((user_id, media_id))
+        return entry[0] if entry else None
+
+    def get_many(self, user_id, media_ids):
+        # {media_id: position} for the given media that have buffered positions
+        with self.lock:
+            found = {}
+            for media_id in media_ids:
+                entry = self.pending.get((user_id, media_id)) or self.flushing.get((user_id, media_id))
+                if entry:
+                    found[media_id] = entry[0]
+        return found
+
+    def flush(self):
+        # write all buffered positions in one upsert, returns the number of rows written
+        with self.flush_lock:
+            with self.lock:
+                self.flushing, self.pending = self.pending, {}
+                batch = self.flushing
+
+            if not batch:
+                return 0
+
+            rows = [{"user_id": user_id, "media_id": media_id, "position_seconds": position, "updated_at": updated_at}
+                    for (user_id, media_id), (position, updated_at) in batch.items()]
+
+            table = MediaProgress.__table__
+            stmt = insert(table)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[table.c.user_id, table.c.media_id],
+                set_={"position_seconds": stmt.excluded.position_seconds, "updated_at": stmt.excluded.updated_at},
+                # another worker may have written a newer heartbeat already
+                where=table.c.updated_at.is_(None) | (stmt.excluded.updated_at >= table.c.updated_at))
+
+            try:
+                db.session.execute(stmt, rows)
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                with self.lock:
+                    # keep anything newer that came in while flushing
+                    self.pending = {**batch, **self.pending}
+                raise
+            finally:
+                with self.lock:
+                    self.flushing = {}
+
+            return len(rows)
+
+    def start(self, app, interval):
+        # flush every interval seconds in a background thread, and once more on shutdown
+        def flush_with_context():
+            with app.app_context():
+                self.flush()
+
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    flush_with_context()
+                except Exception:
+                    log.exception("progress flush failed")
+
+        atexit.register(flush_with_context)
+
+        thread = threading.Thread(target=run, name="progress-flusher", daemon=True)
+        thread.start()
+        return thread
@@ -0,0 +1,217 @@
+# reconcile.py
+# keeps the media table consistent with MEDIA_DIR beyond what the incremental scanner does:
+# - files that were moved or renamed get their watched flags and progress carried over
+#   from the row of their old location (matched by size, mtime and a partial hash)
+# - rows of files that have been gone for longer than RECONCILE_ORPHAN_GRACE are deleted,
+#   along with their watched flags and progress
+#
+# runs in the background every RECONCILE_INTERVAL seconds, or with `flask --app app reconcile`
+
+import os
+import time
+import hashlib
+import logging
+import threading
+
+from sqlalchemy import text, and_
+from sqlalchemy.orm import aliased
+
+import metrics
+from database import db, Media, SQLITE_MAX_VARS
+from library import scan_library, scan_lock
+
+HASH_BLOCK_SIZE = 64 * 1024
+CHECK_INTERVAL = 60 # seconds between checks whether a background reconciliation is due
+
+# tables that reference media rows
+MEDIA_REFERENCES = ["user_watched", "media_progress", "book_progress", "subtitle_track"]
+
+log = logging.getLogger(__name__)
+
+reconcile_seconds = metrics.histogram("reconcile_seconds", "Time for a full reconciliation of the media table")
+moves_found = metrics.counter("reconcile_moves_total", "Moved files whose watched flags and progress were carried over")
+orphans_purged = metrics.counter("reconcile_orphans_purged_total", "Media rows deleted after their file was gone for good")
+
+def partial_hash(path, size):
+    # cheap fingerprint: size, first and last block, enough to tell apart files with equal size and mtime
+    sha1 = hashlib.sha1(str(size).encode("ascii"))
+    with open(path, "rb") as fp:
+        sha1.update(fp.read(HASH_BLOCK_SIZE))
+        if size > HASH_BLOCK_SIZE:
+            fp.seek(max(size - HASH_BLOCK_SIZE, HASH_BLOCK_SIZE))
+            sha1.update(fp.read(HASH_BLOCK_SIZE))
+    return sha1.hexdigest()
+
+def update_partial_hashes(media_dir, batch_size = SQLITE_MAX_VARS):
+    # fingerprint present files that don't have one yet, so they can be recognized once they move
+    updated = 0
+    while True:
+        batch = Media.query.filter(Media.present, Media.partial_hash.is_(None), Media.size.isnot(None)) \
+                           .limit(batch_size).all()
+        if not batch:
+            break
+
+        for media in batch:
+            try:
+                media.partial_hash = partial_hash(os.path.join(media_dir, media.subpath), media.size)
+            except OSError:
+                media.partial_hash = "" # gone since the scan, the next scan marks it missing
+        db.session.commit()
+        updated += len(batch)
+    return updated
+
+def find_moves(media_dir = None):
+    # pairs of (missing row, present row) for the same file, in one query per side
+    # a present row only takes over from a missing row that is older than itself, and when the
+    # missing row has no fingerprint the match has to be unambiguous
+    # with media_dir, present rows without a fingerprint get one on the fly, without storing it (dry runs)
+    def fingerprint(media):
+        if media.partial_hash is not None or not media_dir:
+            return media.partial_hash
+        try:
+            return partial_hash(os.path.join(media_dir, media.subpath), media.size)
+        except OSError:
+            return ""
+
+    missing = Media.query.filter(~Media.present, Media.size.isnot(None)).all()
+    if not missing:
+        return []
+
+    # present rows with the size and mtime of some missing row (a move keeps both)
+    missing_media = aliased(Media)
+    candidates = {}
+    query = Media.query.join(missing_media, and_(missing_media.size == Media.size, missing_media.mtime == Media.mtime)) \
+                       .filter(Media.present, ~missing_media.present).distinct()
+    for media in query:
+        candidates.setdefault((media.size, media.mtime), []).append(media)
+
+    moves = []
+    taken = set()
+    for old in sorted(missing, key=lambda media: media.media_id):
+        matches = [new for new in candidates.get((old.size, old.mtime), [])
+                   if new.media_id > old.media_id and new.media_id not in taken]
+        if old.partial_hash:
+            matches = [new for new in matches if fingerprint(new) == old.partial_hash]
+        elif len(matches) > 1:
+            continue
+
+        if matches:
+            moves.append((old, matches[0]))
+            taken.add(matches[0].media_id)
+    return moves
+
+def apply_moves(moves):
+    # re-point watched flags and progress to the new rows, where the new row doesn't have its own yet
+    if not moves:
+        return
+
+    params = [{"old": old.media_id, "new": new.media_id} for old, new in moves]
+    db.session.execute(text("INSERT OR IGNORE INTO user_watched (user_id, media_id) "
+                            "SELECT user_id, :new FROM user_watched WHERE media_id = :old"), params)
+    db.session.execute(text("INSERT OR IGNORE INTO media_progress (user_id, media_id, position_seconds, updated_at) "
+                            "SELECT user_id, :new, position_seconds, updated_at FROM media_progress WHERE media_id = :old"), params)
+    db.session.execute(text("INSERT OR IGNORE INTO book_progress (user_id, media_id, location, updated_at) "
+                            "SELECT user_id, :new, location, updated_at FROM book_progress WHERE media_id = :old"), params)
+    delete_media([old.media_id for old, _ in moves])
+
+    for old, new in moves:
+        log.info("moved '%s' -> '%s'", old.subpath, new.subpath)
+
+def delete_media(media_ids):
+    # delete media rows and everything that references them, in chunked statements
+    for i in range(0, len(media_ids), SQLITE_MAX_VARS):
+        chunk = media_ids[i:i + SQLITE_MAX_VARS]
+        placeholders = ", ".join(f":id{j}" for j in range(len(chunk)))
+        params = {f"id{j}": media_id for j, media_id in enumerate(chunk)}
+
+        for table in MEDIA_REFERENCES + ["media"]:
+            db.session.execute(text(f"DELETE FROM {table} WHERE media_id IN ({placeholders})"), params)
+
+def purge_orphans(grace, batch_size = SQLITE_MAX_VARS, event_log = None):
+    # delete rows of files that have been missing for longer than grace seconds, a batch per transaction
+    # rows marked missing before missing_since existed start their grace period now
+    Media.query.filter(~Media.present, Media.missing_since.is_(None)) \
+               .update({Media.missing_since: time.time()}, synchronize_session=False)
+    db.session.commit()
+
+    purged = 0
+    cutoff = time.time() - grace
+    while True:
+        media_ids = [media_id for (media_id,) in db.session.execute(
+            db.select(Media.media_id).where(~Media.present, Media.missing_since < cutoff).limit(batch_size))]
+        if not media_ids:
+            break
+
+        delete_media(media_ids)
+        db.session.commit()
+        if event_log:
+            event_log.remove_media(media_ids)
+        purged += len(media_ids)
+    return purged
+
+def reconcile(media_dir, orphan_grace, dry_run = False, event_log = None):
+    # full rescan, move detection and orphan purge, returns counts of what was done
+    # a dry run writes nothing: it skips the rescan and reports what the index as of the last scan would give
+    # event_log: the EventLog when PROGRESS_STORE is "log", its changes are folded in first so they get carried over
+    if dry_run:
+        unhashed = Media.query.filter(Media.present, Media.partial_hash.is_(None), Media.size.isnot(None)).count()
+        moves = find_moves(media_dir)
+        orphans = Media.query.filter(~Media.present, Media.missing_since < time.time() - orphan_grace).count()
+        return {"hashed": unhashed, "moves": len(moves), "orphans": orphans}
+
+    with reconcile_seconds.time():
+        if not os.path.isdir(media_dir):
+            # e.g. an unmounted drive, don't mark the whole library missing
+            raise FileNotFoundError(f"media folder '{media_dir}' not found")
+
+        scan_library(media_dir, full=True, in_pool=True)
+        hashed = update_partial_hashes(media_dir)
+
+        moves = find_moves()
+        if event_log:
+            event_log.locked_compact() # watched flags and progress still in the log, onto the old rows
+
+        moved_ids = [old.media_id for old, _ in moves]
+        apply_moves(moves)
+        db.session.commit()
+        if event_log:
+            event_log.remove_media(moved_ids)
+        moves_found.inc(len(moves))
+
+        purged = purge_orphans(orphan_grace, event_log = event_log)
+        orphans_purged.inc(purged)
+
+    log.info("reconcile: %d fingerprinted, %d moves, %d orphans purged", hashed, len(moves), purged)
+    return {"hashed": hashed, "moves": len(moves), "orphans": purged}
+
+def is_due(stamp_path, interval):
+    # whether the last run (by any worker) started at least interval seconds ago, call with the scan lock held
+    # the first check only starts the clock, startup already did a quick scan
+    try:
+        if time.time() - os.path.getmtime(stamp_path) < interval:
+            return False
+    except FileNotFoundError:
+        open(stamp_path, "w").close()
+        return False
+    os.utime(stamp_path) # before running, so a run that keeps failing isn't retried every check
+    return True
+
+def start_reconciler(app, media_dir, interval, orphan_grace, event_log = None):
+    # reconcile every interval seconds in a background thread, sharing the scanner's lock
+    # every worker process runs one, the stamp file makes sure only one of them reconciles per interval
+    lock_path = os.path.join(app.instance_path, "library-scan.lock")
+    stamp_path = os.path.join(app.instance_path, "reconcile.stamp")
+
+    def run():
+        while True:
+            time.sleep(min(interval, CHECK_INTERVAL))
+            try:
+                with app.app_context(), scan_lock(lock_path, blocking = False) as acquired:
+                    if acquired and is_due(stamp_path, interval):
+                        reconcile(media_dir, orphan_grace, event_log = event_log)
+            except Exception:
+                log.exception("reconcile failed")
+
+    thread = threading.Thread(target=run, name="reconciler", daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,95 @@
+# search.py
+# full-text search over media filenames and paths, using an sqlite FTS5 index
+# that triggers keep in sync with the media table
+
+import re
+import json
+import logging
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+
+from database import db, Media
+
+log = logging.getLogger(__name__)
+
+FTS_SETUP = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS media_fts USING fts5(
+           filename, subpath, content='media', content_rowid='media_id',
+           tokenize='unicode61 remove_diacritics 2', prefix='2 3')""",
+    """CREATE TRIGGER IF NOT EXISTS media_fts_insert AFTER INSERT ON media BEGIN
+           INSERT INTO media_fts (rowid, filename, subpath) VALUES (new.media_id, new.filename, new.subpath);
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS media_fts_delete AFTER DELETE ON media BEGIN
+           INSERT INTO media_fts (media_fts, rowid, filename, subpath) VALUES ('delete', old.media_id, old.filename, old.subpath);
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS media_fts_update AFTER UPDATE OF filename, subpath ON media BEGIN
+           INSERT INTO media_fts (media_fts, rowid, filename, subpath) VALUES ('delete', old.media_id, old.filename, old.subpath);
+           INSERT INTO media_fts (rowid, filename, subpath) VALUES (new.media_id, new.filename, new.subpath);
+       END""",
+]
+
+fts_available = False # set by create_search_index(), falls back to LIKE queries otherwise
+
+def create_search_index():
+    global fts_available
+
+    exists = db.session.execute(text("SELECT 1 FROM sqlite_master WHERE name = 'media_fts'")).first()
+    try:
+        for statement in FTS_SETUP:
+            db.session.execute(text(statement))
+        if not exists:
+            # index the rows that were there before the search index
+            db.session.execute(text("INSERT INTO media_fts (media_fts) VALUES ('rebuild')"))
+        db.session.commit()
+        fts_available = True
+    except OperationalError as e:
+        db.session.rollback()
+        log.warning("full-text search unavailable, using slower LIKE queries: %s", e)
+        fts_available = False
+
+def get_words(query):
+    return re.findall(r"\w+", query)
+
+def search_media(query, user_id = None, unwatched = False, mp4_only = False, limit = 50, offset = 0, pending_watched = None):
+    # media matching every word of the query (as a prefix), best matches first
+    # returns (media_list, has_more)
+    # pending_watched: {media_id: watched} changes that aren't in user_watched yet (event log)
+    words = get_words(query)
+    if not words:
+        return [], False
+
+    params = {"limit": limit + 1, "offset": offset, "user_id": user_id}
+    filters = ["media.present = 1"]
+
+    if unwatched and user_id:
+        # same as database.unwatched_filter()
+        pending_watched = pending_watched or {}
+        unwatched_sql = ("NOT EXISTS (SELECT 1 FROM user_watched WHERE user_watched.user_id = :user_id "
+                         "AND user_watched.media_id = media.media_id)")
+        unmarked = [media_id for media_id, watched in pending_watched.items() if not watched]
+        if unmarked:
+            params["unmarked"] = json.dumps(unmarked)
+            unwatched_sql = f"({unwatched_sql} OR media.media_id IN (SELECT value FROM json_each(:unmarked)))"
+        filters.append(unwatched_sql)
+
+        marked = [media_id for media_id, watched in pending_watched.items() if watched]
+        if marked:
+            params["marked"] = json.dumps(marked)
+            filters.append("media.media_id NOT IN (SELECT value FROM json_each(:marked))")
+    if mp4_only:
+        # same as database.playable_filter()
+        filters.append("(media.playable = 1 OR (media.playable IS NULL AND substr(media.filename, -4) = '.mp4'))")
+
+    if fts_available:
+        params["match"] = " ".join(f'"{word}"*' for word in words) # "break bad" -> "break"* "bad"*
+        sql = ("SELECT media.* FROM media_fts JOIN media ON media.media_id = media_fts.rowid "
+               f"WHERE media_fts MATCH :match AND {' AND '.join(filters)} "
+               "ORDER BY bm25(media_fts) LIMIT :limit OFFSET :offset")
+    else:
+        for i, word in enumerate(words):
+            params[f"word{i}"] = f"%{word}%"
+            filters.append(f"media.subpath LIKE :word{i}")
+        sql = f"SELECT media.* FROM media WHERE {' AND '.join(filters)} ORDER BY media.filename LIMIT :limit OFFSET :offset"
+
+    media_list = db.session.execute(db.select(Media).from_statement(text(sql)), params).scalars().all()
+    return media_list[:limit], len(media_list) > limit
@@ -0,0 +1,310 @@
+# streaming.py
+# HLS for videos browsers can't play directly (e.g. .mkv, hevc, ac3 audio): each segment is cut from
+# the file with ffmpeg the first time it's asked for, copying h264 video and aac/mp3 audio and
+# transcoding everything else
+#
+# copied video can only be cut at keyframes, so those segments end at the first keyframe
+# HLS_SEGMENT_SECONDS after they start (listed once with ffprobe and kept with the segments),
+# transcoded video is cut every HLS_SEGMENT_SECONDS of the duration in the database
+#
+# segments are generated on a bounded thread pool per worker process (each thread waits for one
+# ffmpeg process), along with the next few after the one being played, and kept in an on-disk
+# cache shared by all workers that drops the least recently served segments once it's full
+
+import os
+import json
+import math
+import shutil
+import hashlib
+import logging
+import tempfile
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, CancelledError
+
+import metrics
+from subtitles import cache_key
+from config import (FFMPEG_PATH, HLS_ENABLED, HLS_CACHE_DIR, HLS_CACHE_MAX_BYTES, HLS_SEGMENT_SECONDS, HLS_WORKERS,
+                    HLS_SEGMENTS_AHEAD, HLS_SEGMENT_TIMEOUT, HLS_TRANSCODE_PRESET, HLS_TRANSCODE_CRF)
+
+# codecs that play in browsers from mpeg-ts segments, the rest is transcoded
+COPY_VIDEO_CODECS = {"h264"}
+COPY_AUDIO_CODECS = {"aac", "mp3"}
+
+EVICT_TO = 0.9 # fraction of HLS_CACHE_MAX_BYTES left after evicting
+SEEK_SLACK = 0.001 # seconds, copied segments are cut just after their keyframes so rounding can't miss them
+PROBE_TIMEOUT = 300 # seconds, ffprobe reads the whole file to list keyframes
+
+log = logging.getLogger(__name__)
+
+generate_seconds = metrics.histogram("hls_segment_generate_seconds", "Time ffmpeg takes to cut one HLS segment", ("video",))
+segment_requests = metrics.counter("hls_segment_requests_total", "HLS segment requests by whether the segment was cached", ("result",))
+evictions = metrics.counter("hls_segments_evicted_total", "HLS segments removed from the cache to stay under HLS_CACHE_MAX_BYTES")
+
+class SegmentError(Exception):
+    pass
+
+def get_ffmpeg():
+    return shutil.which(FFMPEG_PATH) if HLS_ENABLED else None
+
+def get_ffprobe(ffmpeg):
+    # installed along with ffmpeg
+    path = os.path.join(os.path.dirname(ffmpeg), "ffprobe")
+    return path if os.access(path, os.X_OK) else shutil.which("ffprobe")
+
+def needs_hls(media):
+    # videos the metadata scan found browsers can't play, if their duration is known
+    return bool(media.is_video and media.playable is False and media.duration)
+
+def get_version(media_dir, subpath):
+    # changes with the file and with the settings segments are made with
+    stat = os.stat(os.path.join(media_dir, subpath))
+    settings = f"{cache_key(subpath, stat)}\0{HLS_SEGMENT_SECONDS}\0{HLS_TRANSCODE_PRESET}\0{HLS_TRANSCODE_CRF}"
+    return hashlib.sha1(settings.encode("utf-8")).hexdigest()[:16]
+
+def probe_keyframes(ffprobe, path):
+    # times of the video keyframes, from the packets (nothing is decoded)
+    command = [ffprobe, "-v", "error", "-select_streams", "v:0", "-show_entries", "packet=pts_time,flags",
+               "-of", "csv=p=0", path]
+    result = subprocess.run(command, stdin=subprocess.DEVNULL, capture_output=True, timeout=PROBE_TIMEOUT)
+    if result.returncode != 0:
+        raise SegmentError(result.stderr.decode("utf-8", "replace").strip())
+
+    keyframes = []
+    for line in result.stdout.decode("ascii", "replace").splitlines():
+        time, _, flags = line.partition(",")
+        if "K" in flags and time not in ("", "N/A"):
+            keyframes.append(float(time))
+    return sorted(keyframes)
+
+def get_keyframes(ffprobe, source, version):
+    # keyframe times of a video, listed once for all workers, or None if ffprobe can't
+    path = os.path.join(HLS_CACHE_DIR, f"{version}.keyframes")
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        pass
+
+    if not ffprobe:
+        return None
+    try:
+        keyframes = probe_keyframes(ffprobe, source["path"])
+    except (SegmentError, subprocess.TimeoutExpired) as e:
+        log.warning("ffprobe failed on '%s': %s", source["path"], e)
+        return None
+
+    fd, temp_path = tempfile.mkstemp(suffix=".tmp", dir=HLS_CACHE_DIR)
+    with os.fdopen(fd, "w") as f:
+        json.dump(keyframes, f)
+    os.replace(temp_path, path)
+    return keyframes
+
+def plan_segments(ffprobe, source, version, duration):
+    # [(start, end)] of the segments, and whether the video is copied into them
+    # video that can't be cut at its keyframes is transcoded instead
+    keyframes = get_keyframes(ffprobe, source, version) if source["video_codec"] in COPY_VIDEO_CODECS else None
+    if not keyframes:
+        count = math.ceil(duration / HLS_SEGMENT_SECONDS)
+        return [(index * HLS_SEGMENT_SECONDS, min((index + 1) * HLS_SEGMENT_SECONDS, duration)) for index in range(count)], False
+
+    starts = [0.0]
+    for keyframe in keyframes:
+        if keyframe - starts[-1] >= HLS_SEGMENT_SECONDS and keyframe < duration:
+            starts.append(keyframe)
+    return list(zip(starts, starts[1:] + [duration])), True
+
+def build_playlist(segments, segment_url):
+    target = math.ceil(max(end - start for start, end in segments)) # no segment may be longer, rounded
+    lines = ["#EXTM3U",
+             "#EXT-X-VERSION:3",
+             f"#EXT-X-TARGETDURATION:{target}",
+             "#EXT-X-PLAYLIST-TYPE:VOD",
+             "#EXT-X-MEDIA-SEQUENCE:0"]
+    for index, (start, end) in enumerate(segments):
+        lines.append(f"#EXTINF:{end - start:.3f},")
+        lines.append(segment_url(index))
+    lines.append("#EXT-X-ENDLIST")
+    return "\n".join(lines) + "\n"
+
+def ffmpeg_command(ffmpeg, source, start, end, output):
+    # source: {"path", "video_codec", "audio_codec", "copy_video"}
+    # timestamps are kept (-copyts), so consecutive segments line up in the player
+    if source["copy_video"]: # start and end are keyframes, seeking copied video lands on the one before
+        start, end = start + SEEK_SLACK, end - SEEK_SLACK
+    command = [ffmpeg, "-v", "error", "-y", "-copyts", "-ss", f"{start:.6f}", "-i", source["path"], "-to", f"{end:.6f}",
+               "-map", "0:v:0", "-map", "0:a:0?", "-sn", "-dn"]
+
+    if source["copy_video"]:
+        command += ["-c:v", "copy"]
+    else:
+        command += ["-c:v", "libx264", "-preset", HLS_TRANSCODE_PRESET, "-crf", str(HLS_TRANSCODE_CRF), "-pix_fmt", "yuv420p"]
+
+    if source["audio_codec"] in COPY_AUDIO_CODECS:
+        command += ["-c:a", "copy"]
+    else:
+        command += ["-c:a", "aac", "-ac", "2", "-b:a", "160k"]
+
+    return command + ["-muxdelay", "0", "-f", "mpegts", output]
+
+class SegmentCache:
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.size = None # bytes in cache_dir, counted on first use
+        self.lock = threading.Lock()
+
+    def path(self, version, index):
+        return os.path.join(self.cache_dir, f"{version}-{index}.ts")
+
+    def get(self, version, index):
+        # path of a cached segment, marked as recently used, or None
+        path = self.path(version, index)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def add(self, temp_path, version, index):
+        size = os.path.getsize(temp_path)
+        os.replace(temp_path, self.path(version, index))
+
+        with self.lock:
+            if self.size is None:
+                self.size = self.count()
+            else:
+                self.size += size
+            full = self.size > self.max_bytes
+        if full:
+            self.evict()
+
+    def scan(self):
+        # [(last used, size, path)] of the cached segments
+        segments = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith(".ts"):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue # evicted by another worker
+                segments.append((stat.st_mtime, stat.st_size, entry.path))
+        return segments
+
+    def count(self):
+        return sum(size for _, size, _ in self.scan())
+
+    def evict(self):
+        # least recently served first, workers evicting at the same time just remove a bit more
+        segments = sorted(self.scan())
+        size = sum(size for _, size, _ in segments)
+        removed = 0
+        for _, segment_size, path in segments:
+            if size <= self.max_bytes * EVICT_TO:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            size -= segment_size
+            removed += 1
+
+        with self.lock:
+            self.size = size
+        evictions.inc(removed)
+
+class SegmentGenerator:
+    def __init__(self, cache, workers, ahead):
+        self.cache = cache
+        self.workers = workers
+        self.ahead = ahead # segments generated after the one being played
+        self.reset()
+
+    def reset(self):
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="hls")
+        self.jobs = {} # (version, index) -> future, queued or running
+        self.lock = threading.RLock() # done callbacks can run while it's held
+
+    def get(self, ffmpeg, source, version, index, segments):
+        # path of segment index, waiting for ffmpeg if it's not cached yet
+        # raises SegmentError if ffmpeg fails, TimeoutError if it takes too long
+        path = self.cache.get(version, index)
+        segment_requests.inc(result="cached" if path else "generated")
+
+        future = None if path else self.submit(ffmpeg, source, version, index, segments)
+        self.prefetch(ffmpeg, source, version, index, segments)
+        if future is None:
+            return path
+
+        try:
+            return future.result(timeout=HLS_SEGMENT_TIMEOUT)
+        except CancelledError: # someone else watching the same video seeked elsewhere
+            return self.submit(ffmpeg, source, version, index, segments).result(timeout=HLS_SEGMENT_TIMEOUT)
+
+    def submit(self, ffmpeg, source, version, index, segments):
+        key = (version, index)
+        with self.lock:
+            future = self.jobs.get(key)
+            if future is None:
+                future = self.executor.submit(self.generate, ffmpeg, source, version, index, segments)
+                self.jobs[key] = future
+                future.add_done_callback(lambda _: self.done(key))
+        return future
+
+    def done(self, key):
+        with self.lock:
+            self.jobs.pop(key, None)
+
+    def prefetch(self, ffmpeg, source, version, index, segments):
+        # queue the next few segments, and drop queued ones of this video the player seeked away from
+        wanted = range(index, min(index + 1 + self.ahead, len(segments)))
+        with self.lock:
+            for (job_version, job_index), future in list(self.jobs.items()):
+                if job_version == version and job_index not in wanted:
+                    future.cancel() # only if it hasn't started
+
+        for ahead in wanted[1:]:
+            if not os.path.exists(self.cache.path(version, ahead)):
+                self.submit(ffmpeg, source, version, ahead, segments)
+
+    def generate(self, ffmpeg, source, version, index, segments):
+        path = self.cache.get(version, index)
+        if path: # made by another worker process in the meantime
+            return path
+
+        start, end = segments[index]
+        video = "copy" if source["copy_video"] else "transcode"
+
+        fd, temp_path = tempfile.mkstemp(suffix=".tmp", dir=self.cache.cache_dir)
+        os.close(fd)
+        try:
+            with generate_seconds.time(video=video):
+                result = subprocess.run(ffmpeg_command(ffmpeg, source, start, end, temp_path),
+                                        stdin=subprocess.DEVNULL, capture_output=True, timeout=HLS_SEGMENT_TIMEOUT)
+            if result.returncode != 0 or not os.path.getsize(temp_path):
+                message = result.stderr.decode("utf-8", "replace").strip()
+                log.warning("ffmpeg failed on segment %d of '%s': %s", index, source["path"], message)
+                raise SegmentError(message)
+
+            self.cache.add(temp_path, version, index)
+        except subprocess.TimeoutExpired:
+            raise SegmentError(f"ffmpeg took longer than {HLS_SEGMENT_TIMEOUT}s")
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        return self.cache.path(version, index)
+
+generators = [] # reset in forked workers, the parent's threads don't survive the fork
+
+def create_generator():
+    os.makedirs(HLS_CACHE_DIR, exist_ok=True)
+    generator = SegmentGenerator(SegmentCache(HLS_CACHE_DIR, HLS_CACHE_MAX_BYTES), HLS_WORKERS, HLS_SEGMENTS_AHEAD)
+    generators.append(generator)
+    return generator
+
+def reset_after_fork():
+    for generator in generators:
+        generator.reset()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=reset_after_fork)
@@ -0,0 +1,124 @@
+# subtitles.py
+# converts .srt subtitles to .vtt off the request path, into a cache directory
+# (the original .srt files are never modified)
+
+import os
+import time
+import hashlib
+import logging
+import tempfile
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+import convert
+import metrics
+from config import SUBTITLE_CACHE_DIR, SUBTITLE_WORKERS, ENCODING_WORKERS
+
+executor = ThreadPoolExecutor(max_workers=SUBTITLE_WORKERS, thread_name_prefix="subtitles")
+queued = set() # srt paths currently waiting for / being converted
+queued_lock = threading.Lock()
+encoding_pool = None # created on first use, see detect_encodings()
+
+log = logging.getLogger(__name__)
+
+conversion_seconds = metrics.histogram("subtitle_conversion_seconds", "Time to convert one .srt file to .vtt")
+conversions = metrics.counter("subtitle_conversions_total", "Subtitle conversions by result", ("result",))
+encoding_seconds = metrics.histogram("subtitle_encoding_detection_seconds", "Time to detect the encodings of a batch of .srt files")
+
+def reset_after_fork():
+    # the parent's worker threads and processes don't belong to a forked gunicorn worker
+    global executor, queued, queued_lock, encoding_pool
+    executor = ThreadPoolExecutor(max_workers=SUBTITLE_WORKERS, thread_name_prefix="subtitles")
+    queued = set()
+    queued_lock = threading.Lock()
+    encoding_pool = None
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=reset_after_fork)
+
+def cache_key(srt_subpath, stat):
+    # changes whenever the source file is replaced or edited
+    source = f"{srt_subpath}\0{stat.st_size}\0{stat.st_mtime_ns}"
+    return hashlib.sha1(source.encode("utf-8")).hexdigest()
+
+def cached_vtt_name(media_dir, srt_subpath):
+    # filename of the converted subtitles in SUBTITLE_CACHE_DIR, None if not converted (yet)
+    try:
+        stat = os.stat(os.path.join(media_dir, srt_subpath))
+    except FileNotFoundError:
+        return None
+
+    name = f"{cache_key(srt_subpath, stat)}.vtt"
+    if os.path.exists(os.path.join(SUBTITLE_CACHE_DIR, name)):
+        return name
+    return None
+
+def detect_encodings(paths, in_pool = False):
+    # detect the encodings of many files at once, in a process pool since chardet is pure python
+    # the pool is forked, so only background scans use it (in_pool), never request threads
+    global encoding_pool
+    if not paths:
+        return []
+    if len(paths) < 2 or not in_pool:
+        with encoding_seconds.time():
+            return [convert.get_encoding_type(path) for path in paths]
+
+    if encoding_pool is None:
+        # fork, spawned processes would re-run app.py when it is __main__
+        # the workers only read files, so the locks of other threads they inherit don't matter
+        encoding_pool = ProcessPoolExecutor(max_workers=ENCODING_WORKERS, mp_context=multiprocessing.get_context("fork"))
+    with encoding_seconds.time():
+        return list(encoding_pool.map(convert.get_encoding_type, paths))
+
+def convert_to_cache(media_dir, srt_subpath, encoding = None, verbose = False):
+    srt_path = os.path.join(media_dir, srt_subpath)
+    stat = os.stat(srt_path)
+    vtt_path = os.path.join(SUBTITLE_CACHE_DIR, f"{cache_key(srt_subpath, stat)}.vtt")
+
+    if os.path.exists(vtt_path):
+        return vtt_path
+
+    start = time.perf_counter()
+    encoding = encoding or convert.get_encoding_type(srt_path)
+    if not encoding:
+        log.warning("unable to detect encoding of '%s'", srt_path)
+        conversions.inc(result="unknown_encoding")
+        return None
+
+    # write to a temp file in the cache directory and rename it into place,
+    # so concurrent conversions (e.g. from different workers) never see half-written files
+    os.makedirs(SUBTITLE_CACHE_DIR, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(suffix=".tmp", dir=SUBTITLE_CACHE_DIR)
+    os.close(fd)
+
+    try:
+        if not convert.srt_to_vtt(srt_path, temp_path, verbose = verbose, encoding = encoding):
+            conversions.inc(result="failed")
+            return None
+        os.replace(temp_path, vtt_path)
+        conversions.inc(result="ok")
+        conversion_seconds.observe(time.perf_counter() - start)
+        return vtt_path
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+def queue_conversion(media_dir, srt_subpath, encoding = None):
+    # convert in the background, ignoring files that are already queued
+    # encoding is detected if not given
+    with queued_lock:
+        if srt_subpath in queued:
+            return
+        queued.add(srt_subpath)
+
+    def run():
+        try:
+            convert_to_cache(media_dir, srt_subpath, encoding = encoding)
+        except Exception:
+            log.exception("subtitle conversion failed for '%s'", srt_subpath)
+        finally:
+            with queued_lock:
+                queued.discard(srt_subpath)
+
+    executor.submit(run)
@@ -0,0 +1,183 @@
+# uploads.py
+# resumable chunked uploads: chunks are streamed straight into a hidden part file
+# in the target folder, which is linked into place once the upload is finalized
+
+import os
+import json
+import time
+import uuid
+import errno
+import hashlib
+import logging
+import threading
+
+from config import UPLOAD_STATE_DIR, UPLOAD_BUFFER_SIZE
+
+MAX_HASHERS = 16 # uploads per worker whose sha256 is kept up to date as chunks arrive
+
+log = logging.getLogger(__name__)
+
+hashers = {} # upload_id -> (bytes hashed, sha256) of the part file, in this worker
+hashers_lock = threading.Lock()
+
+class UploadError(Exception):
+    def __init__(self, message, status = 400, **extra):
+        super().__init__(message)
+        self.status = status
+        self.extra = extra # additional fields for the json response
+
+def state_path(upload_id):
+    return os.path.join(UPLOAD_STATE_DIR, f"{upload_id}.json")
+
+def save_state(upload):
+    # write to a temp file and rename, so other workers never read half-written state
+    temp_path = state_path(upload["upload_id"]) + ".tmp"
+    with open(temp_path, "w") as fp:
+        json.dump(upload, fp)
+    os.replace(temp_path, state_path(upload["upload_id"]))
+
+def create_upload(media_dir, folder, filename, size):
+    final_path = os.path.join(media_dir, folder, filename)
+    if os.path.exists(final_path):
+        raise UploadError(f"File '{filename}' already exists.", 409)
+
+    upload_id = uuid.uuid4().hex
+    upload = {
+        "upload_id": upload_id,
+        "folder": folder,
+        "filename": filename,
+        "size": size,
+        "part_path": os.path.join(media_dir, folder, f".{upload_id}.part"),
+        "final_path": final_path,
+    }
+
+    os.makedirs(UPLOAD_STATE_DIR, exist_ok=True)
+    open(upload["part_path"], "wb").close()
+    save_state(upload)
+    return upload
+
+def load_upload(upload_id):
+    try:
+        uuid.UUID(hex=upload_id) # don't let ids escape the state directory
+        with open(state_path(upload_id)) as fp:
+            return json.load(fp)
+    except (ValueError, FileNotFoundError):
+        raise UploadError("Unknown upload", 404)
+
+def get_offset(upload):
+    # bytes received so far, where the next chunk has to start
+    return os.path.getsize(upload["part_path"])
+
+def take_hasher(upload, offset):
+    # sha256 of the first offset bytes of the part file, for the caller alone until put_hasher()
+    # chunks written by other workers are read back from the file
+    with hashers_lock:
+        hashed, sha256 = hashers.pop(upload["upload_id"], (0, None))
+    if sha256 is None or hashed > offset:
+        hashed, sha256 = 0, hashlib.sha256()
+
+    with open(upload["part_path"], "rb") as fp:
+        fp.seek(hashed)
+        while hashed < offset:
+            data = fp.read(min(UPLOAD_BUFFER_SIZE, offset - hashed))
+            if not data:
+                break
+            sha256.update(data)
+            hashed += len(data)
+    return sha256
+
+def put_hasher(upload, offset, sha256):
+    with hashers_lock:
+        hashers[upload["upload_id"]] = (offset, sha256)
+        if len(hashers) > MAX_HASHERS: # e.g. uploads finalized by other workers
+            del hashers[next(iter(hashers))]
+
+def write_chunk(upload, offset, stream):
+    # append a chunk read from stream (e.g. request.stream) without buffering it in memory,
+    # hashing it on the way so finalizing doesn't have to read the whole file again
+    current = get_offset(upload)
+    if offset != current:
+        raise UploadError("Chunk does not start at the current offset", 409, offset=current)
+
+    sha256 = take_hasher(upload, offset)
+    with open(upload["part_path"], "r+b") as part:
+        part.seek(offset)
+        while True:
+            data = stream.read(UPLOAD_BUFFER_SIZE)
+            if not data:
+                break
+            if part.tell() + len(data) > upload["size"]:
+                part.truncate(offset) # drop the whole chunk (and its hash), the client can retry it
+                raise UploadError("Chunk goes past the announced file size", 413, offset=offset)
+            part.write(data)
+            sha256.update(data)
+
+        put_hasher(upload, part.tell(), sha256)
+        return part.tell()
+
+def finalize_upload(upload, sha256 = None):
+    # checks the upload is complete and moves it into place, returns the final path
+    offset = get_offset(upload)
+    if offset != upload["size"]:
+        raise UploadError("Upload is incomplete", 409, offset=offset)
+
+    if sha256 and take_hasher(upload, offset).hexdigest() != sha256.lower():
+        discard_upload(upload)
+        raise UploadError("Checksum mismatch, upload discarded", 422)
+
+    try:
+        os.link(upload["part_path"], upload["final_path"]) # unlike rename, fails if another upload got there first
+    except FileExistsError:
+        raise UploadError(f"File '{upload['filename']}' already exists.", 409)
+    except OSError as e:
+        if e.errno not in (errno.EPERM, errno.EOPNOTSUPP): # filesystems without hard links, e.g. exfat
+            raise
+        if os.path.exists(upload["final_path"]):
+            raise UploadError(f"File '{upload['filename']}' already exists.", 409)
+        os.rename(upload["part_path"], upload["final_path"])
+
+    discard_upload(upload)
+    return upload["final_path"]
+
+def discard_upload(upload):
+    with hashers_lock:
+        hashers.pop(upload["upload_id"], None)
+    for path in (upload["part_path"], state_path(upload["upload_id"])):
+        if os.path.exists(path):
+            os.remove(path)
+
+def expire_uploads(max_age):
+    # discard uploads that haven't received a chunk in max_age seconds, returns how many
+    now = time.time()
+    try:
+        entries = list(os.scandir(UPLOAD_STATE_DIR))
+    except FileNotFoundError:
+        return 0
+
+    expired = 0
+    for entry in entries:
+        try:
+            try:
+                with open(entry.path) as fp:
+                    upload = json.load(fp)
+                last_chunk = os.path.getmtime(upload["part_path"])
+            except FileNotFoundError: # finalized meanwhile, or state without a part file
+                last_chunk = 0
+            except (ValueError, KeyError, TypeError): # left half-written (.tmp) or damaged, there is no part file to find
+                upload = None
+                last_chunk = 0
+
+            if now - max(last_chunk, entry.stat().st_mtime) < max_age:
+                continue
+
+            if upload:
+                discard_upload(upload)
+                log.info("discarded upload of '%s', no chunks for %d hours", upload["filename"], max_age // 3600)
+            else:
+                os.remove(entry.path)
+            expired += 1
+        except FileNotFoundError:
+            pass # finalized or discarded meanwhile
+        except OSError as e:
+            log.warning("couldn't check upload state '%s': %s", entry.name, e)
+    return expired
@@ -16,15 +16,57 @@ def ensure_file(path_str):
     path.parent.mkdir(parents=True, exist_ok=True)
     path.touch(exist_ok=True)
 
+def get_worker_class():
+    worker_class = config.WSGI_WORKER_CLASS
+    if worker_class == "gevent":
+        try:
+            import gevent
+        except ImportError:
+            print("gevent is not installed, using gthread workers instead")
+            worker_class = "gthread"
+    return worker_class
+
+def get_worker_counts(worker_class):
+    # returns (workers, threads per worker), sized from the cpu count unless set in config.py
+    cpus = os.cpu_count() or 1
+
+    if worker_class == "sync":
+        workers, threads = 2 * cpus + 1, 1
+    elif worker_class == "gthread":
+        # threads cover slow clients (uploads, seeking), processes cover cpu-bound work
+        workers, threads = cpus + 1, 4
+    else:
+        # gevent: one process per cpu, concurrency comes from greenlets
+        workers, threads = cpus, 1
+
+    return config.WSGI_WORKERS or workers, config.WSGI_THREADS or threads
+
 ensure_file(access_logfile)
 ensure_file(error_logfile)
 
-os.execvp("gunicorn", [
+worker_class = get_worker_class()
+workers, threads = get_worker_counts(worker_class)
+
+args = [
     "gunicorn",
     f"--bind={host}:{port}",
     f"--access-logfile={access_logfile}",
     f"--error-logfile={error_logfile}",
     f"--capture-output",
-    "--timeout=120",  
-    "app:app"
-])
+    f"--timeout={config.WSGI_TIMEOUT}",
+    f"--worker-class={worker_class}",
+    f"--workers={workers}",
+]
+
+if worker_class == "gthread":
+    args.append(f"--threads={threads}")
+
+if config.WSGI_PRELOAD:
+    args.append("--preload")
+
+args.append("app:app")
+
+os.environ["WSGI_WORKERS"] = str(workers) # the app picks its progress store by it, see PROGRESS_STORE in config.py
+
+print(f"starting gunicorn: {workers} {worker_class} worker(s), {threads} thread(s) each")
+os.execvp("gunicorn", args)
@@ -0,0 +1,104 @@
+# benchmark: listing a large folder with per-file queries (old index() loop)
+# vs. the bulk helpers in database.py
+#
+# usage: python bench/folder_queries.py [--files 5000] [--watched 2500]
+
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+from flask import Flask
+from sqlalchemy import event
+
+from database import (db, User, Media, user_watched, create_media_object,
+                      get_media_by_subpaths, get_folder_media, bulk_create_media, get_watched_ids)
+
+FOLDER = "Shows/Synthetic"
+
+class QueryCounter:
+    def __init__(self, engine):
+        self.count = 0
+        event.listen(engine, "before_cursor_execute", self.on_execute)
+
+    def on_execute(self, *args):
+        self.count += 1
+
+def make_app():
+    app = Flask(__name__)
+    app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite://"
+    db.init_app(app)
+    return app
+
+def list_per_file(filenames, subtitle_basenames, user):
+    # the original index() loop: one SELECT per file, linear watched lookups
+    media_list = []
+    for filename in filenames:
+        subpath = os.path.join(FOLDER, filename)
+        media = Media.query.filter_by(subpath=subpath).first()
+        if not media:
+            media = create_media_object(filename, subpath, subtitle_basenames)
+            db.session.add(media)
+        media_list.append(media)
+    db.session.commit()
+
+    watched_media = [media for media in user.watched_media]
+    return [media for media in media_list if not media in watched_media]
+
+def list_bulk(filenames, subtitle_basenames, user):
+    existing = get_media_by_subpaths(os.path.join(FOLDER, filename) for filename in filenames)
+    new_filenames = [filename for filename in filenames if os.path.join(FOLDER, filename) not in existing]
+    bulk_create_media(FOLDER, new_filenames, subtitle_basenames)
+    db.session.commit()
+
+    media_list = get_folder_media(FOLDER)
+
+    watched_ids = get_watched_ids(user.user_id)
+    return [media for media in media_list if media.media_id not in watched_ids]
+
+def run(app, counter, label, fn, filenames, subtitle_basenames, n_watched):
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        user = User(username="bench", password_hash="x")
+        db.session.add(user)
+        db.session.commit()
+
+        results = []
+        for phase in ("cold", "warm"):
+            if phase == "warm":
+                # mark some media as watched between the first and second listing
+                ids = [media_id for (media_id,) in db.session.query(Media.media_id).limit(n_watched)]
+                db.session.execute(user_watched.insert(), [{"user_id": user.user_id, "media_id": i} for i in ids])
+                db.session.commit()
+                db.session.expire_all()
+
+            counter.count = 0
+            start = time.perf_counter()
+            unwatched = fn(filenames, subtitle_basenames, user)
+            elapsed = time.perf_counter() - start
+            results.append((phase, counter.count, elapsed, len(unwatched)))
+
+        for phase, queries, elapsed, n in results:
+            print(f"{label:<10} {phase:<5} queries={queries:<6} time={elapsed * 1000:9.1f} ms  unwatched={n}")
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--files", type=int, default=5000)
+    parser.add_argument("--watched", type=int, default=2500)
+    args = parser.parse_args()
+
+    filenames = [f"Episode {i:05d}.mp4" for i in range(args.files)]
+    subtitle_basenames = {f"Episode {i:05d}" for i in range(0, args.files, 2)}
+
+    app = make_app()
+    with app.app_context():
+        counter = QueryCounter(db.engine)
+
+    run(app, counter, "per-file", list_per_file, filenames, subtitle_basenames, args.watched)
+    run(app, counter, "bulk", list_bulk, filenames, subtitle_basenames, args.watched)
+
+if __name__ == "__main__":
+    main()
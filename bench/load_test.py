@@ -0,0 +1,104 @@
+# load test: starts the app through wsgi_launcher.py against a synthetic media library
+# and measures throughput for increasing worker counts
+#
+# usage: python bench/load_test.py [--workers 1 2 4] [--clients 16] [--seconds 10]
+
+import os
+import sys
+import time
+import signal
+import argparse
+import tempfile
+import threading
+import subprocess
+import urllib.request
+from urllib.parse import quote
+
+APP_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "app"))
+PORT = 8765
+
+def make_media_dir(root, shows, episodes):
+    media_dir = os.path.join(root, "media")
+    for i in range(shows):
+        show = os.path.join(media_dir, f"Show {i:03d}")
+        os.makedirs(show)
+        for j in range(episodes):
+            open(os.path.join(show, f"Episode {j:04d}.mp4"), "w").close()
+    return media_dir
+
+def wait_until_up(url, timeout = 60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            urllib.request.urlopen(url, timeout=1).read()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError("server did not start")
+
+def client(urls, deadline, counts, latencies, index):
+    i = index
+    while time.time() < deadline:
+        url = urls[i % len(urls)]
+        i += 1
+        start = time.perf_counter()
+        try:
+            urllib.request.urlopen(url, timeout=30).read()
+            counts[index] += 1
+            latencies.append(time.perf_counter() - start)
+        except OSError:
+            pass
+
+def run(workers, args, root, media_dir):
+    env = dict(os.environ,
+               MEDIA_DIR=media_dir,
+               DATABASE_URI=f"sqlite:///{os.path.join(root, f'load-{workers}.db')}",
+               SECRET_KEY="bench", ADMIN_USERNAME="admin", ADMIN_PASSWORD="admin",
+               WSGI_PORT=str(PORT), WSGI_WORKERS=str(workers), WSGI_WORKER_CLASS=args.worker_class,
+               ACCESS_LOGFILE=os.path.join(root, "access.log"), ERROR_LOGFILE=os.path.join(root, "error.log"))
+
+    server = subprocess.Popen([sys.executable, "wsgi_launcher.py"], cwd=APP_DIR, env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        base = f"http://127.0.0.1:{PORT}"
+        wait_until_up(base + "/")
+        urls = [base + "/"] + [f"{base}/{quote(f'Show {i:03d}')}" for i in range(args.shows)]
+
+        counts = [0] * args.clients
+        latencies = []
+        deadline = time.time() + args.seconds
+        threads = [threading.Thread(target=client, args=(urls, deadline, counts, latencies, i))
+                   for i in range(args.clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        latencies.sort()
+        p50 = latencies[len(latencies) // 2] if latencies else float("nan")
+        p99 = latencies[int(len(latencies) * 0.99)] if latencies else float("nan")
+        print(f"workers={workers:<3} requests={sum(counts):<7} req/s={sum(counts) / args.seconds:8.1f}  "
+              f"p50={p50 * 1000:7.1f} ms  p99={p99 * 1000:7.1f} ms")
+    finally:
+        server.send_signal(signal.SIGTERM)
+        server.wait()
+
+def main():
+    cpus = os.cpu_count() or 1
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, nargs="+", default=sorted({1, max(1, cpus // 2), cpus, cpus + 1}))
+    parser.add_argument("--worker-class", default="gthread")
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--shows", type=int, default=20)
+    parser.add_argument("--episodes", type=int, default=200)
+    args = parser.parse_args()
+
+    print(f"{cpus} cpu(s), {args.worker_class} workers, {args.clients} clients")
+    with tempfile.TemporaryDirectory() as root:
+        media_dir = make_media_dir(root, args.shows, args.episodes)
+        for workers in args.workers:
+            run(workers, args, root, media_dir)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+# benchmark: sustained progress heartbeat throughput from many request threads, comparing
+#   orm    - one ORM transaction per heartbeat (the original /progress path)
+#   buffer - ProgressBuffer, batched upserts every PROGRESS_FLUSH_INTERVAL
+#   log    - EventLog, group-committed appends to the event log (+ fsync) and compaction
+# the time to write the buffered/logged state to the database at the end is reported separately
+#
+# usage: python bench/progress_store.py [--threads 16] [--seconds 5] [--users 200]
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+import threading
+import statistics
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+from flask import Flask
+
+from database import db, tune_sqlite, User, Media, MediaProgress
+from progress_buffer import ProgressBuffer
+from event_log import EventLog
+
+MEDIA = 1000
+
+def make_app(tmp):
+    app = Flask(__name__)
+    app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{os.path.join(tmp, 'bench.db')}"
+    db.init_app(app)
+    return app
+
+def seed(app, users):
+    with app.app_context():
+        tune_sqlite(db.engine)
+        db.create_all()
+        db.session.bulk_save_objects([User(username=f"user{i}", password_hash="x") for i in range(users)])
+        db.session.bulk_save_objects([Media(filename=f"ep{i}.mp4", subpath=f"show/ep{i}.mp4", folder="show", is_video=True)
+                                      for i in range(MEDIA)])
+        db.session.commit()
+
+def orm_heartbeat(user_id, media_id, position):
+    row = MediaProgress.query.filter_by(user_id=user_id, media_id=media_id).first()
+    if row:
+        row.position_seconds = position
+    else:
+        db.session.add(MediaProgress(user_id=user_id, media_id=media_id, position_seconds=position))
+    db.session.commit()
+
+def worker(app, heartbeat, seconds, offset, users, latencies):
+    deadline = time.time() + seconds
+    i = offset
+    with app.app_context():
+        while time.time() < deadline:
+            i += 1
+            start = time.perf_counter()
+            heartbeat(i % users + 1, i % MEDIA + 1, float(i))
+            latencies.append(time.perf_counter() - start)
+        db.session.remove()
+
+def run(name, args):
+    with tempfile.TemporaryDirectory() as tmp:
+        app = make_app(tmp)
+        seed(app, args.users)
+
+        if name == "orm":
+            store = None
+            heartbeat = orm_heartbeat
+        elif name == "buffer":
+            store = ProgressBuffer()
+            heartbeat = store.set
+        else:
+            store = EventLog(os.path.join(tmp, "event-log"))
+            heartbeat = store.set
+        if store:
+            store.start(app, 1)
+
+        latencies = [[] for _ in range(args.threads)]
+        threads = [threading.Thread(target=worker, args=(app, heartbeat, args.seconds, i * 7919, args.users, latencies[i]))
+                   for i in range(args.threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        start = time.perf_counter()
+        with app.app_context():
+            if name == "buffer":
+                store.flush()
+            elif name == "log":
+                store.compact()
+            rows = MediaProgress.query.count()
+        settle = time.perf_counter() - start
+
+        values = sorted(value for thread_values in latencies for value in thread_values)
+        p99 = values[int(len(values) * 0.99)] if values else 0
+        print(f"{name:<7} heartbeats={len(values):<8} per s={len(values) / args.seconds:9.1f}  "
+              f"p50={statistics.median(values) * 1000:7.2f} ms  p99={p99 * 1000:7.2f} ms  "
+              f"final write={settle * 1000:7.1f} ms  rows={rows}")
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--users", type=int, default=200)
+    args = parser.parse_args()
+
+    for name in ("orm", "buffer", "log"):
+        run(name, args)
+
+if __name__ == "__main__":
+    main()
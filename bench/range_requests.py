@@ -0,0 +1,100 @@
+# benchmark: seek-heavy Range requests against /media/, comparing MEDIA_DELIVERY modes
+# ("flask" = send_from_directory, "direct" = media_delivery.py with sendfile)
+#
+# usage: python bench/range_requests.py [--size-mb 512] [--chunk-kb 2048] [--clients 8] [--seconds 10]
+
+import os
+import sys
+import time
+import random
+import signal
+import argparse
+import tempfile
+import threading
+import subprocess
+import urllib.request
+
+APP_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "app"))
+PORT = 8766
+
+def make_media_dir(root, size):
+    media_dir = os.path.join(root, "media")
+    os.makedirs(media_dir)
+    path = os.path.join(media_dir, "movie.mp4")
+    block = os.urandom(1024 * 1024)
+    with open(path, "wb") as fp:
+        for _ in range(size // len(block)):
+            fp.write(block)
+    return media_dir, path
+
+def wait_until_up(url, timeout = 60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            urllib.request.urlopen(url, timeout=1).read()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError("server did not start")
+
+def client(url, size, chunk, deadline, results, expected):
+    rng = random.Random()
+    count = received = 0
+    while time.time() < deadline:
+        start = rng.randrange(0, size - chunk)
+        request = urllib.request.Request(url, headers={"Range": f"bytes={start}-{start + chunk - 1}"})
+        data = urllib.request.urlopen(request, timeout=30).read()
+        if data != expected[start:start + chunk]:
+            raise RuntimeError("wrong bytes returned")
+        count += 1
+        received += len(data)
+    results.append((count, received))
+
+def run(mode, args, root, media_dir, path):
+    env = dict(os.environ,
+               MEDIA_DIR=media_dir, MEDIA_DELIVERY=mode,
+               DATABASE_URI=f"sqlite:///{os.path.join(root, f'range-{mode}.db')}",
+               SECRET_KEY="bench", ADMIN_USERNAME="admin", ADMIN_PASSWORD="admin",
+               WSGI_PORT=str(PORT), ACCESS_LOGFILE=os.path.join(root, "access.log"),
+               ERROR_LOGFILE=os.path.join(root, "error.log"))
+
+    with open(path, "rb") as fp:
+        expected = fp.read()
+
+    server = subprocess.Popen([sys.executable, "wsgi_launcher.py"], cwd=APP_DIR, env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_until_up(f"http://127.0.0.1:{PORT}/")
+        url = f"http://127.0.0.1:{PORT}/media/movie.mp4"
+        results = []
+        deadline = time.time() + args.seconds
+        threads = [threading.Thread(target=client, args=(url, len(expected), args.chunk_kb * 1024, deadline, results, expected))
+                   for _ in range(args.clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        count = sum(c for c, _ in results)
+        received = sum(r for _, r in results)
+        print(f"{mode:<7} requests={count:<6} req/s={count / args.seconds:8.1f}  MB/s={received / 1e6 / args.seconds:8.1f}")
+    finally:
+        server.send_signal(signal.SIGTERM)
+        server.wait()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size-mb", type=int, default=512)
+    parser.add_argument("--chunk-kb", type=int, default=2048)
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--modes", nargs="+", default=["flask", "direct"])
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as root:
+        media_dir, path = make_media_dir(root, args.size_mb * 1024 * 1024)
+        for mode in args.modes:
+            run(mode, args, root, media_dir, path)
+
+if __name__ == "__main__":
+    main()
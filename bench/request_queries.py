@@ -0,0 +1,57 @@
+# counts SQL queries per request for the main routes, using the flask test client
+#
+# usage: python bench/request_queries.py
+
+import os
+import sys
+import tempfile
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app")
+sys.path.insert(0, APP_DIR)
+
+def make_media_dir(root):
+    media_dir = os.path.join(root, "media")
+    show = os.path.join(media_dir, "Show")
+    os.makedirs(show)
+    for i in range(50):
+        open(os.path.join(show, f"Episode {i:02d}.mp4"), "w").close()
+    return media_dir
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["MEDIA_DIR"] = make_media_dir(tmp)
+        os.environ["DATABASE_URI"] = f"sqlite:///{os.path.join(tmp, 'bench.db')}"
+        os.environ.setdefault("SECRET_KEY", "bench")
+        os.environ.setdefault("ADMIN_USERNAME", "admin")
+        os.environ.setdefault("ADMIN_PASSWORD", "admin")
+        os.chdir(tmp)
+
+        from sqlalchemy import event
+        from app import app, db, Media
+
+        queries = []
+        with app.app_context():
+            event.listen(db.engine, "before_cursor_execute", lambda *args: queries.append(args[2]))
+            media_id = Media.query.filter_by(folder="Show").first().media_id
+
+        client = app.test_client()
+        client.post("/login", data={"username": os.environ["ADMIN_USERNAME"], "password": os.environ["ADMIN_PASSWORD"]})
+
+        requests = [
+            ("GET", "/", None),
+            ("GET", "/Show", None),
+            ("GET", "/Show?unwatched=true", None),
+            ("GET", "/upload", None),
+            ("POST", "/toggle_watched", {"media_id": media_id}),
+            ("POST", f"/progress/{media_id}", {"position": 42}),
+            ("GET", f"/progress/{media_id}", None),
+            ("GET", "/play/Show/Episode 00.mp4", None),
+        ]
+
+        for method, url, body in requests:
+            queries.clear()
+            response = client.open(url, method=method, json=body)
+            print(f"{method:<5} {url:<32} status={response.status_code}  queries={len(queries)}")
+
+if __name__ == "__main__":
+    main()
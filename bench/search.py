@@ -0,0 +1,75 @@
+# benchmark: /api/search query latency on a synthetic library, FTS5 index vs. LIKE fallback
+#
+# usage: python bench/search.py [--rows 100000] [--repeat 50]
+
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+import statistics
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+from flask import Flask
+from sqlalchemy import text
+
+import search
+from database import db, migrate, tune_sqlite
+
+WORDS = ["breaking", "bad", "the", "office", "planet", "earth", "star", "trek", "lost", "wire",
+         "house", "dragon", "crown", "dark", "fargo", "mad", "men", "sopranos", "twin", "peaks"]
+
+QUERIES = ["breaking bad", "plan", "star trek s02", "the office e1", "dark", "zzz"]
+
+def seed(rows):
+    rng = random.Random(0)
+    batch = []
+    for i in range(rows):
+        title = " ".join(rng.choice(WORDS) for _ in range(2)).title()
+        folder = f"{title}/Season {i % 7 + 1:02d}"
+        filename = f"{title.replace(' ', '.')}.S{i % 7 + 1:02d}E{i % 24 + 1:02d}.{i}.{'mp4' if i % 3 else 'mkv'}"
+        batch.append({"f": filename, "s": f"{folder}/{filename}", "d": folder})
+
+    db.session.execute(text("INSERT INTO media (filename, subpath, folder, is_video, is_book, has_subtitles, present) "
+                            "VALUES (:f, :s, :d, 1, 0, 0, 1)"), batch)
+    db.session.commit()
+
+def measure(label, repeat):
+    for query in QUERIES:
+        latencies = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            results, _ = search.search_media(query, limit=50)
+            latencies.append(time.perf_counter() - start)
+        print(f"{label:<5} {query!r:<18} results={len(results):<3} "
+              f"p50={statistics.median(latencies) * 1000:8.2f} ms  max={max(latencies) * 1000:8.2f} ms")
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        app = Flask(__name__)
+        app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{os.path.join(tmp, 'search.db')}"
+        db.init_app(app)
+
+        with app.app_context():
+            tune_sqlite(db.engine)
+            db.create_all()
+            migrate()
+
+            start = time.perf_counter()
+            search.create_search_index()
+            seed(args.rows)
+            print(f"seeded {args.rows} rows (with FTS triggers) in {time.perf_counter() - start:.1f}s")
+
+            measure("fts", args.repeat)
+            search.fts_available = False
+            measure("like", args.repeat)
+
+if __name__ == "__main__":
+    main()
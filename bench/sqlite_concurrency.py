@@ -0,0 +1,126 @@
+# benchmark: N readers running the index() queries while M writers save progress heartbeats,
+# with sqlite defaults vs. the pragmas from database.tune_sqlite()
+#
+# usage: python bench/sqlite_concurrency.py [--readers 8] [--writers 4] [--seconds 5]
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+import statistics
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+from sqlalchemy import create_engine, event, text
+
+from database import db, set_sqlite_pragmas, MIGRATION_INDEXES
+
+FOLDERS = 20
+FILES_PER_FOLDER = 500
+USERS = 50
+
+def make_engine(path, tuned):
+    engine = create_engine(f"sqlite:///{path}", connect_args={"timeout": 30})
+    if tuned:
+        event.listen(engine, "connect", set_sqlite_pragmas)
+    return engine
+
+def seed(path, tuned):
+    engine = make_engine(path, tuned)
+    db.metadata.create_all(engine)
+
+    with engine.begin() as conn:
+        for name, target in MIGRATION_INDEXES.items():
+            conn.execute(text(f"CREATE INDEX IF NOT EXISTS {name} ON {target}"))
+        conn.execute(text("INSERT INTO user (username, password_hash, is_admin) VALUES (:u, 'x', 0)"),
+                     [{"u": f"user{i}"} for i in range(USERS)])
+        conn.execute(text("INSERT INTO media (filename, subpath, folder, is_video, is_book, has_subtitles, present) "
+                          "VALUES (:f, :s, :d, 1, 0, 0, 1)"),
+                     [{"f": f"ep{j}.mp4", "s": f"show{i}/ep{j}.mp4", "d": f"show{i}"}
+                      for i in range(FOLDERS) for j in range(FILES_PER_FOLDER)])
+        conn.execute(text("INSERT INTO user_watched (user_id, media_id) VALUES (:u, :m)"),
+                     [{"u": u, "m": m} for u in range(1, USERS + 1) for m in range(1, 2000, 7)])
+    engine.dispose()
+
+def reader(path, tuned, seconds, seed_value, results):
+    engine = make_engine(path, tuned)
+    latencies = []
+    deadline = time.time() + seconds
+    i = seed_value
+
+    while time.time() < deadline:
+        i += 1
+        start = time.perf_counter()
+        with engine.connect() as conn:
+            conn.execute(text("SELECT * FROM media WHERE folder = :f AND present = 1"), {"f": f"show{i % FOLDERS}"}).fetchall()
+            conn.execute(text("SELECT media_id FROM user_watched WHERE user_id = :u"), {"u": i % USERS + 1}).fetchall()
+        latencies.append(time.perf_counter() - start)
+
+    results.put(("read", latencies))
+
+def writer(path, tuned, seconds, seed_value, results):
+    # one transaction per heartbeat, like the unbuffered /progress path
+    engine = make_engine(path, tuned)
+    latencies = []
+    deadline = time.time() + seconds
+    i = seed_value
+
+    while time.time() < deadline:
+        i += 1
+        start = time.perf_counter()
+        with engine.begin() as conn:
+            conn.execute(text("INSERT INTO media_progress (user_id, media_id, position_seconds, updated_at) "
+                              "VALUES (:u, :m, :p, :t) ON CONFLICT (user_id, media_id) "
+                              "DO UPDATE SET position_seconds = excluded.position_seconds, updated_at = excluded.updated_at"),
+                         {"u": i % USERS + 1, "m": i % 1000 + 1, "p": float(i), "t": time.time()})
+        latencies.append(time.perf_counter() - start)
+        time.sleep(0.001)
+
+    results.put(("write", latencies))
+
+def percentile(values, p):
+    if not values:
+        return float("nan")
+    return statistics.quantiles(values, n=100)[p - 1] if len(values) > 1 else values[0]
+
+def run(tuned, args):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.db")
+        seed(path, tuned)
+
+        results = multiprocessing.Queue()
+        processes = [multiprocessing.Process(target=reader, args=(path, tuned, args.seconds, i * 1000, results))
+                     for i in range(args.readers)]
+        processes += [multiprocessing.Process(target=writer, args=(path, tuned, args.seconds, i * 1000, results))
+                      for i in range(args.writers)]
+
+        for process in processes:
+            process.start()
+
+        latencies = {"read": [], "write": []}
+        for _ in processes:
+            kind, values = results.get()
+            latencies[kind].extend(values)
+
+        for process in processes:
+            process.join()
+
+    label = "tuned" if tuned else "default"
+    for kind, values in latencies.items():
+        print(f"{label:<8} {kind:<6} ops={len(values):<7} ops/s={len(values) / args.seconds:9.1f}  "
+              f"p50={percentile(values, 50) * 1000:7.2f} ms  p99={percentile(values, 99) * 1000:7.2f} ms")
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--readers", type=int, default=8)
+    parser.add_argument("--writers", type=int, default=4)
+    parser.add_argument("--seconds", type=float, default=5)
+    args = parser.parse_args()
+
+    run(False, args)
+    run(True, args)
+
+if __name__ == "__main__":
+    main()
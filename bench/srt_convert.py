@@ -0,0 +1,99 @@
+# micro-benchmark: streaming srt -> vtt conversion in convert.py
+# vs. the previous implementation (three full reads, per-line uncompiled regexes)
+#
+# usage: python bench/srt_convert.py [--cues 10000 50000]
+
+import io
+import os
+import re
+import sys
+import time
+import argparse
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+from chardet import detect
+
+import convert
+
+def write_srt(path, cues, encoding):
+    with open(path, "w", encoding=encoding) as f:
+        for i in range(1, cues + 1):
+            start = i * 2
+            f.write(f"{i}\n")
+            f.write(f"{start // 3600:02d}:{start // 60 % 60:02d}:{start % 60:02d},000 --> "
+                    f"{start // 3600:02d}:{start // 60 % 60:02d}:{start % 60:02d},900\n")
+            f.write(f"Line {i} with some text, café\n{i}\n\n")
+
+def legacy_convert(srt_file, vtt_file):
+    # previous convert.get_encoding_type + is_srt + srt_to_vtt, without the in-place rewrite
+    with open(srt_file, 'rb') as f:
+        encoding = detect(f.read())['encoding']
+
+    with open(srt_file, 'r', encoding=encoding) as file:
+        content = file.read()
+    if not re.search(r"\d+\n\d{2}:\d{2}:\d{2},\d{3} --> \d{2}:\d{2}:\d{2},\d{3}", content):
+        return
+
+    with open(srt_file, 'r', encoding=encoding) as srt:
+        lines = srt.readlines()
+
+    with open(vtt_file, 'w', encoding='utf-8') as vtt:
+        vtt.write("WEBVTT\n\n")
+        buffer = []
+        for line in lines:
+            line = line.strip()
+            if re.match(r"^\d+$", line):
+                continue
+            if re.match(r"\d{2}:\d{2}:\d{2},\d{3} --> \d{2}:\d{2}:\d{2},\d{3}", line):
+                line = line.replace(",", ".")
+                if buffer:
+                    vtt.write("\n".join(buffer) + "\n\n")
+                    buffer = []
+            buffer.append(line)
+        if buffer:
+            vtt.write("\n".join(buffer) + "\n\n")
+
+def streaming_convert(srt_file, vtt_file):
+    convert.srt_to_vtt(srt_file, vtt_file, verbose = False)
+
+def streaming_convert_buffer(srt_file, vtt_file):
+    convert.srt_to_vtt(srt_file, io.StringIO(), verbose = False)
+
+def measure(fn, srt_file, vtt_file):
+    start = time.perf_counter()
+    fn(srt_file, vtt_file)
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    fn(srt_file, vtt_file)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--cues", type=int, nargs="+", default=[10000, 50000])
+    args = parser.parse_args()
+
+    implementations = [("legacy", legacy_convert),
+                       ("streaming", streaming_convert),
+                       ("stream->buf", streaming_convert_buffer)]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for cues in args.cues:
+            for encoding in ("utf-8", "cp1252"):
+                srt_file = os.path.join(tmp, f"bench_{cues}_{encoding}.srt")
+                vtt_file = os.path.join(tmp, "out.vtt")
+                write_srt(srt_file, cues, encoding)
+                size_mb = os.path.getsize(srt_file) / 1e6
+
+                for label, fn in implementations:
+                    elapsed, peak = measure(fn, srt_file, vtt_file)
+                    print(f"{cues:>6} cues {encoding:<6} ({size_mb:5.1f} MB)  {label:<11} "
+                          f"time={elapsed * 1000:8.1f} ms  peak={peak / 1e6:6.2f} MB")
+
+if __name__ == "__main__":
+    main()
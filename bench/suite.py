@@ -0,0 +1,583 @@
+# end-to-end benchmark suite: generates a synthetic library (see synthetic_library.py), seeds users,
+# watched flags and progress, then runs each scenario against the app through the flask test client
+# (a fresh process per scenario, so peak RSS is per scenario) and through a real gunicorn server
+# started by wsgi_launcher.py
+#
+# reports latency percentiles, SQL queries per operation and peak RSS per scenario, and writes them
+# as JSON; --compare prints the changes against an earlier run and exits with 1 on regressions
+#
+# usage: python bench/suite.py [--preset medium] [--modes client gunicorn] [--scenarios index_big_folder ...]
+#                              [--requests 200] [--root DIR] [--output results.json] [--compare baseline.json]
+#
+# --root keeps the library and database between runs, so runs on different commits see the same data
+
+import io
+import os
+import sys
+import json
+import time
+import random
+import signal
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+import http.cookiejar
+import urllib.error
+import urllib.request
+from collections import namedtuple
+from urllib.parse import quote, urlencode
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.join(BENCH_DIR, "..", "app")
+
+import synthetic_library
+
+sys.path.insert(0, APP_DIR) # ahead of bench/, whose search.py would shadow the app's
+
+PORT = 8767
+ADMIN_USERNAME = "admin"
+ADMIN_PASSWORD = "bench-password"
+METRICS_TOKEN = "bench"
+METRICS_WRITE_INTERVAL = 5 # config.METRICS_WRITE_INTERVAL, gunicorn workers' query counts lag by up to this
+
+# scenarios
+
+def index_root(client, library, i, state):
+    return client.request("GET", "/")
+
+def index_big_folder(client, library, i, state):
+    return client.request("GET", "/" + quote(library["big_folder"]))
+
+def index_deep_folder(client, library, i, state):
+    return client.request("GET", "/" + quote(library["deep_folder"]))
+
+def index_unwatched(client, library, i, state):
+    return client.request("GET", "/" + quote(library["big_folder"]) + "?unwatched=true")
+
+def api_list_pages(client, library, i, state):
+    # pages through the big folder, starting over after the last page
+    url = "/api/list/" + quote(library["big_folder"])
+    if state.get("cursor"):
+        url += "?" + urlencode({"cursor": state["cursor"]})
+    status, data = client.request("GET", url)
+    state["cursor"] = json.loads(data).get("next_cursor") if status == 200 else None
+    return status, data
+
+def play_with_subtitles(client, library, i, state):
+    # get_subtitle_url() runs on every /play
+    return client.request("GET", "/play/" + quote(library["subtitle_video"]))
+
+def progress_post(client, library, i, state):
+    return client.request("POST", f"/progress/{library['media_id']}", json_body={"position": i * 5.0})
+
+def progress_get(client, library, i, state):
+    return client.request("GET", f"/progress/{library['media_id']}")
+
+def search(client, library, i, state):
+    return client.request("GET", "/api/search?" + urlencode({"q": f"Episode {i % 1000:05d}"}))
+
+def upload_form(client, library, i, state):
+    # /upload with a small file, into the top of MEDIA_DIR (rescanning it) like the form does
+    filename = f"bench-form-{state['prefix']}-{i}.mp4"
+    return client.request("POST", "/upload", form={"file": (os.urandom(64 * 1024), filename)})
+
+def upload_chunked(client, library, i, state):
+    # start, one chunk and finalize through /api/uploads
+    data = os.urandom(256 * 1024)
+    filename = f"bench-chunked-{state['prefix']}-{i}.mp4"
+    status, response = client.request("POST", "/api/uploads", json_body={"filename": filename, "folder": library["upload_folder"], "size": len(data)})
+    if status != 201:
+        return status, response
+    upload_id = json.loads(response)["upload_id"]
+    status, response = client.request("PUT", f"/api/uploads/{upload_id}?offset=0", body=data)
+    if status != 200:
+        return status, response
+    return client.request("POST", f"/api/uploads/{upload_id}/finalize", json_body={})
+
+def remove_uploads(library):
+    media_dir = library["media_dir"]
+    for folder in (media_dir, os.path.join(media_dir, library["upload_folder"])):
+        for name in os.listdir(folder):
+            if name.startswith("bench-"):
+                os.remove(os.path.join(folder, name))
+
+def disable_listing_cache(server):
+    server.listing_cache.size = 0
+    server.listing_cache.cache_dir = None
+
+# client_only: needs the test client (multipart bodies, or changing the app in process)
+# setup: called with the app module before the scenario runs
+Scenario = namedtuple("Scenario", ["run", "client_only", "setup"], defaults=[False, None])
+
+# uploads add files to MEDIA_DIR, so they run last (and the files are removed after the run)
+SCENARIOS = {
+    "index_root": Scenario(index_root),
+    "index_big_folder": Scenario(index_big_folder),
+    "index_big_folder_uncached": Scenario(index_big_folder, client_only=True, setup=disable_listing_cache),
+    "index_deep_folder": Scenario(index_deep_folder),
+    "index_unwatched": Scenario(index_unwatched),
+    "api_list_pages": Scenario(api_list_pages),
+    "play_with_subtitles": Scenario(play_with_subtitles),
+    "progress_post": Scenario(progress_post),
+    "progress_get": Scenario(progress_get),
+    "search": Scenario(search),
+    "upload_form": Scenario(upload_form, client_only=True),
+    "upload_chunked": Scenario(upload_chunked),
+}
+
+# clients, both return (status, body)
+
+class TestClient:
+    def __init__(self, client):
+        self.client = client
+
+    def request(self, method, url, json_body = None, body = None, form = None):
+        # form values can be (bytes, filename) for file uploads
+        kwargs = {}
+        if json_body is not None:
+            kwargs["json"] = json_body
+        elif form is not None:
+            kwargs["data"] = {key: (io.BytesIO(value[0]), value[1]) if isinstance(value, tuple) else value
+                              for key, value in form.items()}
+        elif body is not None:
+            kwargs["data"] = body
+        response = self.client.open(url, method=method, **kwargs)
+        return response.status_code, response.get_data()
+
+class HTTPClient:
+    def __init__(self, base):
+        self.base = base
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+
+    def request(self, method, url, json_body = None, body = None, form = None):
+        headers = {}
+        if json_body is not None:
+            body = json.dumps(json_body).encode("utf-8")
+            headers["Content-Type"] = "application/json"
+        elif form is not None:
+            body = urlencode(form).encode("utf-8")
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+
+        request = urllib.request.Request(self.base + url, data=body, headers=headers, method=method)
+        try:
+            with self.opener.open(request, timeout=120) as response:
+                return response.status, response.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.read()
+
+def login(client):
+    status, _ = client.request("POST", "/login", form={"username": ADMIN_USERNAME, "password": ADMIN_PASSWORD})
+    if status >= 400:
+        raise RuntimeError(f"login failed with status {status}")
+
+# measurements
+
+def read_status(pid, field):
+    # VmRSS / VmHWM of a process in MB, None where /proc isn't available
+    try:
+        with open(f"/proc/{pid}/status") as fp:
+            for line in fp:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+def reset_peak_rss(pid):
+    # lets VmHWM start over from the current RSS (linux), otherwise it's the peak since the process started
+    try:
+        with open(f"/proc/{pid}/clear_refs", "w") as fp:
+            fp.write("5")
+    except OSError:
+        pass
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def summarize(mode, name, latencies, errors, seconds, queries, rss_start, rss_peak):
+    latencies = sorted(latency * 1000 for latency in latencies)
+    round_ms = lambda value: None if value is None else round(value, 3)
+    return {"mode": mode,
+            "scenario": name,
+            "operations": len(latencies),
+            "errors": errors,
+            "seconds": round(seconds, 3),
+            "ops_per_second": round(len(latencies) / seconds, 1) if seconds else None,
+            "latency_ms": {"mean": round_ms(sum(latencies) / len(latencies)) if latencies else None,
+                           "p50": round_ms(percentile(latencies, 0.5)),
+                           "p90": round_ms(percentile(latencies, 0.9)),
+                           "p95": round_ms(percentile(latencies, 0.95)),
+                           "p99": round_ms(percentile(latencies, 0.99)),
+                           "max": round_ms(latencies[-1] if latencies else None)},
+            "queries_per_operation": None if queries is None else round(queries / max(len(latencies), 1), 2),
+            "rss_start_mb": None if rss_start is None else round(rss_start, 1),
+            "rss_peak_mb": None if rss_peak is None else round(rss_peak, 1)}
+
+def wait_for_scanner(lock_path):
+    # the background scan that starts with the first request holds this lock while it runs
+    time.sleep(0.5)
+    if fcntl and os.path.exists(lock_path):
+        with open(lock_path, "a") as fp:
+            fcntl.flock(fp, fcntl.LOCK_EX)
+            fcntl.flock(fp, fcntl.LOCK_UN)
+
+# library setup, in a process of its own since the app reads its settings on import
+
+def app_env(root):
+    return dict(os.environ,
+                MEDIA_DIR=os.path.join(root, "media"),
+                DATABASE_URI=f"sqlite:///{os.path.join(root, 'bench.db')}",
+                SECRET_KEY="bench", ADMIN_USERNAME=ADMIN_USERNAME, ADMIN_PASSWORD=ADMIN_PASSWORD,
+                METRICS_TOKEN=METRICS_TOKEN, LOG_LEVEL="WARNING",
+                PYTHONPATH=os.pathsep.join(filter(None, [APP_DIR, os.environ.get("PYTHONPATH")])))
+
+def run_self(root, *args):
+    # runs this script in root with the app's environment, returns the JSON it prints last
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), *args, "--root", root],
+                            cwd=root, env=app_env(root), stdout=subprocess.PIPE, check=True).stdout
+    return json.loads(output.decode("utf-8").strip().splitlines()[-1])
+
+def prepare(root, args):
+    # generates and seeds the library once per root, returns its manifest
+    manifest_path = os.path.join(root, "manifest.json")
+    options = dict(synthetic_library.PRESETS[args.preset])
+    options.update({name: getattr(args, name) for name in options if getattr(args, name, None) is not None})
+    options.update(users=args.users, watched_fraction=args.watched_fraction, progress_fraction=args.progress_fraction)
+
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as fp:
+            library = json.load(fp)
+        if library["options"] == options:
+            return library
+        raise SystemExit(f"{root} holds a library made with other options: {library['options']}")
+
+    print(f"generating library in {root}: {options}", file=sys.stderr)
+    start = time.perf_counter()
+    library_options = {name: value for name, value in options.items() if name in synthetic_library.PRESETS["medium"]}
+    library = synthetic_library.generate(os.path.join(root, "media"), **library_options)
+    library["options"] = options
+    with open(manifest_path, "w") as fp:
+        json.dump(library, fp)
+
+    library.update(run_self(root, "--setup"))
+    library["setup_seconds"] = round(time.perf_counter() - start, 1)
+    with open(manifest_path, "w") as fp:
+        json.dump(library, fp)
+    return library
+
+def setup(root):
+    # runs in the app's environment: index and read the library, then seed users, watched flags and progress
+    with open(os.path.join(root, "manifest.json")) as fp:
+        library = json.load(fp)
+    options = library["options"]
+
+    import app as server
+    import subtitles
+    from library import update_metadata
+    from database import db, User, Media, MediaProgress, user_watched
+
+    rng = random.Random(0)
+    with server.app.app_context():
+        update_metadata(server.MEDIA_DIR)
+
+        admin = User.query.filter_by(username=ADMIN_USERNAME).one()
+        db.session.execute(User.__table__.insert(), [{"username": f"user{i:04d}", "password_hash": admin.password_hash, "is_admin": False}
+                                                     for i in range(options["users"])])
+        media_ids = [media_id for media_id, in db.session.execute(db.select(Media.media_id).where(Media.is_video))]
+        user_ids = [user_id for user_id, in db.session.execute(db.select(User.user_id))]
+
+        now = time.time()
+        for user_id in user_ids:
+            watched = rng.sample(media_ids, int(len(media_ids) * options["watched_fraction"]))
+            if watched:
+                db.session.execute(user_watched.insert(), [{"user_id": user_id, "media_id": media_id} for media_id in watched])
+            progress = rng.sample(media_ids, int(len(media_ids) * options["progress_fraction"]))
+            if progress:
+                db.session.execute(MediaProgress.__table__.insert(),
+                                   [{"user_id": user_id, "media_id": media_id, "position_seconds": rng.uniform(0, 3000), "updated_at": now}
+                                    for media_id in progress])
+        db.session.commit()
+
+        media_id = Media.query.filter_by(subpath=library["subtitle_video"]).one().media_id
+
+    subtitles.executor.shutdown(wait=True) # .srt files queued for conversion by the scan
+    print(json.dumps({"media_id": media_id, "media_rows": len(media_ids), "user_rows": len(user_ids)}))
+
+# test client mode, one scenario per process
+
+def run_scenario(root, name, requests, warmup):
+    with open(os.path.join(root, "manifest.json")) as fp:
+        library = json.load(fp)
+    scenario = SCENARIOS[name]
+
+    import app as server
+    from sqlalchemy import event
+
+    queries = []
+    with server.app.app_context():
+        event.listen(server.db.engine, "before_cursor_execute", lambda *args: queries.append(1))
+
+    client = TestClient(server.app.test_client())
+    login(client)
+    wait_for_scanner(os.path.join(server.app.instance_path, "library-scan.lock"))
+    if scenario.setup:
+        scenario.setup(server)
+
+    state = {"prefix": f"client-{os.getpid()}"}
+    for i in range(warmup):
+        scenario.run(client, library, -1 - i, state)
+
+    pid = os.getpid()
+    reset_peak_rss(pid)
+    rss_start = read_status(pid, "VmRSS")
+    queries.clear()
+
+    latencies = []
+    errors = 0
+    start = time.perf_counter()
+    for i in range(requests):
+        operation_start = time.perf_counter()
+        status, _ = scenario.run(client, library, i, state)
+        latencies.append(time.perf_counter() - operation_start)
+        errors += status >= 400
+    seconds = time.perf_counter() - start
+
+    rss_peak = read_status(pid, "VmHWM")
+    if rss_peak is None:
+        import resource
+        rss_peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 # kB on linux, only a fallback
+
+    print(json.dumps(summarize("client", name, latencies, errors, seconds, len(queries), rss_start, rss_peak)))
+
+def run_client_mode(root, names, args):
+    results = []
+    for name in names:
+        result = run_self(root, "--run-scenario", name, "--requests", str(args.requests), "--warmup", str(args.warmup))
+        print_result(result)
+        results.append(result)
+    return results
+
+# gunicorn mode, all scenarios against one server
+
+def server_pids(pid):
+    # gunicorn master and its workers
+    pids = [pid]
+    if not os.path.isdir("/proc"):
+        return pids
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as fp:
+                parent = int(fp.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        if parent == pid:
+            pids.append(int(entry))
+    return pids
+
+def scrape_queries(base):
+    # db_queries_total over all routes and workers, from /metrics
+    request = urllib.request.Request(base + "/metrics", headers={"Authorization": f"Bearer {METRICS_TOKEN}"})
+    with urllib.request.urlopen(request, timeout=30) as response:
+        text = response.read().decode("utf-8")
+    return sum(float(line.rsplit(" ", 1)[1]) for line in text.splitlines() if line.startswith("db_queries_total{"))
+
+def wait_until_up(url, timeout = 120):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            urllib.request.urlopen(url, timeout=1).read()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError("server did not start")
+
+def run_clients(clients, scenario, library, requests, mode):
+    # splits requests over the clients, one thread each
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+
+    def run(index, client):
+        state = {"prefix": f"{mode}-{os.getpid()}-{index}"}
+        for i in range(index, requests, len(clients)):
+            start = time.perf_counter()
+            status, _ = scenario.run(client, library, i, state)
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+                errors[0] += status >= 400
+
+    threads = [threading.Thread(target=run, args=(index, client)) for index, client in enumerate(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, errors[0], time.perf_counter() - start
+
+def run_gunicorn_mode(root, names, library, args):
+    env = dict(app_env(root), WSGI_PORT=str(PORT), WSGI_WORKERS=str(args.workers), WSGI_WORKER_CLASS=args.worker_class,
+               TAILSCALE_IP="127.0.0.1", ACCESS_LOGFILE=os.path.join(root, "access.log"), ERROR_LOGFILE=os.path.join(root, "error.log"))
+    server = subprocess.Popen([sys.executable, os.path.join(APP_DIR, "wsgi_launcher.py")], cwd=root, env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    results = []
+    try:
+        base = f"http://127.0.0.1:{PORT}"
+        wait_until_up(base + "/login")
+
+        clients = [HTTPClient(base) for _ in range(args.clients)]
+        for client in clients:
+            login(client)
+        run_clients(clients, SCENARIOS["index_root"], library, len(clients) * 2, "warmup") # starts every worker's background tasks
+        wait_for_scanner(os.path.join(APP_DIR, "instance", "library-scan.lock"))
+
+        for name in names:
+            scenario = SCENARIOS[name]
+            run_clients(clients, scenario, library, args.warmup * len(clients), "warmup")
+            time.sleep(METRICS_WRITE_INTERVAL + 1) # until every worker wrote its snapshot
+            queries_before = scrape_queries(base)
+
+            pids = server_pids(server.pid)
+            for pid in pids:
+                reset_peak_rss(pid)
+            rss = [read_status(pid, "VmRSS") for pid in pids]
+            rss_start = sum(rss) if None not in rss else None
+
+            latencies, errors, seconds = run_clients(clients, scenario, library, args.requests, "gunicorn")
+
+            peaks = [read_status(pid, "VmHWM") for pid in pids]
+            time.sleep(METRICS_WRITE_INTERVAL + 1)
+            queries_after = scrape_queries(base)
+
+            result = summarize("gunicorn", name, latencies, errors, seconds, None, rss_start, sum(peaks) if None not in peaks else None)
+            result["queries_per_operation"] = round((queries_after - queries_before) / max(len(latencies), 1), 2)
+            result["workers"] = len(pids) - 1
+            print_result(result)
+            results.append(result)
+    finally:
+        server.send_signal(signal.SIGTERM)
+        server.wait()
+    return results
+
+# reporting
+
+def print_result(result):
+    latency = result["latency_ms"]
+    format_value = lambda value, spec: "-" if value is None else format(value, spec)
+    print(f"{result['mode']:<9} {result['scenario']:<26} ops={result['operations']:<5} errors={result['errors']:<4} "
+          f"p50={format_value(latency['p50'], '8.2f')} ms  p95={format_value(latency['p95'], '8.2f')} ms  "
+          f"p99={format_value(latency['p99'], '8.2f')} ms  queries={format_value(result['queries_per_operation'], '6.1f')}  "
+          f"rss={format_value(result['rss_peak_mb'], '7.1f')} MB", flush=True)
+
+def change(old, new):
+    if old is None or new is None:
+        return None
+    if not old:
+        return 0.0 if not new else float("inf")
+    return (new - old) / old * 100
+
+def compare(baseline, results, threshold):
+    # prints the change of every scenario in both runs, returns the number of regressions
+    previous = {(result["mode"], result["scenario"]): result for result in baseline["results"]}
+    regressions = 0
+    print(f"\ncompared to {baseline.get('git') or 'baseline'} ({baseline.get('created')}), regressions beyond {threshold}%:")
+    for result in results:
+        old = previous.get((result["mode"], result["scenario"]))
+        if not old:
+            continue
+
+        changes = {"p50": change(old["latency_ms"]["p50"], result["latency_ms"]["p50"]),
+                   "p99": change(old["latency_ms"]["p99"], result["latency_ms"]["p99"]),
+                   "queries": change(old["queries_per_operation"], result["queries_per_operation"]),
+                   "rss": change(old["rss_peak_mb"], result["rss_peak_mb"])}
+        worse = [name for name, value in changes.items() if value is not None and value > threshold]
+        regressions += bool(worse)
+        print(f"{result['mode']:<9} {result['scenario']:<26} "
+              + "  ".join(f"{name}={'-' if value is None else format(value, '+7.1f')}%" for name, value in changes.items())
+              + ("  REGRESSED: " + ", ".join(worse) if worse else ""))
+    return regressions
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BENCH_DIR, capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+def main():
+    cpus = os.cpu_count() or 1
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--preset", choices=synthetic_library.PRESETS, default="medium")
+    for name in synthetic_library.PRESETS["medium"]:
+        parser.add_argument(f"--{name.replace('_', '-')}", type=int, help="overrides the preset")
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--watched-fraction", type=float, default=0.3)
+    parser.add_argument("--progress-fraction", type=float, default=0.05)
+    parser.add_argument("--modes", nargs="+", choices=["client", "gunicorn"], default=["client", "gunicorn"])
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument("--requests", type=int, default=200, help="operations per scenario")
+    parser.add_argument("--warmup", type=int, default=5, help="operations per scenario (and client) before measuring")
+    parser.add_argument("--clients", type=int, default=4, help="concurrent clients in gunicorn mode")
+    parser.add_argument("--workers", type=int, default=0, help="gunicorn workers, 0 = based on the cpu count")
+    parser.add_argument("--worker-class", default="gthread")
+    parser.add_argument("--root", help="directory for the library and database, kept between runs")
+    parser.add_argument("--output", help="write the results here as JSON")
+    parser.add_argument("--compare", help="results of an earlier run to compare against")
+    parser.add_argument("--threshold", type=float, default=10, help="percent change counted as a regression")
+    parser.add_argument("--setup", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--run-scenario", choices=SCENARIOS, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.setup:
+        return setup(args.root)
+    if args.run_scenario:
+        return run_scenario(args.root, args.run_scenario, args.requests, args.warmup)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        root = os.path.abspath(args.root or tmp)
+        os.makedirs(root, exist_ok=True)
+        library = prepare(root, args)
+        print(f"{cpus} cpu(s), {library['videos']} videos in {library['folder_count']} folders, "
+              f"{library['subtitles']} .srt files, {library['options']['users']} users")
+
+        results = []
+        names = [name for name in SCENARIOS if name in args.scenarios] # uploads last
+        try:
+            if "client" in args.modes:
+                results += run_client_mode(root, names, args)
+            if "gunicorn" in args.modes:
+                results += run_gunicorn_mode(root, [name for name in names if not SCENARIOS[name].client_only], library, args)
+        finally:
+            remove_uploads(library) # the database forgets them on the next scan, so --root runs stay comparable
+
+    report = {"created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+              "git": git_commit(),
+              "python": platform.python_version(),
+              "platform": platform.platform(),
+              "cpus": cpus,
+              "library": {name: library[name] for name in ("options", "videos", "subtitles", "folder_count", "media_rows", "user_rows")},
+              "settings": {"requests": args.requests, "warmup": args.warmup, "clients": args.clients,
+                           "workers": args.workers, "worker_class": args.worker_class},
+              "results": results}
+
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump(report, fp, indent=2)
+
+    if args.compare:
+        with open(args.compare) as fp:
+            if compare(json.load(fp), results, args.threshold):
+                sys.exit(1)
+
+if __name__ == "__main__":
+    main()
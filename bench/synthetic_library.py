@@ -0,0 +1,101 @@
+# synthetic media library for benchmarks: a deep folder tree, one very large folder, sparse video
+# files (full size on paper, no disk space used) and .srt subtitles in a mix of encodings
+#
+# used by bench/suite.py, or on its own to get a library to point MEDIA_DIR at:
+# usage: python bench/synthetic_library.py <media dir> [--preset medium] [--big-folder-files 10000]
+
+import os
+import json
+import random
+import argparse
+
+# name -> generate() arguments
+PRESETS = {
+    "small": {"depth": 3, "branching": 2, "files_per_folder": 10, "big_folder_files": 1000, "video_mb": 64, "srt_every": 5},
+    "medium": {"depth": 5, "branching": 3, "files_per_folder": 20, "big_folder_files": 10000, "video_mb": 700, "srt_every": 10},
+    "large": {"depth": 7, "branching": 3, "files_per_folder": 30, "big_folder_files": 20000, "video_mb": 2000, "srt_every": 10},
+}
+
+# encodings the .srt files are written in, with a line each can encode
+SRT_ENCODINGS = [
+    ("utf-8", "Déjà vu, naïve café — ¿qué?"),
+    ("utf-8-sig", "Ça va? Œuvres complètes"),
+    ("cp1252", "Déjà vu, naïve café, façade"),
+    ("utf-16", "Déjà vu — こんにちは"),
+    ("cp1251", "Привет, как дела? Всё хорошо"),
+    ("shift_jis", "こんにちは、元気ですか"),
+    ("iso-8859-7", "Καλημέρα, τι κάνεις;"),
+]
+
+BIG_FOLDER = "Big Folder"
+TREE_ROOT = "Library"
+UPLOAD_FOLDER = "Uploads" # empty, for upload benchmarks
+
+def write_video(path, size):
+    with open(path, "wb") as fp:
+        fp.truncate(size) # sparse, reads as zeros
+
+def write_srt(path, encoding, line, cues):
+    # cues two seconds apart, every encoding gets the same structure
+    parts = []
+    for i in range(1, cues + 1):
+        start = i * 2
+        timestamp = f"{start // 3600:02d}:{start // 60 % 60:02d}:{start % 60:02d}"
+        parts.append(f"{i}\r\n{timestamp},000 --> {timestamp},900\r\n{line} {i}\r\n\r\n")
+    with open(path, "w", encoding=encoding, newline="") as fp:
+        fp.write("".join(parts))
+
+def write_folder(media_dir, subpath, files, video_size, srt_every, rng, manifest):
+    os.makedirs(os.path.join(media_dir, subpath), exist_ok=True)
+    manifest["folders"].append(subpath)
+
+    for i in range(files):
+        filename = f"Episode {i:05d}.{'mp4' if i % 3 else 'mkv'}"
+        video_subpath = f"{subpath}/{filename}"
+        write_video(os.path.join(media_dir, video_subpath), video_size)
+        manifest["videos"] += 1
+
+        if srt_every and i % srt_every == 0:
+            encoding, line = SRT_ENCODINGS[manifest["subtitles"] % len(SRT_ENCODINGS)]
+            write_srt(os.path.join(media_dir, os.path.splitext(video_subpath)[0] + ".srt"), encoding, line, rng.randint(100, 400))
+            manifest["subtitles"] += 1
+            manifest.setdefault("subtitle_videos", []).append(video_subpath)
+
+def write_tree(media_dir, subpath, level, args, rng, manifest):
+    write_folder(media_dir, subpath, args["files_per_folder"], args["video_mb"] * 1024**2, args["srt_every"], rng, manifest)
+    if level == args["depth"]:
+        manifest["deep_folder"] = manifest.get("deep_folder") or subpath
+        return
+    for i in range(args["branching"]):
+        write_tree(media_dir, f"{subpath}/Level {level + 1} {chr(ord('A') + i)}", level + 1, args, rng, manifest)
+
+def generate(media_dir, depth, branching, files_per_folder, big_folder_files, video_mb, srt_every, seed = 0):
+    # returns a manifest: counts and the paths benchmarks request
+    args = {"depth": depth, "branching": branching, "files_per_folder": files_per_folder, "video_mb": video_mb, "srt_every": srt_every}
+    rng = random.Random(seed)
+    manifest = {"media_dir": os.path.abspath(media_dir), "folders": [], "videos": 0, "subtitles": 0,
+                "big_folder": BIG_FOLDER, "deep_folder": None, "upload_folder": UPLOAD_FOLDER}
+
+    write_tree(media_dir, TREE_ROOT, 0, args, rng, manifest)
+    write_folder(media_dir, BIG_FOLDER, big_folder_files, video_mb * 1024**2, srt_every * 10, rng, manifest)
+    write_folder(media_dir, UPLOAD_FOLDER, 0, 0, 0, rng, manifest)
+
+    manifest["folder_count"] = len(manifest.pop("folders"))
+    manifest["subtitle_video"] = manifest.pop("subtitle_videos", [None])[0]
+    return manifest
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("media_dir")
+    parser.add_argument("--preset", choices=PRESETS, default="medium")
+    for name in PRESETS["medium"]:
+        parser.add_argument(f"--{name.replace('_', '-')}", type=int)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    options = dict(PRESETS[args.preset])
+    options.update({name: getattr(args, name) for name in options if getattr(args, name) is not None})
+    print(json.dumps(generate(args.media_dir, seed=args.seed, **options), indent=2))
+
+if __name__ == "__main__":
+    main()